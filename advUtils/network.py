@@ -1,5 +1,11 @@
 import socketserver
-from typing import Union, Callable, Any
+import struct
+from collections import deque
+from queue import Queue
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, perf_counter, sleep
+from typing import Union, Callable, Any, Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
 import win32net
 
 import wx
@@ -25,6 +31,15 @@ STATE_LAUNCH = "state_launch"
 CLIENT = "client"
 SERVER = "server"
 
+NoneType = type(None)
+
+# Frame flags, stored in the highest bits of the 8-byte length header.
+RAW_FRAME = 1 << 63
+# Heartbeat frames, a ping is answered with a pong by the receiving packet system.
+CONTROL_FRAME = 1 << 62
+PING = b"ping"
+PONG = b"pong"
+
 
 class _Utils:
     @staticmethod
@@ -208,6 +223,292 @@ class Downloader(object):
         return self.downloadActive
 
 
+class KeyExchange(object):
+    # The 2048-bit MODP group of RFC 3526 (group 14), a safe prime with generator 2.
+    PRIME = int(
+        "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A43"
+        "1B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7EDEE386BFB5A899FA5AE9F24117C4B"
+        "1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB9ED5290770"
+        "96966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3BE39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF69"
+        "55817183995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF", 16)
+    GENERATOR = 2
+
+    # Bits of the private exponents, twice the security level of the group.
+    exponentBits = 256
+
+    _shared: Optional['KeyExchange'] = None
+    _sharedLock = Lock()
+
+    def __init__(self, pool_size: int = 4):
+        """
+        Diffie-Hellman key exchange over a fixed group, used in the handshake of Server.run() and Client.run().
+        Every connection gets a new keypair. Keypairs are generated ahead on a background thread, so a handshake only
+        computes the shared secret.
+
+        :param pool_size: The amount of keypairs to keep ready.
+        """
+
+        import queue
+        import threading
+
+        self._pool = queue.Queue(pool_size)
+        self._empty = queue.Empty
+        self._thread = threading.Thread(target=self._fill, name="KeyExchange", daemon=True)
+        self._threadLock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> 'KeyExchange':
+        """
+        Returns the key exchange shared by the servers and clients of the process, with one pool of keypairs.
+
+        :return:
+        """
+
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _fill(self):
+        while True:
+            self._pool.put(self.generate_keypair())
+
+    @classmethod
+    def generate_keypair(cls) -> Tuple[int, int]:
+        """
+        Generate a new keypair.
+
+        :return: The private exponent and the public value.
+        """
+
+        import secrets
+
+        private = secrets.randbits(cls.exponentBits) | 1 << (cls.exponentBits - 1)
+        return private, pow(cls.GENERATOR, private, cls.PRIME)
+
+    def keypair(self) -> Tuple[int, int]:
+        """
+        Take a keypair from the pool, or generate one if the pool is empty. A keypair is only used once.
+
+        :return: The private exponent and the public value.
+        """
+
+        with self._threadLock:
+            if not self._thread.is_alive() and self._thread.ident is None:
+                self._thread.start()
+        try:
+            return self._pool.get_nowait()
+        except self._empty:
+            return self.generate_keypair()
+
+    @classmethod
+    def secret(cls, private: int, public: int) -> int:
+        """
+        Compute the shared secret from the public value of the other side.
+
+        :param private: The own private exponent.
+        :param public: The public value of the other side.
+        :raises ValueError: If the public value isn't in the group, like 1 or p - 1, which give a guessable secret.
+        :return:
+        """
+
+        if not 1 < public < cls.PRIME - 1:
+            raise ValueError("Public value out of range")
+        return pow(public, private, cls.PRIME)
+
+
+class PooledConnection(object):
+    def __init__(self, address: str, conn, pak: 'PacketSystem', owner, *, port: Optional[int] = None, settings: Optional[tuple] = None):
+        """
+        Connection in a connection pool.
+
+        :param address: The IP address of the peer.
+        :param conn: The socket connection.
+        :param pak: The packet system of the connection, heartbeats are sent with it.
+        :param owner: The server or client that runs the connection.
+        :param port: The server port the connection was opened to, None for accepted connections.
+        :param settings: The settings the connection was opened with, see Client.pool_settings().
+        """
+
+        self.address: str = address
+        self.port: Optional[int] = port
+        self.settings: Optional[tuple] = settings
+        self.conn = conn
+        self.pak: PacketSystem = pak
+        self.owner = owner
+        # Other servers and clients of the process that use the connection, see Client.run().
+        self.adopters: list = []
+
+        # Time the connection was last used for a transfer, or taken from the pool.
+        self.lastUse: float = monotonic()
+        self.lastPing: float = 0.0
+
+    def users(self) -> list:
+        return [self.owner, *self.adopters]
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} address={self.address} port={self.port} " \
+               f"owner={self.owner.__class__.__name__}>"
+
+
+class ConnectionPool(object):
+    _shared: Optional['ConnectionPool'] = None
+    _sharedLock = Lock()
+
+    def __init__(self, *, heartbeat_interval: float = 15.0, heartbeat_timeout: float = 45.0, idle_timeout: float = 3600.0):
+        """
+        Pool of the authenticated connections of the process, shared by the servers and clients. A client that connects
+        to a server it already has a connection to, opened to the same port with the same settings, uses it without a new
+        key exchange. Connections accepted by a server are only kept alive, they aren't used by clients.
+        Connections that haven't received anything for the heartbeat interval are pinged, so firewalls and NATs keep
+        them open and dead peers are noticed. Connections are closed when the peer doesn't answer within the heartbeat
+        timeout, or when they weren't used for the idle timeout. Busy connections, see Server.is_busy(...), are left
+        alone, their transfers notice a broken connection themselves.
+
+        :param heartbeat_interval: The seconds without received frames before a connection is pinged.
+        :param heartbeat_timeout: The seconds without received frames before a connection is closed.
+        :param idle_timeout: The seconds without use before a connection is closed, None to keep connections open.
+        """
+
+        import socket
+        import threading
+
+        self.heartbeatInterval: float = heartbeat_interval
+        self.heartbeatTimeout: float = heartbeat_timeout
+        self.idleTimeout: Optional[float] = idle_timeout
+
+        self._connections: Dict[Any, PooledConnection] = {}
+        self._busySince: Dict[Any, float] = {}
+        self._lock = threading.Lock()
+        self._socket = socket
+        self._threading = threading
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def shared(cls) -> 'ConnectionPool':
+        """
+        Returns the connection pool shared by the servers and clients of the process.
+
+        :return:
+        """
+
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def add(self, address: str, conn, pak: 'PacketSystem', owner, *, port: Optional[int] = None, settings: Optional[tuple] = None) -> PooledConnection:
+        """
+        Add a connection to the pool, after its handshake.
+
+        :param address: The IP address of the peer.
+        :param conn: The socket connection.
+        :param pak: The packet system of the connection.
+        :param owner: The server or client that runs the connection, it's told when the pool closes the connection.
+        :param port: The server port the connection was opened to, None for accepted connections.
+        :param settings: The settings the connection was opened with, see Client.pool_settings().
+        :return: The pooled connection.
+        """
+
+        pooled = PooledConnection(address, conn, pak, owner, port=port, settings=settings)
+        with self._lock:
+            self._connections[conn] = pooled
+            if self._thread is None:
+                self._thread = self._threading.Thread(target=self._run, name="ConnectionPool", daemon=True)
+                self._thread.start()
+        return pooled
+
+    def get(self, address: str, port: int, settings: tuple, owner=None) -> Optional[PooledConnection]:
+        """
+        Returns a warm connection to a server.
+
+        :param address: The IP address of the server.
+        :param port: The port of the server.
+        :param settings: The settings of the client, see Client.pool_settings().
+        :param owner: Only return connections opened by this client, None for connections of any client.
+        :return: The most recently used connection, or None if the pool has no matching connection.
+        """
+
+        now = monotonic()
+        with self._lock:
+            candidates = [pooled for pooled in self._connections.values()
+                          if pooled.address == address and pooled.port == port and pooled.settings == settings
+                          and (owner is None or pooled.owner is owner)
+                          and now - pooled.pak.lastReceived < self.heartbeatTimeout]
+            if not candidates:
+                return None
+            pooled = max(candidates, key=lambda pooled_: pooled_.lastUse)
+            pooled.lastUse = now
+            return pooled
+
+    def connections(self) -> List[PooledConnection]:
+        with self._lock:
+            return list(self._connections.values())
+
+    def remove(self, conn) -> Optional[PooledConnection]:
+        """
+        Remove a connection from the pool, without closing it.
+
+        :param conn: The socket connection.
+        :return: The pooled connection, or None if it wasn't in the pool.
+        """
+
+        with self._lock:
+            self._busySince.pop(conn, None)
+            return self._connections.pop(conn, None)
+
+    def close(self, conn):
+        """
+        Remove a connection from the pool and close it. The owner is told first, so it knows the connection errors
+        that follow are expected.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        pooled = self.remove(conn)
+        if pooled is not None:
+            for user in pooled.users():
+                user.connection_closed(conn)
+        try:
+            conn.shutdown(self._socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def check(self):
+        """
+        Pings the silent connections, and closes the dead and idle connections. Called every second by the pool thread.
+
+        :return:
+        """
+
+        for pooled in self.connections():
+            now = monotonic()
+            if any(user.is_busy(pooled.conn) for user in pooled.users()):
+                self._busySince[pooled.conn] = now
+                pooled.lastUse = now
+                continue
+
+            # A transfer that just finished may have kept the connection from receiving, like the sender of a file.
+            silent = now - max(pooled.pak.lastReceived, self._busySince.get(pooled.conn, 0.0))
+            if silent > self.heartbeatTimeout:
+                self.close(pooled.conn)
+            elif self.idleTimeout is not None and now - pooled.lastUse > self.idleTimeout:
+                self.close(pooled.conn)
+            elif silent > self.heartbeatInterval and now - pooled.lastPing > self.heartbeatInterval:
+                pooled.lastPing = now
+                try:
+                    pooled.pak.ping()
+                except OSError:
+                    self.close(pooled.conn)
+
+    def _run(self):
+        while True:
+            sleep(1.0)
+            self.check()
+
+
 class Server(object):
     "A class for a Server instance."""
 
@@ -248,12 +549,52 @@ class Server(object):
 
         self.conn_array = []
         self.secret_array = {}
+        self.codec_array = {}
+        # Extra data streams opened by the clients in single-port mode, by connection and stream index. The condition
+        # of a connection is notified when a stream is attached.
+        self.stream_array = {}
+        self.stream_locks = {}
+        self.stream_conditions = {}
+        # The stream indices attached to a connection, an index is attached once per session.
+        self.stream_indices = {}
+        self._sessions = {}
+
+        # Disable Nagle's algorithm on the connections, lowers the latency of small packets.
+        self.tcpNoDelay = False
+
+        # Use the accepted connections directly, instead of moving every client to a random port.
+        # Clients must use the same mode. The preInitHook gets None for the second socket in this mode.
+        self.singlePort = False
+        # The amount of pending connections to queue in single-port mode.
+        self.backlog = 128
+        # Seconds a new connection in single-port mode may take to send its hello packet.
+        self.helloTimeout = 5.0
+        # The amount of extra data streams a connection may open in single-port mode.
+        self.maxStreams = 16
+        # Seconds a new connection may take for the key exchange and the codec negotiation.
+        self.handshakeTimeout = 10.0
+
+        # Encrypt the connections with AES-GCM, when the client wants it too. The session keys are stored by connection.
+        self.encrypted = False
+        self.key_array = {}
+        self.keyExchange = KeyExchange.shared()
+
+        # The packet systems of the connections, and the pool that keeps them alive.
+        self.pak_array = {}
+        self.pool: ConnectionPool = ConnectionPool.shared()
+
+        # Run streams over the connections with a Multiplexer, when the other side wants it too. The multiplexers are
+        # stored by connection, the runner gets the connection before anything is read from it.
+        self.multiplexed = False
+        self.mux_array = {}
 
         import math
+        import os
         import random
         import socket
         import threading
         self._math = math
+        self._os = os
         self._random = random
         self._socket = socket
         self._threading = threading
@@ -288,6 +629,78 @@ class Server(object):
 
         pass
 
+    def packet_system(self, conn) -> 'PacketSystem':
+        """
+        Returns the packet system of the connection, using the codecs negotiated for the connection.
+        It's created once per connection, so all senders share its frame writer, the heartbeats of the connection pool
+        included.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        pak = self.pak_array.get(conn)
+        if pak is None:
+            if conn in self.key_array:
+                pak = CryptedPacketSystem(conn, self.key_array[conn])
+            else:
+                pak = PacketSystem(conn)
+            self.pak_array[conn] = pak
+        if conn in self.codec_array:
+            pak.codecs = self.codec_array[conn]
+        return pak
+
+    def is_busy(self, conn) -> bool:
+        """
+        Checks if the connection is busy with a transfer, the connection pool doesn't ping or close busy connections.
+        Should be overridden in subclass to take effect.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return False
+
+    def streams(self, conn) -> Dict[int, 'PacketSystem']:
+        """
+        Returns the extra data streams of the connection, by stream index.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return self.stream_array.get(conn, {})
+
+    def stream_lock(self, conn):
+        """
+        Returns the lock for sending over the extra data streams of the connection, held for a whole transfer.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return self.stream_locks.get(conn)
+
+    def stream_condition(self, conn):
+        """
+        Returns the condition that is notified when an extra data stream of the connection is attached.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return self.stream_conditions.get(conn)
+
+    def multiplexer(self, conn) -> Optional['Multiplexer']:
+        """
+        Returns the multiplexer of the connection.
+
+        :param conn: The socket connection.
+        :return: The multiplexer, or None if the connection isn't multiplexed.
+        """
+
+        return self.mux_array.get(conn)
+
     def run(self):
         """
         Stars the server in non-thread-mode.
@@ -295,6 +708,10 @@ class Server(object):
         :return: Nothing
         """
 
+        if self.singlePort:
+            self._run_single_port()
+            return
+
         while True:
             s = self._socket.socket(self._socket.AF_INET, self._socket.SOCK_STREAM)
             try:
@@ -322,51 +739,214 @@ class Server(object):
             conn_init.close()
             conn, addr = serv.accept()
 
-            pak = PacketSystem(conn)
-
-            self.conn_array.append(conn)  # add an array entry for this connection
-            self.event(CONN_SUCCESS, self)
-
-            # create the numbers for my encryption
-            prime = self._random.randint(1000, 9000)
-            while not self.is_prime(prime):
-                prime = self._random.randint(1000, 9000)
-            base = self._random.randint(20, 100)
-            a = self._random.randint(20, 100)
-
-            # send the numbers (base, prime, A)
-            # conn.send(self.network.format_number(len(str(base))).encode())
-            # conn.send(str(base).encode())
-            #
-            # conn.send(self.network.format_number(len(str(prime))).encode())
-            # conn.send(str(prime).encode())
-            #
-            # conn.send(self.network.format_number(len(str(pow(base, a) % prime))).encode())
-            # conn.send(str(pow(base, a) % prime).encode())
-            #
-            # # get B
-            # value = conn.recv(4)
-            # value = conn.recv(int(value.decode()))
-            # b = int(value.decode())
-
-            pak.send(base)
-            pak.send(prime)
-            pak.send(pow(base, a))
-
-            b = PacketReciever(conn).recv()
-
-            # calculate the encryption key
-            secret = pow(b, a) % prime
-            # store the encryption key by the connection
-            self.secret_array[conn] = secret
-
-            self.postInitHook(self, conn, addr, secret)
-
-            self._threading.Thread(target=self.runner, args=(conn, secret)).start()
-            del pak
+            self._threading.Thread(target=self._init_connection, args=(conn, addr), daemon=True).start()
             # # Server(self.port_).start()
         # self.start()
 
+    def _run_single_port(self):
+        """
+        Accepts the connections on the listening socket, which is created once. The accepted connections are used
+        directly, without moving to a random port.
+
+        :return: Nothing
+        """
+
+        s = self._socket.socket(self._socket.AF_INET, self._socket.SOCK_STREAM)
+        try:
+            s.bind(('', self.port))
+        except OSError:
+            return
+
+        self.preInitHook(self, s, None)
+        s.listen(self.backlog)
+        self.event(CONN_SUCCESS, "server")
+
+        while True:
+            conn, addr = s.accept()
+
+            # The handshake runs on its own thread, a slow client doesn't hold up the next connections.
+            self._threading.Thread(target=self._accept, args=(conn, addr), daemon=True).start()
+
+    def _accept(self, conn, addr):
+        """
+        Reads the hello packet of an accepted connection in single-port mode, and initializes it as a connection or as
+        an extra data stream.
+
+        :param conn: The accepted socket connection.
+        :param addr: The address of the client.
+        :return: Nothing
+        """
+
+        # The hello packet tells a new connection apart from an extra data stream of a connection. It comes from an
+        # unauthenticated peer, whatever fails on it only closes the socket.
+        conn.settimeout(self.helloTimeout)
+        try:
+            hello = PacketReciever(conn).recv()
+            conn.settimeout(None)
+            if isinstance(hello, dict) and hello.get("type") == "stream":
+                self._init_stream(conn, hello)
+                return
+        except Exception:
+            self._forget(conn)
+            conn.close()
+            return
+        self._init_connection(conn, addr)
+
+    def _init_stream(self, conn, hello: dict):
+        """
+        Attaches an extra data stream to the connection of its session.
+
+        :param conn: The accepted socket connection of the stream.
+        :param hello: The hello packet of the stream.
+        :return: Nothing
+        """
+
+        # The hello packet isn't authenticated, streams with an unknown session or an invalid or used index are closed.
+        main_conn = self._sessions.get(hello.get("session"))
+        index = hello.get("index")
+        salt = hello.get("salt")
+        streams = self.stream_array.get(main_conn)
+        condition = self.stream_conditions.get(main_conn)
+        used = self.stream_indices.get(main_conn)
+        if streams is None or condition is None or used is None or not isinstance(index, int) or \
+                not 0 <= index < self.maxStreams or index in used or not isinstance(salt, str) or len(salt) != 32:
+            conn.close()
+            return
+
+        if self.tcpNoDelay:
+            conn.setsockopt(self._socket.IPPROTO_TCP, self._socket.TCP_NODELAY, 1)
+        self.codec_array[conn] = self.codec_array[main_conn]
+        if main_conn in self.key_array:
+            self.key_array[conn] = self.key_array[main_conn].derive(f"{index} {salt}")
+        pak = self.packet_system(conn)
+        with condition:
+            # A reused index would get the key and nonces of its earlier stream again.
+            attached = index not in used
+            if attached:
+                used.add(index)
+                streams[index] = pak
+            condition.notify_all()
+        if not attached:
+            # Another stream with the same index was attached in the meantime.
+            self.codec_array.pop(conn, None)
+            self.key_array.pop(conn, None)
+            self.pak_array.pop(conn, None)
+            conn.close()
+
+    def _init_connection(self, conn, addr):
+        """
+        Initializes an accepted connection, exchanges the encryption key and codecs, and starts the runner.
+
+        :param conn: The accepted socket connection.
+        :param addr: The address of the client.
+        :return: Nothing
+        """
+
+        if self.tcpNoDelay:
+            conn.setsockopt(self._socket.IPPROTO_TCP, self._socket.TCP_NODELAY, 1)
+
+        pak = PacketSystem(conn)
+
+        self.conn_array.append(conn)  # add an array entry for this connection
+        self.event(CONN_SUCCESS, self)
+
+        conn.settimeout(self.handshakeTimeout)
+        try:
+            secret = self._handshake(conn, pak)
+        except Exception:
+            # The client isn't authenticated yet, whatever fails on its input only drops the connection.
+            self.connection_closed(conn)
+            conn.close()
+            return
+        conn.settimeout(None)
+        if conn in self.mux_array:
+            self.mux_array[conn].start()
+        self.pool.add(addr[0], conn, self.packet_system(conn), self)
+
+        self.postInitHook(self, conn, addr, secret)
+
+        self._threading.Thread(target=self.runner, args=(conn, secret)).start()
+        del pak
+
+    def _handshake(self, conn, pak: 'PacketSystem') -> int:
+        """
+        Exchanges the encryption key and the codecs with the client.
+
+        :param conn: The socket connection.
+        :param pak: The packet-system for the handshake.
+        :return: The shared secret.
+        """
+
+        # send the group (base, prime) and my public value A, the keypair is generated ahead
+        a, public = self.keyExchange.keypair()
+        pak.send(KeyExchange.GENERATOR)
+        pak.send(KeyExchange.PRIME)
+        pak.send(public)
+
+        b = PacketReciever(conn).recv()
+
+        # calculate the encryption key
+        secret = KeyExchange.secret(a, b)
+        # store the encryption key by the connection
+        self.secret_array[conn] = secret
+
+        # negotiate the packet codecs, the client picks from the offered codecs
+        pak.send(CodecRegistry.available())
+        self.codec_array[conn] = PacketReciever(conn).recv()
+
+        # negotiate the encryption, both sides send a random salt when they want to encrypt the connection
+        salt = self._os.urandom(16) if self.encrypted and FrameCipher.available() else None
+        pak.send(salt)
+        client_salt = PacketReciever(conn).recv()
+        if salt is not None and client_salt is not None:
+            self.key_array[conn] = SessionKey.from_secret(secret, salt + client_salt, True)
+
+        # negotiate the multiplexing, the multiplexer is started after the handshake
+        pak.send(self.multiplexed)
+        if PacketReciever(conn).recv() and self.multiplexed:
+            self.mux_array[conn] = Multiplexer(self.packet_system(conn), True)
+
+        if self.singlePort:
+            # the session token, used by the client for opening extra data streams
+            token = uuid4()
+            self._sessions[token] = conn
+            self.stream_array[conn] = {}
+            self.stream_locks[conn] = self._threading.Lock()
+            self.stream_conditions[conn] = self._threading.Condition()
+            self.stream_indices[conn] = set()
+            pak.send(token)
+
+        return secret
+
+    def connection_closed(self, conn):
+        """
+        Forgets a connection that was closed by the connection pool, and closes its extra data streams.
+
+        :param conn: The socket connection.
+        :return: Nothing
+        """
+
+        if conn in self.conn_array:
+            self.conn_array.remove(conn)
+        for token, session_conn in list(self._sessions.items()):
+            if session_conn is conn:
+                del self._sessions[token]
+        for stream in self.stream_array.pop(conn, {}).values():
+            self._forget(stream.conn)
+            stream.conn.close()
+        self._forget(conn)
+        self.stream_locks.pop(conn, None)
+        self.stream_conditions.pop(conn, None)
+        self.stream_indices.pop(conn, None)
+        self.event(CONN_LOST, self)
+
+    def _forget(self, conn):
+        mux = self.mux_array.pop(conn, None)
+        if mux is not None:
+            mux.close()
+        for array in (self.secret_array, self.codec_array, self.key_array, self.pak_array):
+            array.pop(conn, None)
+
     def start(self):
         """
         Starts ther server in thread-mode.
@@ -415,15 +995,49 @@ class Client(object):
         self.preInitHook: Callable = lambda client, conn_init2: None
         self.postInitHook: Callable = lambda client, conn, secret: None
 
+        import os
         import socket
         import random
         import threading
+        self._os = os
         self._socket = socket
         self._random = random
         self._threading = threading
 
         self.secret_array = {}
         self.conn_array = []
+        self.codec_array = {}
+        # Extra data streams of the connections, by connection and stream index. The condition of a connection is
+        # notified when a stream is attached.
+        self.stream_array = {}
+        self.stream_locks = {}
+        self.stream_conditions = {}
+
+        # Disable Nagle's algorithm on the connections, lowers the latency of small packets.
+        self.tcpNoDelay = False
+
+        # Connect directly to the server port, the server must use the same mode.
+        self.singlePort = False
+        # The amount of extra data streams to open in single-port mode, for parallel transfers of large files.
+        self.streamCount = 0
+
+        # Encrypt the connections with AES-GCM, when the server wants it too. The session keys are stored by connection.
+        self.encrypted = False
+        self.key_array = {}
+        self.keyExchange = KeyExchange.shared()
+
+        # The packet systems of the connections, and the pool that keeps them alive.
+        self.pak_array = {}
+        self.pool: ConnectionPool = ConnectionPool.shared()
+
+        # Run streams over the connections with a Multiplexer, when the other side wants it too. The multiplexers are
+        # stored by connection, the runner gets the connection before anything is read from it.
+        self.multiplexed = False
+        self.mux_array = {}
+
+        # Use warm connections of other clients of the process. Adopted connections keep the runner of the client that
+        # opened them, so subclasses whose runner keeps state per connection must only use their own connections.
+        self.adoptConnections = True
 
         self.event: Callable = lambda evt_type, client: None
 
@@ -439,13 +1053,96 @@ class Client(object):
 
         pass
 
+    def packet_system(self, conn) -> 'PacketSystem':
+        """
+        Returns the packet system of the connection, using the codecs negotiated for the connection.
+        It's created once per connection, so all senders share its frame writer, the heartbeats of the connection pool
+        included.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        pak = self.pak_array.get(conn)
+        if pak is None:
+            if conn in self.key_array:
+                pak = CryptedPacketSystem(conn, self.key_array[conn])
+            else:
+                pak = PacketSystem(conn)
+            self.pak_array[conn] = pak
+        if conn in self.codec_array:
+            pak.codecs = self.codec_array[conn]
+        return pak
+
+    def is_busy(self, conn) -> bool:
+        """
+        Checks if the connection is busy with a transfer, the connection pool doesn't ping or close busy connections.
+        Should be overridden in subclass to take effect.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return False
+
+    def streams(self, conn) -> Dict[int, 'PacketSystem']:
+        """
+        Returns the extra data streams of the connection, by stream index.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return self.stream_array.get(conn, {})
+
+    def stream_lock(self, conn):
+        """
+        Returns the lock for sending over the extra data streams of the connection, held for a whole transfer.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return self.stream_locks.get(conn)
+
+    def stream_condition(self, conn):
+        """
+        Returns the condition that is notified when an extra data stream of the connection is attached.
+
+        :param conn: The socket connection.
+        :return:
+        """
+
+        return self.stream_conditions.get(conn)
+
+    def multiplexer(self, conn) -> Optional['Multiplexer']:
+        """
+        Returns the multiplexer of the connection.
+
+        :param conn: The socket connection.
+        :return: The multiplexer, or None if the connection isn't multiplexed.
+        """
+
+        return self.mux_array.get(conn)
+
     def run(self):
         """
-        Starts the client in non-thread-mode
+        Starts the client in non-thread-mode.
+        When the connection pool has a warm connection to the server, that connection is used, without a new
+        connection and key exchange.
 
         :returns: Nothing
         """
 
+        try:
+            pooled = self.pool.get(self._socket.gethostbyname(self.host), self.port, self.pool_settings(),
+                                   None if self.adoptConnections else self)
+        except OSError:
+            pooled = None
+        if pooled is not None:
+            self._adopt(pooled)
+            return
+
         conn_init2 = self._socket.socket(self._socket.AF_INET, self._socket.SOCK_STREAM)
         conn_init2.settimeout(5.0)
         pak_init = PacketSystem(conn_init2)
@@ -458,31 +1155,73 @@ class Client(object):
 
         self.preInitHook(self, conn_init2)
 
-        # Recieve port
-        porte = pak_init.recv()
+        if self.singlePort:
+            conn_init2.settimeout(None)
+            conn = conn_init2
+            pak_init.send({"type": "hello"})
+        else:
+            # Recieve port
+            porte = pak_init.recv()
 
-        del pak_init
-        conn_init2.close()
+            conn_init2.close()
 
-        # New connection
-        conn = self._socket.socket(self._socket.AF_INET, self._socket.SOCK_STREAM)
-        conn.connect((self.host, porte))
+            # New connection
+            conn = self._socket.socket(self._socket.AF_INET, self._socket.SOCK_STREAM)
+            conn.connect((self.host, porte))
+        del pak_init
+        if self.tcpNoDelay:
+            conn.setsockopt(self._socket.IPPROTO_TCP, self._socket.TCP_NODELAY, 1)
         pak = PacketSystem(conn)
 
         self.event(CONN_SUCCESS, self)
 
         self.conn_array.append(conn)
 
-        # Get my base, prime, and A values
+        # Get my base, prime, and A values, only the known group is accepted
         base = pak.recv()
         prime = pak.recv()
         a = pak.recv()
-        b = self._random.randint(20, 100)
-        # Send the 'b' value
-        pak.send(pow(base, b) % prime)
-        secret = pow(a, b) % prime
+        if (base, prime) != (KeyExchange.GENERATOR, KeyExchange.PRIME):
+            conn.close()
+            raise ConnectionRefusedError("The server uses an unknown key exchange group")
+        b, public = self.keyExchange.keypair()
+        # Send the 'B' value
+        pak.send(public)
+        secret = KeyExchange.secret(b, a)
 
         self.secret_array[conn] = secret
+
+        # Pick the codecs from the codecs offered by the server
+        codecs = CodecRegistry.negotiate(pak.recv())
+        pak.send(codecs)
+        self.codec_array[conn] = codecs
+
+        # Negotiate the encryption, both sides send a random salt when they want to encrypt the connection
+        server_salt = pak.recv()
+        salt = self._os.urandom(16) if self.encrypted and FrameCipher.available() else None
+        pak.send(salt)
+        if salt is not None and server_salt is not None:
+            self.key_array[conn] = SessionKey.from_secret(secret, server_salt + salt, False)
+
+        # Negotiate the multiplexing, the multiplexer is started after the handshake
+        multiplexed = pak.recv()
+        pak.send(self.multiplexed)
+        if multiplexed and self.multiplexed:
+            self.mux_array[conn] = Multiplexer(self.packet_system(conn), False)
+
+        if self.singlePort:
+            self.stream_array[conn] = {}
+            self.stream_locks[conn] = self._threading.Lock()
+            self.stream_conditions[conn] = self._threading.Condition()
+            token = pak.recv()
+            if token is not None:
+                for index in range(self.streamCount):
+                    self._open_stream(conn, token, index)
+        if conn in self.mux_array:
+            self.mux_array[conn].start()
+        self.pool.add(conn.getpeername()[0], conn, self.packet_system(conn), self, port=self.port,
+                      settings=self.pool_settings())
+
         self.postInitHook(self, conn, secret)
 
         self._threading.Thread(target=self.runner, args=(conn, secret)).start()
@@ -490,251 +1229,2428 @@ class Client(object):
         # Server(self.port_).start()                             # Errored command! #
         # THIS IS GOOD, BUT I CAN'T TEST ON ONE MACHINE
 
-    def start(self):
+    def pool_settings(self) -> tuple:
         """
-        Starts the client in thread-mode
+        Returns the settings that make a connection, a pooled connection is only used by clients with the same settings.
 
-        :returns: The Thread(...) instance of the client thread
+        :return: The settings.
         """
 
-        t_ = self._threading.Thread(target=self.run)
-        t_.start()
+        return self.singlePort, self.streamCount, self.encrypted, self.multiplexed, self.tcpNoDelay
+
+    def _adopt(self, pooled: PooledConnection):
+        """
+        Uses a pooled connection to the server. The connection keeps the runner of the server or client that opened it,
+        so the runner isn't started again.
+
+        :param pooled: The pooled connection.
+        :return: Nothing
+        """
+
+        conn = pooled.conn
+        owner = pooled.owner
+        if owner is not self:
+            for name in ("secret_array", "codec_array", "key_array", "pak_array", "mux_array", "stream_array",
+                         "stream_locks", "stream_conditions"):
+                if conn in getattr(owner, name):
+                    getattr(self, name)[conn] = getattr(owner, name)[conn]
+            if self not in pooled.adopters:
+                pooled.adopters.append(self)
+        if conn not in self.conn_array:
+            self.conn_array.append(conn)
+
+        self.event(CONN_SUCCESS, self)
+        self.postInitHook(self, conn, self.secret_array.get(conn))
+
+    def connection_closed(self, conn):
+        """
+        Forgets a connection that was closed by the connection pool, and closes its extra data streams.
+
+        :param conn: The socket connection.
+        :return: Nothing
+        """
+
+        if conn in self.conn_array:
+            self.conn_array.remove(conn)
+        for stream in self.stream_array.pop(conn, {}).values():
+            self._forget(stream.conn)
+            stream.conn.close()
+        self._forget(conn)
+        self.stream_locks.pop(conn, None)
+        self.stream_conditions.pop(conn, None)
+        self.event(CONN_LOST, self)
+
+    def _forget(self, conn):
+        mux = self.mux_array.pop(conn, None)
+        if mux is not None:
+            mux.close()
+        for array in (self.secret_array, self.codec_array, self.key_array, self.pak_array):
+            array.pop(conn, None)
+
+    def _open_stream(self, conn, token: UUID, index: int):
+        """
+        Opens an extra data stream for the connection.
+
+        :param conn: The socket connection of the session.
+        :param token: The session token sent by the server.
+        :param index: The index of the stream.
+        :return: Nothing
+        """
+
+        stream = self._socket.create_connection((self.host, self.port), 5.0)
+        stream.settimeout(None)
+        if self.tcpNoDelay:
+            stream.setsockopt(self._socket.IPPROTO_TCP, self._socket.TCP_NODELAY, 1)
+
+        # The hello packet isn't encrypted, the server reads it before it knows the session. The random salt gives every
+        # attached stream its own key.
+        import os
+
+        salt = os.urandom(16).hex()
+        hello = PacketSystem(stream)
+        hello.codecs = self.codec_array[conn]
+        hello.send({"type": "stream", "session": token, "index": index, "salt": salt})
+
+        if conn in self.key_array:
+            self.key_array[stream] = self.key_array[conn].derive(f"{index} {salt}")
+        pak = self.packet_system(stream)
+        pak.codecs = self.codec_array[conn]
+        self.stream_array[conn][index] = pak
+
+    def start(self):
+        """
+        Starts the client in thread-mode
+
+        :returns: The Thread(...) instance of the client thread
+        """
+
+        t_ = self._threading.Thread(target=self.run)
+        t_.start()
         return t_
 
 
+class PacketCodec(object):
+    def __init__(self, id_: int, name: str):
+        """
+        Serializer for packets. Encoded packets are prefixed with the codec id, so the receiver can decode any packet
+        from a registered codec.
+
+        :param id_: The codec id, sent as the first byte of every encoded packet.
+        :param name: The codec name, used for the codec negotiation.
+        """
+
+        self.id: int = id_
+        self.name: str = name
+        self.prefix: bytes = bytes((id_,))
+
+    def available(self) -> bool:
+        """
+        Checks if the codec can be used, a codec isn't available when its module can't be imported.
+
+        :return:
+        """
+
+        return True
+
+    def encode(self, o) -> list:
+        """
+        Encode an object.
+
+        :param o: The object to encode.
+        :raises ValueError: When the object isn't supported by the codec.
+        :return: A list of bytes-like parts.
+        """
+
+        raise NotImplementedError()
+
+    def decode(self, data: memoryview) -> Any:
+        """
+        Decode an object.
+
+        :param data: The encoded data, without the codec id.
+        :return: The decoded object.
+        """
+
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} id={self.id} name={repr(self.name)}>"
+
+
+class MarshalCodec(PacketCodec):
+    def __init__(self):
+        """
+        Codec for plain control packets, like dicts of strings and integers.
+        """
+
+        super(MarshalCodec, self).__init__(3, "marshal")
+
+        import marshal
+        self._marshal = marshal
+        self._scalars = frozenset((str, int, float, bool, bytes, NoneType))
+        self._containers = frozenset((list, tuple, set, frozenset))
+
+    def _is_plain(self, o) -> bool:
+        # Marshal converts bytes-like objects and subclasses to their base types, so only exact types are accepted.
+        type_ = type(o)
+        if type_ in self._scalars:
+            return True
+        if type_ is dict:
+            for key, value in o.items():
+                if not (type(key) in self._scalars or self._is_plain(key)):
+                    return False
+                if not (type(value) in self._scalars or self._is_plain(value)):
+                    return False
+            return True
+        if type_ in self._containers:
+            for item in o:
+                if not (type(item) in self._scalars or self._is_plain(item)):
+                    return False
+            return True
+        return False
+
+    def encode(self, o) -> list:
+        if not self._is_plain(o):
+            raise ValueError(f"Can't marshal {type(o).__name__}")
+        return [self._marshal.dumps(o)]
+
+    def decode(self, data: memoryview) -> Any:
+        return self._marshal.loads(data)
+
+
+class PickleCodec(PacketCodec):
+    def __init__(self):
+        """
+        Codec using pickle protocol 5, with out-of-band buffers for large binary data.
+        """
+
+        super(PickleCodec, self).__init__(2, "pickle")
+
+        import pickle
+        self._pickle = pickle
+        self._count = struct.Struct(">I")
+        self._length = struct.Struct(">Q")
+
+    def encode(self, o) -> list:
+        buffers = []
+        try:
+            data = self._pickle.dumps(o, protocol=5, buffer_callback=buffers.append)
+        except (self._pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ValueError(f"Can't pickle {type(o).__name__}: {e}")
+        buffers = [buffer.raw() for buffer in buffers]
+
+        header = [self._count.pack(len(buffers)), self._length.pack(len(data))]
+        header.extend(self._length.pack(len(buffer)) for buffer in buffers)
+        return [b"".join(header), data, *buffers]
+
+    def decode(self, data: memoryview) -> Any:
+        count, = self._count.unpack_from(data)
+        offset = self._count.size
+        lengths = []
+        for _ in range(count + 1):
+            lengths.append(self._length.unpack_from(data, offset)[0])
+            offset += self._length.size
+
+        pickled = data[offset:offset + lengths[0]]
+        offset += lengths[0]
+
+        # The frame buffer gets reused, so out-of-band buffers are copied.
+        buffers = []
+        for length in lengths[1:]:
+            buffers.append(bytearray(data[offset:offset + length]))
+            offset += length
+        return self._pickle.loads(pickled, buffers=buffers)
+
+
+class QPyDataCodec(PacketCodec):
+    def __init__(self):
+        """
+        Codec using the QPyDataFile format from advUtils.data.
+        """
+
+        super(QPyDataCodec, self).__init__(4, "qpydata")
+
+        self._dataFile = None
+
+    def available(self) -> bool:
+        try:
+            self._get_data_file()
+        except ImportError:
+            return False
+        return True
+
+    def _get_data_file(self):
+        if self._dataFile is None:
+            from advUtils.data import QPyDataFile
+            self._dataFile = QPyDataFile()
+        return self._dataFile
+
+    def encode(self, o) -> list:
+        try:
+            return [self._get_data_file().dumps(o)]
+        except (TypeError, KeyError) as e:
+            raise ValueError(f"Can't encode {type(o).__name__} with QPyDataFile: {e}")
+
+    def decode(self, data: memoryview) -> Any:
+        return self._get_data_file().loads(bytes(data))
+
+
+class DillCodec(PacketCodec):
+    def __init__(self):
+        """
+        Codec using dill, supports almost every object, like lambdas and exceptions. Used as fallback.
+        """
+
+        super(DillCodec, self).__init__(1, "dill")
+
+        self._dill = None
+
+    def available(self) -> bool:
+        try:
+            self._get_dill()
+        except ImportError:
+            return False
+        return True
+
+    def _get_dill(self):
+        if self._dill is None:
+            import dill
+            self._dill = dill
+        return self._dill
+
+    def encode(self, o) -> list:
+        return [self._get_dill().dumps(o)]
+
+    def decode(self, data: memoryview) -> Any:
+        return self._get_dill().loads(data)
+
+
+class CodecRegistry(object):
+    """
+    Registry of packet codecs.
+    The codecs used for a connection are negotiated in the handshake of Server.run() and Client.run(), they are tried
+    in order of preference until a codec supports the packet.
+    """
+
+    _codecs: Dict[str, PacketCodec] = {}
+    _ids: Dict[int, PacketCodec] = {}
+
+    # Order of preference, the first codec that supports a packet is used.
+    preference: List[str] = ["marshal", "pickle", "qpydata", "dill"]
+
+    @classmethod
+    def register(cls, codec: PacketCodec, preference: int = None):
+        """
+        Register a codec.
+
+        :param codec: The codec to register.
+        :param preference: Index in the order of preference, appended to the end when None.
+        :return:
+        """
+
+        if codec.id in cls._ids and cls._ids[codec.id].name != codec.name:
+            raise ValueError(f"Duplicate codec id: {codec.id}")
+        cls._codecs[codec.name] = codec
+        cls._ids[codec.id] = codec
+        if codec.name not in cls.preference:
+            if preference is None:
+                cls.preference.append(codec.name)
+            else:
+                cls.preference.insert(preference, codec.name)
+
+    @classmethod
+    def get(cls, name: str) -> PacketCodec:
+        return cls._codecs[name]
+
+    @classmethod
+    def get_by_id(cls, id_: int) -> PacketCodec:
+        try:
+            return cls._ids[id_]
+        except KeyError:
+            raise ValueError(f"Unknown codec id: {id_}")
+
+    @classmethod
+    def available(cls) -> List[str]:
+        """
+        Returns the names of the available codecs, in order of preference.
+
+        :return:
+        """
+
+        return [name for name in cls.preference if name in cls._codecs and cls._codecs[name].available()]
+
+    @classmethod
+    def negotiate(cls, offered: List[str]) -> List[str]:
+        """
+        Returns the available codecs that are also offered by the other side, in order of preference.
+
+        :param offered: The codec names offered by the other side.
+        :return:
+        """
+
+        return [name for name in cls.available() if name in offered]
+
+
+CodecRegistry.register(DillCodec())
+CodecRegistry.register(PickleCodec())
+CodecRegistry.register(MarshalCodec())
+CodecRegistry.register(QPyDataCodec())
+
+# Codecs used before a connection negotiated its codecs.
+DEFAULT_CODECS = ["marshal", "pickle", "dill"]
+
+
 class PacketEncoder(object):
-    def __init__(self, data):
+    def __init__(self, data, codecs: List[str] = None):
+        """
+        Packet encoder, encodes with the first of the given codecs that supports the data.
+
+        :param data: The data to encode.
+        :param codecs: The codec names to try, in order of preference.
+        """
+
         self.data = data
+        self.codecs: List[str] = DEFAULT_CODECS if codecs is None else codecs
+
+    def get_parts(self) -> list:
+        """
+        Returns the encoded data as a list of bytes-like parts, starting with the codec id.
+
+        :return:
+        """
 
-        import dill as dill
-        self._dill = dill
+        error = None
+        for name in self.codecs:
+            codec = CodecRegistry.get(name)
+            try:
+                parts = codec.encode(self.data)
+            except ValueError as e:
+                error = e
+                continue
+            return [codec.prefix, *parts]
+        raise ValueError(f"None of the codecs {self.codecs} can encode {type(self.data).__name__}: {error}")
 
     def get_encoded(self):
-        data = self._dill.dumps(self.data)
+        data = b"".join(self.get_parts())
         length = len(data)
 
         return length, data
 
     @classmethod
     def dump(cls, data, stream) -> None:
-        import dill
-
         stream.seek(0)
-        dill.dump(data, stream)
+        stream.write(cls.dumps(data))
 
     @classmethod
     def dumps(cls, data) -> bytes:
-        import dill
-
-        return dill.dumps(data)
+        return cls(data).get_encoded()[1]
 
 
 class PacketDecoder(object):
     def __init__(self, data: bytes):
-        self.data = data
+        """
+        Packet decoder, decodes with the codec of the codec id the data starts with.
+
+        :param data: The encoded data.
+        """
 
-        import dill as dill
-        self._dill = dill
+        self.data = data
 
     def get_decoded(self):
-        data = self._dill.loads(self.data)
+        data = memoryview(self.data)
 
-        return data
+        return CodecRegistry.get_by_id(data[0]).decode(data[1:])
 
     @classmethod
     def load(cls, stream) -> Any:
         """
-        Loads dilled data from the stream, and returns the normalized data.
+        Loads encoded data from the stream, and returns the normalized data.
 
         :param stream:
         :return:
         """
 
-        import dill
-
         stream.seek(0)
-        return dill.load(stream)
+        return cls(stream.read()).get_decoded()
 
     @classmethod
     def loads(cls, data) -> Any:
         """
-        Loads dilled data and returns the normalized data.
+        Loads encoded data and returns the normalized data.
 
         :param data:
         :return:
         """
 
-        import dill
-
-        return dill.loads(data)
+        return cls(data).get_decoded()
 
 
-class PacketSender(object):
-    def __init__(self, conn, data, len_bytesize=8):
-        self.lengthByteSize = len_bytesize
-        self._length, self._data = PacketEncoder(data).get_encoded()
+class BlockCompressor(object):
+    def __init__(self, id_: int, name: str):
+        """
+        Compressor for the data of raw file-data blocks. The compressor id is stored in the flags of a block, so the
+        receiver can decompress blocks of any registered compressor.
 
-        import socket
-        import socketserver
+        :param id_: The compressor id, from 1 to 7.
+        :param name: The compressor name, used for the compressor negotiation.
+        """
 
-        self.conn: Union[socket.socket, socketserver.BaseRequestHandler] = conn
+        if not 1 <= id_ <= 7:
+            raise ValueError(f"Compressor id out of range: {id_}")
+        self.id: int = id_
+        self.name: str = name
 
-    def send(self):
-        self.conn.send(self._length.to_bytes(self.lengthByteSize, "big", signed=False))
-        self.conn.send(self._data)
+    def available(self) -> bool:
+        """
+        Checks if the compressor can be used, a compressor isn't available when its module can't be imported.
 
-    def sendall(self):
-        if not issubclass(type(self.conn), socketserver.BaseRequestHandler):
-            raise Exception(f"the conn argument and attribute of {self.__class__.__name__}() "
-                            f"must be a subclass of socketserver.BaseRequestHandler")
+        :return:
+        """
 
-        self.conn.sendall(self._length.to_bytes(self.lengthByteSize, "big", signed=False))
-        self.conn.sendall(self._data)
+        return True
 
-    def __repr__(self):
-        if self.lengthByteSize == 8:
-            return f"<{self.__class__.__name__} data={repr(self._data)}>"
-        else:
-            return f"<{self.__class__.__name__} data={repr(self._data)} len_bytesize={repr(self.lengthByteSize)}>"
+    def compress(self, data) -> bytes:
+        raise NotImplementedError()
 
+    def decompress(self, data, length: int) -> bytes:
+        """
+        Decompress block data, without producing more than the length.
 
-class PacketReciever(object):
-    def __init__(self, conn):
+        :param data: The compressed data.
+        :param length: The length of the uncompressed data.
+        :raise ValueError: When the data decompresses to more than the length, or has data after the compressed stream.
+        :return:
         """
-        Packet receiver.
 
-        :param conn: The socket connection.
+        raise NotImplementedError()
+
+
+class ZlibCompressor(BlockCompressor):
+    def __init__(self, level: int = 1):
         """
+        Compressor using zlib, fast with a fair ratio.
 
-        import socket
+        :param level: The compression level.
+        """
 
-        self.conn: socket.socket = conn
+        super(ZlibCompressor, self).__init__(1, "zlib")
+        self.level: int = level
 
-    def recv(self):
-        length = self.conn.recv(8)
-        data = self.conn.recv(int.from_bytes(length, "big", signed=False))
+    def available(self) -> bool:
+        try:
+            import zlib
+        except ImportError:
+            return False
+        return True
 
-        return PacketDecoder(data).get_decoded()
+    def compress(self, data) -> bytes:
+        import zlib
+        return zlib.compress(data, self.level)
 
-    def __repr__(self):
-        return f"<PacketReciever conn=<{self.conn.__class__.__name__} peername={repr(self.conn.getpeername())}>>"
+    def decompress(self, data, length: int) -> bytes:
+        import zlib
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(data, length)
+        if not decompressor.eof or decompressor.unconsumed_tail or decompressor.unused_data:
+            raise ValueError(f"Compressed block doesn't decompress to {length} bytes")
+        return out
 
 
-class PacketSystem(object):
-    def __init__(self, conn):
+class LzmaCompressor(BlockCompressor):
+    def __init__(self, preset: int = 1):
         """
-        Packet System for communicate with servers / clients
-        Maximum size of a packet is 4294967296 Bytes, 4 Gigabytes. Calculated from the lengthByteSize attribute.
-        
-        **Note:** Don't change the lengthByteSize attribute, if you will change it frequently, That will cause problems
-        with different clients, with different lengthByteSize attributes.
+        Compressor using lzma, slow with a high ratio. For slow connections.
 
-        :param conn: The socket connection.
+        :param preset: The compression preset.
         """
 
-        import socket
+        super(LzmaCompressor, self).__init__(2, "lzma")
+        self.preset: int = preset
 
-        self.conn: socket.socket = conn
-        self.lengthByteSize = 8
+    def available(self) -> bool:
+        try:
+            import lzma
+        except ImportError:
+            return False
+        return True
 
-    def send(self, o):
-        """
-        Send a packet to the connection.
+    def compress(self, data) -> bytes:
+        import lzma
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA2, "preset": self.preset}])
 
-        :param o: The data to send.
-        :return:
-        """
+    def decompress(self, data, length: int) -> bytes:
+        import lzma
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA2}])
+        out = decompressor.decompress(data, length)
+        if not decompressor.eof or decompressor.unused_data:
+            raise ValueError(f"Compressed block doesn't decompress to {length} bytes")
+        return out
 
-        length, data = PacketEncoder(o).get_encoded()
 
-        self.conn.send(length.to_bytes(self.lengthByteSize, "big", signed=False))
-        self.conn.send(data)
+class CompressorRegistry(object):
+    """
+    Registry of block compressors.
+    The receiver of a transfer replies its available compressors, the sender picks one with a CompressionStage.
+    """
 
-    def sendall(self, o):
+    _compressors: Dict[str, BlockCompressor] = {}
+    _ids: Dict[int, BlockCompressor] = {}
+
+    # Order of preference.
+    preference: List[str] = ["zlib", "lzma"]
+
+    @classmethod
+    def register(cls, compressor: BlockCompressor, preference: int = None):
         """
-        Send a packet to all connected clients.
+        Register a compressor.
 
-        :param o:
+        :param compressor: The compressor to register.
+        :param preference: Index in the order of preference, appended to the end when None.
         :return:
         """
 
-        if not issubclass(type(self.conn), socketserver.BaseRequestHandler):
-            raise Exception(f"the conn argument and attribute of {self.__class__.__name__}() "
-                            f"must be a subclass of socketserver.BaseRequestHandler")
+        if compressor.id in cls._ids and cls._ids[compressor.id].name != compressor.name:
+            raise ValueError(f"Duplicate compressor id: {compressor.id}")
+        cls._compressors[compressor.name] = compressor
+        cls._ids[compressor.id] = compressor
+        if compressor.name not in cls.preference:
+            if preference is None:
+                cls.preference.append(compressor.name)
+            else:
+                cls.preference.insert(preference, compressor.name)
 
-        length, data = PacketEncoder(o).get_encoded()
+    @classmethod
+    def get(cls, name: str) -> BlockCompressor:
+        return cls._compressors[name]
 
-        self.conn.sendall(length.to_bytes(self.lengthByteSize, "big", signed=False))
-        self.conn.sendall(data)
+    @classmethod
+    def get_by_id(cls, id_: int) -> BlockCompressor:
+        try:
+            return cls._ids[id_]
+        except KeyError:
+            raise ValueError(f"Unknown compressor id: {id_}")
 
-    def recv(self):
+    @classmethod
+    def available(cls) -> List[str]:
         """
-        Recieve a packet from the socket.
+        Returns the names of the available compressors, in order of preference.
 
         :return:
         """
 
-        length = self.conn.recv(self.lengthByteSize)
-        data = self.conn.recv(int.from_bytes(length, "big", signed=False))
-
-        return PacketDecoder(data).get_decoded()
+        return [name for name in cls.preference if name in cls._compressors and cls._compressors[name].available()]
 
+    @classmethod
+    def negotiate(cls, offered: List[str], preferred: str = None) -> Optional[str]:
+        """
+        Returns the compressor to use for a transfer.
 
-class CryptedPacketSystem(PacketSystem):
-    def __init__(self, conn):
+        :param offered: The compressor names offered by the receiver.
+        :param preferred: The preferred compressor, the first common compressor is used when None.
+        :return: The compressor name, or None if there's no common compressor.
         """
-        Crypted Packet System for communicate with servers / clients using the ARC4 encryption algorithm.
-        Maximum size of a packet is 4294967296 Bytes, 4 Gigabytes. Calculated from the lengthByteSize attribute.
 
-        **Note:** Don't change the lengthByteSize attribute, if you will change it frequently, That will cause problems
-        with different clients, with different lengthByteSize attributes.
+        common = [name for name in cls.available() if name in offered]
+        if preferred is not None:
+            return preferred if preferred in common else None
+        return common[0] if common else None
 
-        :param conn: The socket connection.
-        """
 
-        super(CryptedPacketSystem, self).__init__(conn)
+CompressorRegistry.register(ZlibCompressor())
+CompressorRegistry.register(LzmaCompressor())
 
-    @staticmethod
-    def _encrypt(b, key):
-        """
-        Encryption for packets
 
-        :param b:
-        :param key:
-        :return:
+class CompressionStage(object):
+    def __init__(self, compressor: str, sample_blocks: int = 8, min_saving: float = 0.1, probe_interval: int = 64):
+        """
+        Compression stage of a transfer, compresses the blocks given to PacketSystem.send_block(...).
+        The first blocks are a sample: when they don't save at least min_saving of their size, like already compressed
+        files, blocks are sent uncompressed. One block per probe interval is still compressed, to pick it up again when
+        the data changes. While compressing, the saving of the blocks since the last check is checked every probe
+        interval, to stop again when the data changes. A block that doesn't get smaller is always sent uncompressed.
+
+        :param compressor: The name of the compressor.
+        :param sample_blocks: The amount of blocks to sample.
+        :param min_saving: The minimal saving of the sample, from 0 to 1.
+        :param probe_interval: The amount of blocks between two probes while skipping.
         """
 
-        # noinspection PyPackageRequirements
-        from Crypto.Cipher import ARC4
+        self.compressor: BlockCompressor = CompressorRegistry.get(compressor)
+        self.sampleBlocks: int = sample_blocks
+        self.minSaving: float = min_saving
+        self.probeInterval: int = probe_interval
 
-        obj = ARC4.new(key.encode())
-        return obj.encrypt(b)
+        # Total input and output bytes, and seconds spent compressing.
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.compressTime = 0.0
+        self._started: Optional[float] = None
 
-    @staticmethod
-    def _decrypt(b, key):
+        self._lock = Lock()
+        self.restart()
 
-        # noinspection PyPackageRequirements
-        from Crypto.Cipher import ARC4
+    def restart(self):
+        """
+        Restarts the sampling, for the next file of a transfer. The totals are kept.
+
+        :return:
+        """
+
+        with self._lock:
+            self.skipping = False
+            self._blocks = 0
+            self._sampleIn = 0
+            self._sampleOut = 0
+
+    def process(self, data) -> Tuple[int, Any]:
+        """
+        Compresses block data if the stage isn't skipping.
+
+        :param data: The bytes-like block data.
+        :return: The compressor flag bits and the data to send.
+        """
+
+        with self._lock:
+            if self._started is None:
+                self._started = perf_counter()
+            self._blocks += 1
+            compress = not self.skipping or self._blocks % self.probeInterval == 0
+
+        out = data
+        elapsed = 0.0
+        if compress and len(data):
+            start = perf_counter()
+            compressed = self.compressor.compress(data)
+            elapsed = perf_counter() - start
+            if len(compressed) < len(data):
+                out = compressed
+
+        with self._lock:
+            self.bytesIn += len(data)
+            self.bytesOut += len(out)
+            self.compressTime += elapsed
+            if compress:
+                self._sampleIn += len(data)
+                self._sampleOut += len(out)
+                if self.skipping and self._blocks > self.sampleBlocks:
+                    # Probe: continue compressing when the block saves enough.
+                    self.skipping = len(out) > len(data) * (1 - self.minSaving)
+                    self._sampleIn = self._sampleOut = 0
+                elif self._blocks == self.sampleBlocks or \
+                        (self._blocks > self.sampleBlocks and self._blocks % self.probeInterval == 0):
+                    # The sample, or the blocks compressed since the last check.
+                    self.skipping = self._sampleOut > self._sampleIn * (1 - self.minSaving)
+                    self._sampleIn = self._sampleOut = 0
+
+        if out is data:
+            return 0, data
+        return self.compressor.id << DataBlock.COMPRESSOR_SHIFT, out
+
+    @property
+    def ratio(self) -> float:
+        """
+        The compressed size as part of the original size.
+        """
+
+        return self.bytesOut / self.bytesIn if self.bytesIn else 1.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        The effective throughput, original bytes per second since the first block.
+        """
+
+        if self._started is None:
+            return 0.0
+        return self.bytesIn / max(perf_counter() - self._started, 1e-9)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} compressor={self.compressor.name} ratio={self.ratio:.2f} " \
+               f"skipping={self.skipping}>"
+
+
+class DataBlock(object):
+    HEADER = struct.Struct(">16sQIB")
+
+    LAST_BLOCK = 0x01
+
+    # Bits 1 to 3 of the flags hold the compressor id of compressed blocks.
+    COMPRESSOR_MASK = 0x0E
+    COMPRESSOR_SHIFT = 1
+
+    # A block of zeros, sent without data so sparse files stay sparse. The length is the amount of zeros.
+    ZERO_BLOCK = 0x10
+
+    # Compressed blocks don't decompress to more than a frame can hold.
+    MAX_DECOMPRESSED = 256 * 1024 * 1024
+
+    def __init__(self, transfer_id: UUID, offset: int, data, flags: int = 0, length: int = None):
+        """
+        Raw file-data block, sent as a binary frame without a serializer.
+        The frame body is a fixed header (transfer id, offset, length, flags) followed by the raw bytes.
+
+        **Note:** A received block's data is a memoryview into the receive buffer of the packet system, it's only valid
+        until the next packet is received.
+
+        :param transfer_id: The UUID of the transfer.
+        :param offset: The offset of the block in the file.
+        :param data: The raw bytes of the block.
+        :param flags: The block flags, like DataBlock.LAST_BLOCK.
+        :param length: The length of the block, defaults to the length of the data. For compressed blocks it's the
+                       uncompressed length.
+        """
+
+        self.transferId: UUID = transfer_id
+        self.offset: int = offset
+        self.data = data
+        self.flags: int = flags
+        self.length: int = len(data) if length is None else length
+
+    @property
+    def last_block(self) -> bool:
+        return bool(self.flags & DataBlock.LAST_BLOCK)
+
+    @property
+    def zero_block(self) -> bool:
+        return bool(self.flags & DataBlock.ZERO_BLOCK)
+
+    def pack_header(self) -> bytes:
+        return DataBlock.HEADER.pack(self.transferId.bytes, self.offset, self.length, self.flags)
+
+    @classmethod
+    def from_frame(cls, view: memoryview) -> 'DataBlock':
+        """
+        Parses a data block from a raw frame body.
+
+        :param view: The frame body.
+        :return: The data block.
+        """
+
+        transfer_id, offset, length, flags = DataBlock.HEADER.unpack_from(view)
+        data = view[DataBlock.HEADER.size:]
+        if flags & DataBlock.COMPRESSOR_MASK:
+            compressor = CompressorRegistry.get_by_id((flags & DataBlock.COMPRESSOR_MASK) >> DataBlock.COMPRESSOR_SHIFT)
+            if length > DataBlock.MAX_DECOMPRESSED:
+                raise ValueError(f"Compressed block of {length} bytes, the maximum is {DataBlock.MAX_DECOMPRESSED}")
+            data = compressor.decompress(data, length)
+            if len(data) != length:
+                raise ValueError(f"Decompressed block has {len(data)} bytes instead of {length}")
+        return cls(UUID(bytes=transfer_id), offset, data, flags, length)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} transfer_id={self.transferId} offset={self.offset} " \
+               f"length={self.length} flags={self.flags}>"
+
+
+class FrameReader(object):
+    def __init__(self, conn, len_bytesize=8):
+        """
+        Length-exact frame reader.
+        Reads the length header and then the frame body with recv_into(...), looping until the frame is complete.
+        The body is read into a preallocated buffer that is reused for the next frames, so the memoryview returned by
+        #read_frame() is only valid until the next call.
+
+        :param conn: The socket connection.
+        :param len_bytesize: The byte size of the length header.
+        """
+
+        import socket
+
+        self.conn: socket.socket = conn
+        self.lengthByteSize = len_bytesize
+
+        # Frames bigger than this are read into a one-off buffer, so one huge block doesn't stay allocated.
+        self.maxRetainedSize = 16 * 1024 * 1024
+        # The length header comes from the peer, bigger frames fail the connection instead of being allocated.
+        self.maxFrameSize = 256 * 1024 * 1024
+
+        self._header = bytearray(len_bytesize)
+        self._buffer = bytearray(64 * 1024)
+
+    def recv_into(self, view: memoryview):
+        """
+        Fill the given memoryview completely with data from the socket.
+
+        :param view: The memoryview to fill.
+        :raises ConnectionError: If the connection was closed before the view was filled.
+        :return:
+        """
+
+        received = 0
+        total = len(view)
+        while received < total:
+            size = self.conn.recv_into(view[received:], total - received)
+            if size == 0:
+                raise ConnectionError(f"Connection closed after {received} of {total} bytes of a frame")
+            received += size
+
+    def read_length(self) -> int:
+        """
+        Read the length header of the next frame.
+
+        :return: The length of the frame body.
+        """
+
+        self.recv_into(memoryview(self._header))
+        return int.from_bytes(self._header, "big", signed=False)
+
+    def read_body(self, length: int) -> memoryview:
+        """
+        Read a frame body of the given length.
+
+        :param length: The length of the frame body.
+        :raises ConnectionError: If the frame is bigger than the maximum frame size.
+        :return: A memoryview of the frame body, only valid until the next read.
+        """
+
+        if length > self.maxFrameSize:
+            raise ConnectionError(f"The peer sent a frame of {length} bytes, the maximum is {self.maxFrameSize}")
+        if length > self.maxRetainedSize:
+            buffer = bytearray(length)
+        else:
+            if length > len(self._buffer):
+                self._buffer = bytearray(max(length, len(self._buffer) * 2))
+            buffer = self._buffer
+
+        view = memoryview(buffer)[:length]
+        self.recv_into(view)
+        return view
+
+    def read_frame(self) -> memoryview:
+        """
+        Read a complete frame.
+
+        :return: A memoryview of the frame body, only valid until the next read.
+        """
+
+        return self.read_body(self.read_length())
+
+
+class FrameWriter(object):
+    def __init__(self, conn, len_bytesize=8):
+        """
+        Frame writer.
+        Writes the length header and the frame body with one socket.sendmsg(...) call, and retries on partial writes.
+        Falls back to socket.sendall(...) on platforms without sendmsg (Windows).
+
+        :param conn: The socket connection.
+        :param len_bytesize: The byte size of the length header.
+        """
+
+        import socket
+        import threading
+
+        self.conn: socket.socket = conn
+        self.lengthByteSize = len_bytesize
+
+        # Small frames are joined on platforms without sendmsg, so they still go out in one call.
+        self.joinLimit = 64 * 1024
+
+        self._lock = threading.Lock()
+
+    def _sendmsg(self, buffers: list):
+        views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+        while views:
+            sent = self.conn.sendmsg(views)
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views[0])
+                    del views[0]
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+
+    def _sendall(self, buffers: list):
+        if sum(len(buffer) for buffer in buffers) <= self.joinLimit:
+            self.conn.sendall(b"".join(buffers))
+            return
+        for buffer in buffers:
+            self.conn.sendall(buffer)
+
+    def write_frame(self, *parts, flags=0):
+        """
+        Write a frame, the body is the concatenation of the given parts.
+
+        :param parts: The bytes-like parts of the frame body.
+        :param flags: Frame flags, or-ed into the high bits of the length header.
+        :return:
+        """
+
+        length = sum(len(part) for part in parts)
+        buffers = [(length | flags).to_bytes(self.lengthByteSize, "big", signed=False), *parts]
+
+        with self._lock:
+            self._write(buffers)
+
+    def _write(self, buffers: list):
+        if hasattr(self.conn, "sendmsg"):
+            self._sendmsg(buffers)
+        else:
+            self._sendall(buffers)
+
+    def write_file_frame(self, head, file, offset: int, count: int, flags=0):
+        """
+        Write a frame, the body is the head followed by a range of a file sent with socket.sendfile(...).
+        On Linux the file data goes from the page cache to the socket without being copied into Python.
+
+        :param head: The bytes-like start of the frame body.
+        :param file: The file, opened in binary mode.
+        :param offset: The offset of the range in the file.
+        :param count: The length of the range.
+        :param flags: Frame flags, or-ed into the high bits of the length header.
+        :raises EOFError: If the file ended before the range, the connection is shut down then.
+        :return:
+        """
+
+        import socket
+
+        length = len(head) + count
+        with self._lock:
+            self.conn.sendall(b"".join([(length | flags).to_bytes(self.lengthByteSize, "big", signed=False), head]))
+            sent = self.conn.sendfile(file, offset, count) if count else 0
+            if sent != count:
+                # The header promised the whole range, the peer would read the next frames as the rest of it.
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise EOFError(f"File ended after {sent} of {count} bytes of a frame")
+
+
+def hkdf_sha256(key: bytes, salt: bytes, info: bytes, length: int = 32) -> bytes:
+    """
+    HKDF with SHA-256 (RFC 5869), derives keys from a shared secret.
+
+    :param key: The input key material.
+    :param salt: The salt, may be empty.
+    :param info: The context of the derived key, different contexts give independent keys.
+    :param length: The length of the derived key.
+    :return: The derived key.
+    """
+
+    import hashlib
+    import hmac
+
+    prk = hmac.new(salt or bytes(32), key, hashlib.sha256).digest()
+    okm = b""
+    block = b""
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+class FrameCipher(object):
+    TAG_SIZE = 16
+
+    def __init__(self, key: bytes, nonce_prefix: bytes):
+        """
+        AES-GCM cipher for the frames of one direction of a connection.
+        The nonce is the 4-byte prefix followed by a 64-bit frame counter, so it's never sent and never repeats for the
+        key. Frames are encrypted and decrypted into a buffer that is reused for the next frames, so the memoryviews
+        returned by #seal() and #open() are only valid until the next call. Uses the cryptography package, or
+        pycryptodome otherwise.
+
+        :param key: The 256-bit key.
+        :param nonce_prefix: The 4-byte nonce prefix.
+        """
+
+        self.noncePrefix: bytes = nonce_prefix
+        self.counter: int = 0
+
+        # Frames bigger than this are processed in a one-off buffer, so one huge block doesn't stay allocated.
+        self.maxRetainedSize = 16 * 1024 * 1024
+
+        self._buffer = bytearray(64 * 1024)
+        try:
+            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+            self._cipher = Cipher
+            self._modes = modes
+            self._algorithm = algorithms.AES(key)
+            self._aes = None
+        except ImportError:
+            # noinspection PyPackageRequirements
+            from Crypto.Cipher import AES
+            self._aes = AES
+            self._key = key
+
+    @staticmethod
+    def available() -> bool:
+        """
+        Checks if an AES-GCM implementation can be imported.
+
+        :return:
+        """
+
+        try:
+            from cryptography.hazmat.primitives.ciphers import Cipher
+        except ImportError:
+            try:
+                # noinspection PyPackageRequirements
+                from Crypto.Cipher import AES
+            except ImportError:
+                return False
+        return True
+
+    def _next_nonce(self) -> bytes:
+        nonce = self.noncePrefix + self.counter.to_bytes(8, "big", signed=False)
+        self.counter += 1
+        return nonce
+
+    def _output(self, size: int) -> memoryview:
+        # Room for the block size of AES, the cryptography package needs it for update_into(...).
+        size += 16
+        if size > self.maxRetainedSize:
+            return memoryview(bytearray(size))
+        if size > len(self._buffer):
+            self._buffer = bytearray(max(size, len(self._buffer) * 2))
+        return memoryview(self._buffer)
+
+    def seal(self, parts: list, aad: bytes) -> memoryview:
+        """
+        Encrypt the next frame.
+
+        :param parts: The bytes-like parts of the frame body.
+        :param aad: The authenticated, unencrypted data, like the length header.
+        :return: The encrypted body followed by the tag, only valid until the next call.
+        """
+
+        nonce = self._next_nonce()
+        length = sum(len(part) for part in parts)
+        out = self._output(length + self.TAG_SIZE)
+        position = 0
+        if self._aes is None:
+            encryptor = self._cipher(self._algorithm, self._modes.GCM(nonce)).encryptor()
+            encryptor.authenticate_additional_data(aad)
+            for part in parts:
+                position += encryptor.update_into(part, out[position:])
+            encryptor.finalize()
+            tag = encryptor.tag
+        else:
+            cipher = self._aes.new(self._key, self._aes.MODE_GCM, nonce=nonce, mac_len=self.TAG_SIZE)
+            cipher.update(aad)
+            for part in parts:
+                cipher.encrypt(part, output=out[position:position + len(part)])
+                position += len(part)
+            tag = cipher.digest()
+        out[position:position + self.TAG_SIZE] = tag
+        return out[:position + self.TAG_SIZE]
+
+    def open(self, data: memoryview, aad: bytes) -> memoryview:
+        """
+        Decrypt the next frame.
+
+        :param data: The encrypted body followed by the tag.
+        :param aad: The authenticated, unencrypted data, like the length header.
+        :raises ConnectionError: If the frame was changed, or frames were lost or reordered.
+        :return: The frame body, only valid until the next call.
+        """
+
+        nonce = self._next_nonce()
+        length = len(data) - self.TAG_SIZE
+        if length < 0:
+            raise ConnectionError("Frame is shorter than its tag")
+        encrypted, tag = data[:length], bytes(data[length:])
+        out = self._output(length)
+        try:
+            if self._aes is None:
+                decryptor = self._cipher(self._algorithm, self._modes.GCM(nonce, tag)).decryptor()
+                decryptor.authenticate_additional_data(aad)
+                decryptor.update_into(encrypted, out)
+                decryptor.finalize()
+            else:
+                cipher = self._aes.new(self._key, self._aes.MODE_GCM, nonce=nonce, mac_len=self.TAG_SIZE)
+                cipher.update(aad)
+                cipher.decrypt(encrypted, output=out[:length])
+                cipher.verify(tag)
+        except Exception:
+            raise ConnectionError("Frame authentication failed") from None
+        return out[:length]
+
+
+class SessionKey(object):
+    def __init__(self, master: bytes, is_server: bool):
+        """
+        Session key of a connection, derived once in the handshake of Server.run() and Client.run().
+        Both directions get their own key and nonce prefix, the ciphers are shared by all packet systems of the
+        connection, so the frame counters continue where the previous packet system stopped.
+
+        :param master: The 256-bit master key of the session.
+        :param is_server: True on the server side of the connection.
+        """
+
+        self.master: bytes = master
+        self.isServer: bool = is_server
+
+        local, remote = ("server", "client") if is_server else ("client", "server")
+        self.sendCipher: FrameCipher = self._cipher(local)
+        self.recvCipher: FrameCipher = self._cipher(remote)
+
+    def _cipher(self, sender: str) -> FrameCipher:
+        return FrameCipher(hkdf_sha256(self.master, b"", f"{sender} key".encode()),
+                           hkdf_sha256(self.master, b"", f"{sender} nonce".encode(), 4))
+
+    @classmethod
+    def from_secret(cls, secret: int, salt: bytes, is_server: bool) -> 'SessionKey':
+        """
+        Derive the session key from the Diffie-Hellman secret.
+
+        :param secret: The shared secret of the key exchange.
+        :param salt: The random salts of both sides, so every session gets new keys.
+        :param is_server: True on the server side of the connection.
+        :return:
+        """
+
+        secret_bytes = secret.to_bytes(max(1, (secret.bit_length() + 7) // 8), "big", signed=False)
+        return cls(hkdf_sha256(secret_bytes, salt, b"advUtils session"), is_server)
+
+    def derive(self, label: str) -> 'SessionKey':
+        """
+        Derive the session key of an extra data stream of the connection.
+
+        :param label: The label of the stream, never used twice within the session.
+        :return:
+        """
+
+        return SessionKey(hkdf_sha256(self.master, b"", f"stream {label}".encode()), self.isServer)
+
+
+class CryptedFrameReader(FrameReader):
+    def __init__(self, conn, cipher: FrameCipher, len_bytesize=8):
+        """
+        Frame reader for encrypted frames. The length header holds the length of the decrypted body and is
+        authenticated with it, the tag follows the encrypted body.
+
+        :param conn: The socket connection.
+        :param cipher: The cipher of the receiving direction.
+        :param len_bytesize: The byte size of the length header.
+        """
+
+        super(CryptedFrameReader, self).__init__(conn, len_bytesize)
+        self.cipher: FrameCipher = cipher
+
+    def read_body(self, length: int) -> memoryview:
+        header = bytes(self._header)
+        return self.cipher.open(super(CryptedFrameReader, self).read_body(length + FrameCipher.TAG_SIZE), header)
+
+
+class CryptedFrameWriter(FrameWriter):
+    def __init__(self, conn, cipher: FrameCipher, len_bytesize=8):
+        """
+        Frame writer for encrypted frames. Frames are encrypted under the write lock, so the frame counter matches the
+        order on the wire.
+
+        :param conn: The socket connection.
+        :param cipher: The cipher of the sending direction.
+        :param len_bytesize: The byte size of the length header.
+        """
+
+        super(CryptedFrameWriter, self).__init__(conn, len_bytesize)
+        self.cipher: FrameCipher = cipher
+
+    def write_frame(self, *parts, flags=0):
+        length = sum(len(part) for part in parts)
+        header = (length | flags).to_bytes(self.lengthByteSize, "big", signed=False)
+
+        with self._lock:
+            self._write([header, self.cipher.seal(parts, header)])
+
+    def write_file_frame(self, head, file, offset: int, count: int, flags=0):
+        # The data has to pass through the cipher, so it's read instead of sent with sendfile(...). A file that ended
+        # before the range fails before the frame is written, the connection stays usable.
+        import os
+
+        if hasattr(os, "pread"):
+            data = os.pread(file.fileno(), count, offset)
+        else:
+            file.seek(offset)
+            data = file.read(count)
+        if len(data) != count:
+            raise EOFError(f"File ended after {len(data)} of {count} bytes of a frame")
+        self.write_frame(head, data, flags=flags)
+
+
+class PacketSender(object):
+    def __init__(self, conn, data, len_bytesize=8):
+        self.lengthByteSize = len_bytesize
+        self._length, self._data = PacketEncoder(data).get_encoded()
+
+        import socket
+        import socketserver
+
+        self.conn: Union[socket.socket, socketserver.BaseRequestHandler] = conn
+
+    def send(self):
+        FrameWriter(self.conn, self.lengthByteSize).write_frame(self._data)
+
+    def sendall(self):
+        if not issubclass(type(self.conn), socketserver.BaseRequestHandler):
+            raise Exception(f"the conn argument and attribute of {self.__class__.__name__}() "
+                            f"must be a subclass of socketserver.BaseRequestHandler")
+
+        self.conn.sendall(self._length.to_bytes(self.lengthByteSize, "big", signed=False))
+        self.conn.sendall(self._data)
+
+    def __repr__(self):
+        if self.lengthByteSize == 8:
+            return f"<{self.__class__.__name__} data={repr(self._data)}>"
+        else:
+            return f"<{self.__class__.__name__} data={repr(self._data)} len_bytesize={repr(self.lengthByteSize)}>"
+
+
+class PacketReciever(object):
+    def __init__(self, conn):
+        """
+        Packet receiver.
+
+        :param conn: The socket connection.
+        """
+
+        import socket
+
+        self.conn: socket.socket = conn
+        self._reader = FrameReader(conn, 8)
+
+    def recv(self):
+        length = self._reader.read_length()
+        if length & RAW_FRAME:
+            return DataBlock.from_frame(self._reader.read_body(length & ~RAW_FRAME))
+        data = self._reader.read_body(length)
+
+        return PacketDecoder(data).get_decoded()
+
+    def __repr__(self):
+        return f"<PacketReciever conn=<{self.conn.__class__.__name__} peername={repr(self.conn.getpeername())}>>"
+
+
+class PacketSystem(object):
+    def __init__(self, conn):
+        """
+        Packet System for communicate with servers / clients
+        Maximum size of a packet is 4294967296 Bytes, 4 Gigabytes. Calculated from the lengthByteSize attribute.
+        
+        **Note:** Don't change the lengthByteSize attribute, if you will change it frequently, That will cause problems
+        with different clients, with different lengthByteSize attributes.
+
+        :param conn: The socket connection.
+        """
+
+        import socket
+
+        self.conn: socket.socket = conn
+        self.lengthByteSize = 8
+
+        self._reader = FrameReader(conn, self.lengthByteSize)
+        self._writer = FrameWriter(conn, self.lengthByteSize)
+
+        # The codecs for encoding packets, in order of preference. Set to the negotiated codecs of the connection.
+        self.codecs: List[str] = list(DEFAULT_CODECS)
+
+        # Time of the last received frame, heartbeats included, for detecting dead connections.
+        self.lastReceived: float = monotonic()
+
+    def send(self, o):
+        """
+        Send a packet to the connection.
+
+        :param o: The data to send.
+        :return:
+        """
+
+        self._writer.write_frame(*PacketEncoder(o, self.codecs).get_parts())
+
+    def sendall(self, o):
+        """
+        Send a packet to all connected clients.
+
+        :param o:
+        :return:
+        """
+
+        if not issubclass(type(self.conn), socketserver.BaseRequestHandler):
+            raise Exception(f"the conn argument and attribute of {self.__class__.__name__}() "
+                            f"must be a subclass of socketserver.BaseRequestHandler")
+
+        length, data = PacketEncoder(o, self.codecs).get_encoded()
+
+        self.conn.sendall(length.to_bytes(self.lengthByteSize, "big", signed=False))
+        self.conn.sendall(data)
+
+    def send_block(self, transfer_id: UUID, offset: int, data, flags: int = 0, compression: CompressionStage = None):
+        """
+        Send a raw file-data block, the data is written to the socket as-is without a serializer.
+
+        :param transfer_id: The UUID of the transfer.
+        :param offset: The offset of the block in the file.
+        :param data: The bytes-like data of the block.
+        :param flags: The block flags, like DataBlock.LAST_BLOCK. With DataBlock.ZERO_BLOCK only the length of the data is
+                      sent.
+        :param compression: The compression stage of the transfer, the data is sent uncompressed when None.
+        :return:
+        """
+
+        length = len(data)
+        if flags & DataBlock.ZERO_BLOCK:
+            data = b""
+        elif compression is not None:
+            bits, data = compression.process(data)
+            flags |= bits
+        block = DataBlock(transfer_id, offset, data, flags, length)
+        self._writer.write_frame(block.pack_header(), data, flags=RAW_FRAME)
+
+    def send_file_block(self, transfer_id: UUID, file, offset: int, length: int, flags: int = 0):
+        """
+        Send a raw file-data block straight from a file, without reading the data into Python. The receiver gets the
+        same frame as from send_block(...).
+
+        :param transfer_id: The UUID of the transfer.
+        :param file: The file, opened in binary mode.
+        :param offset: The offset of the block in the file.
+        :param length: The length of the block.
+        :param flags: The block flags, like DataBlock.LAST_BLOCK.
+        :raises EOFError: If the file ended before the block, the connection is shut down then.
+        :return:
+        """
+
+        block = DataBlock(transfer_id, offset, b"", flags, length)
+        self._writer.write_file_frame(block.pack_header(), file, offset, length, flags=RAW_FRAME)
+
+    def ping(self):
+        """
+        Send a heartbeat, the other side answers it when it receives the next packet.
+
+        :return:
+        """
+
+        self._writer.write_frame(PING, flags=CONTROL_FRAME)
+
+    def send_frame(self, *parts, flags: int = 0):
+        """
+        Send a frame without encoding, for layers on top of the packet system like the Multiplexer class.
+
+        :param parts: The bytes-like parts of the frame body.
+        :param flags: The frame flags, like RAW_FRAME.
+        :return:
+        """
+
+        self._writer.write_frame(*parts, flags=flags)
+
+    def recv_frame(self) -> Tuple[int, memoryview]:
+        """
+        Recieve a frame without decoding it. Heartbeats are answered and skipped.
+
+        :return: The frame flags and the frame body, the body is only valid until the next frame is received.
+        """
+
+        length = self._reader.read_length()
+        self.lastReceived = monotonic()
+        while length & CONTROL_FRAME:
+            if bytes(self._reader.read_body(length & ~CONTROL_FRAME)) == PING:
+                self._writer.write_frame(PONG, flags=CONTROL_FRAME)
+            length = self._reader.read_length()
+            self.lastReceived = monotonic()
+
+        return length & RAW_FRAME, self._reader.read_body(length & ~RAW_FRAME)
+
+    def recv(self):
+        """
+        Recieve a packet from the socket. Heartbeats are answered and skipped.
+
+        :return: The decoded packet, or a DataBlock instance for raw data frames.
+        """
+
+        flags, data = self.recv_frame()
+        if flags & RAW_FRAME:
+            return DataBlock.from_frame(data)
+
+        return PacketDecoder(data).get_decoded()
+
+
+class CryptedPacketSystem(PacketSystem):
+    def __init__(self, conn, key: SessionKey):
+        """
+        Crypted Packet System for communicate with servers / clients, every frame is encrypted and authenticated with
+        AES-GCM. Packets and raw data blocks are sent and received like with the PacketSystem class.
+
+        **Note:** Create one crypted packet system per connection and keep using it, the frame counters of both sides
+        must stay in step.
+
+        :param conn: The socket connection.
+        :param key: The session key of the connection.
+        """
+
+        super(CryptedPacketSystem, self).__init__(conn)
+
+        self.key: SessionKey = key
+        self._reader = CryptedFrameReader(conn, key.recvCipher, self.lengthByteSize)
+        self._writer = CryptedFrameWriter(conn, key.sendCipher, self.lengthByteSize)
+
+    def sendall(self, o):
+        """
+        Send a packet, like send(...). The packet goes through the cipher, unencrypted frames can't be mixed in.
+
+        :param o: The data to send.
+        :return:
+        """
+
+        self.send(o)
+
+
+class _MuxMessage(object):
+    def __init__(self, parts: list, block: bool):
+        """
+        Message of a multiplexed stream, a packet or a raw data block. The writer thread of the multiplexer takes it
+        fragment by fragment, the sender waits until it's written.
+
+        :param parts: The bytes-like parts of the message.
+        :param block: True for a raw data block.
+        """
+
+        self.parts = deque(memoryview(part).cast("B") for part in parts if len(part))
+        self.size: int = sum(len(part) for part in self.parts)
+        self.remaining: int = self.size
+        self.block: bool = block
+        self.done = Event()
+        self.error: Optional[Exception] = None
+
+    def take(self, size: int) -> list:
+        """
+        Take the next fragment of the message.
+
+        :param size: The size of the fragment, at most the remaining size.
+        :return: The parts of the fragment.
+        """
+
+        parts = []
+        self.remaining -= size
+        while size:
+            part = self.parts[0]
+            if len(part) <= size:
+                parts.append(self.parts.popleft())
+                size -= len(part)
+            else:
+                parts.append(part[:size])
+                self.parts[0] = part[size:]
+                size = 0
+        return parts
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.done.set()
+
+
+class MuxStream(object):
+    def __init__(self, mux: 'Multiplexer', stream_id: int):
+        """
+        Stream of a multiplexed connection, sends and receives packets and raw data blocks like the PacketSystem class.
+        Streams are created with Multiplexer.open() and Multiplexer.accept().
+        Sending blocks until the data is written to the socket, and while the stream has no window left.
+
+        **Note:** A received block's data is a memoryview into a receive buffer of the stream, like with the
+        PacketSystem class it's only valid until the next packet is received from the stream.
+
+        :param mux: The multiplexer of the connection.
+        :param stream_id: The id of the stream.
+        """
+
+        self.mux: Multiplexer = mux
+        self.id: int = stream_id
+        self.conn = mux.pak.conn
+
+        # Closed on this side, and closed by the peer.
+        self.closed = False
+        self.remoteClosed = False
+
+        # Bytes the peer granted this side to send, and the messages waiting for the writer thread.
+        self._credit: int = mux.window
+        self._outbox = deque()
+        self._scheduled = False
+        # Set while the sender writes a fragment of the stream itself, the writer thread leaves the stream alone then.
+        self._writing = False
+
+        # Received messages as (block, data, held bytes), and the message being received with its received size.
+        self._inbox: Queue = Queue()
+        self._waiting = 0
+        self._partial: Optional[memoryview] = None
+        self._partialSize = 0
+        self._partialHeld = 0
+        # Receive buffers, the buffer of the last received message is reused after the next recv().
+        self._buffers: List[bytearray] = []
+        self._current: Optional[bytearray] = None
+        # Received bytes that aren't granted back to the peer yet, and the part of them that is consumed.
+        self._unacked = 0
+        self._consumed = 0
+        self._reason: Optional[str] = None
+
+    @property
+    def codecs(self) -> List[str]:
+        return self.mux.pak.codecs
+
+    @property
+    def lastReceived(self) -> float:
+        return self.mux.pak.lastReceived
+
+    def send(self, o):
+        """
+        Send a packet over the stream.
+
+        :param o: The data to send.
+        :return:
+        """
+
+        self.mux._send(self, _MuxMessage(PacketEncoder(o, self.codecs).get_parts(), False))
+
+    def send_block(self, transfer_id: UUID, offset: int, data, flags: int = 0, compression: CompressionStage = None):
+        """
+        Send a raw file-data block over the stream, see PacketSystem.send_block(...).
+
+        :param transfer_id: The UUID of the transfer.
+        :param offset: The offset of the block in the file.
+        :param data: The bytes-like data of the block.
+        :param flags: The block flags, like DataBlock.LAST_BLOCK. With DataBlock.ZERO_BLOCK only the length of the data is
+                      sent.
+        :param compression: The compression stage of the transfer, the data is sent uncompressed when None.
+        :return:
+        """
+
+        length = len(data)
+        if flags & DataBlock.ZERO_BLOCK:
+            data = b""
+        elif compression is not None:
+            bits, data = compression.process(data)
+            flags |= bits
+        block = DataBlock(transfer_id, offset, data, flags, length)
+        self.mux._send(self, _MuxMessage([block.pack_header(), data], True))
+
+    def ping(self):
+        """
+        Send a heartbeat over the connection of the stream.
+
+        :return:
+        """
+
+        self.mux.pak.ping()
+
+    def recv(self):
+        """
+        Recieve a packet from the stream.
+
+        :raises ConnectionError: If the stream or the connection is closed.
+        :return: The decoded packet, or a DataBlock instance for raw data blocks.
+        """
+
+        item = self._inbox.get()
+        if item is None:
+            self._inbox.put(None)
+            raise ConnectionError(self._reason)
+        block, data, held = item
+        self.mux._consume(self, data.obj, held)
+        if block:
+            return DataBlock.from_frame(data)
+
+        return PacketDecoder(data).get_decoded()
+
+    def close(self):
+        """
+        Close the stream, the peer receives a ConnectionError after the packets that were sent before.
+        Packets that are still waiting for the window aren't sent.
+
+        :return:
+        """
+
+        self.mux._close(self)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} id={self.id} closed={self.closed} remoteClosed={self.remoteClosed}>"
+
+
+class Multiplexer(object):
+    HEADER = struct.Struct(">IB")
+
+    # Frame types, in the low bits of the type byte.
+    OPEN = 1
+    DATA = 2
+    WINDOW = 3
+    CLOSE = 4
+    TYPE_MASK = 0x0F
+
+    # Flags of data frames, for the last fragment of a message and for messages that are raw data blocks. The first
+    # fragment of a message starts with the size of the message, so the receiver fills one buffer.
+    FINAL = 0x80
+    BLOCK = 0x40
+    FIRST = 0x20
+    SIZE = struct.Struct(">Q")
+
+    # Receive buffers bigger than this aren't reused, like FrameReader.maxRetainedSize, and the buffers kept per stream.
+    maxRetainedSize = 16 * 1024 * 1024
+    retainedBuffers = 4
+
+    # Messages can be bigger than the window, but not bigger than this. The peer's size of a message is allocated up
+    # front, a bigger size fails the connection.
+    maxMessageSize = 256 * 1024 * 1024
+
+    CONTROL_STREAM = 0
+
+    def __init__(self, pak: PacketSystem, is_server: bool, *, window: int = 4 * 1024 * 1024, fragment_size: int = 64 * 1024,
+                 bulk_fragment_size: int = 2 * 1024 * 1024):
+        """
+        Multiplexer, runs streams over one connection, so transfers and control packets share the connection without
+        waiting for each other.
+        Every frame starts with the id of its stream. Messages are sent in fragments, a writer thread writes one fragment
+        of every stream that has data in turn, so a large block of one stream doesn't hold up the other streams.
+        While no other stream waits, fragments are bulk sized, and a sender on an idle connection writes its fragment
+        itself instead of handing it to the writer thread, so a single transfer isn't slowed down by the fragments.
+        Every stream has a window, the bytes it may send before the peer has read them. The peer grants the window again
+        as the stream is read, so a stream that isn't read stops its own sender, not the connection.
+        Stream 0 is the control stream, it's open on both sides. Streams opened by the server have even ids, streams
+        opened by the client odd ids.
+
+        **Note:** Both sides must use a multiplexer, and nothing else may receive from the packet system once it's
+        started. Heartbeats of the packet system are answered by the reader thread.
+
+        :param pak: The packet system of the connection, plain or crypted.
+        :param is_server: True on the server side of the connection.
+        :param window: The window of every stream in bytes.
+        :param fragment_size: The maximum size of a fragment in bytes.
+        :param bulk_fragment_size: The maximum size of a fragment in bytes, while no other stream waits.
+        """
+
+        self.pak: PacketSystem = pak
+        self.window: int = window
+        self.fragmentSize: int = min(fragment_size, window)
+        self.bulkFragmentSize: int = min(max(bulk_fragment_size, self.fragmentSize), window)
+
+        self._condition = Condition()
+        self._streams: Dict[int, MuxStream] = {}
+        self._nextId = 2 if is_server else 1
+        self._accepted: Queue = Queue()
+        # Frames without data, like window updates, are written before the fragments of the streams.
+        self._control = deque()
+        # Streams with messages and window left, the writer thread takes them in turn.
+        self._ready = deque()
+        # Set while a sender writes a fragment itself.
+        self._direct = False
+        self._error: Optional[str] = None
+
+        self._reader = Thread(target=lambda: self._read(), name="Multiplexer-reader", daemon=True)
+        self._writer = Thread(target=lambda: self._write(), name="Multiplexer-writer", daemon=True)
+
+        self.control: MuxStream = self._add(Multiplexer.CONTROL_STREAM)
+
+    def start(self):
+        self._reader.start()
+        self._writer.start()
+
+    def open(self) -> MuxStream:
+        """
+        Open a new stream, the peer gets it from accept().
+
+        :raises ConnectionError: If the connection is closed.
+        :return: The stream.
+        """
+
+        with self._condition:
+            if self._error is not None:
+                raise ConnectionError(self._error)
+            stream = self._add(self._nextId)
+            self._nextId += 2
+            self._queue_frame(stream.id, Multiplexer.OPEN)
+        return stream
+
+    def accept(self) -> MuxStream:
+        """
+        Wait for a stream opened by the peer, in the order the peer opened them.
+
+        :raises ConnectionError: If the connection is closed.
+        :return: The stream.
+        """
+
+        stream = self._accepted.get()
+        if stream is None:
+            self._accepted.put(None)
+            raise ConnectionError(self._error)
+        return stream
+
+    def close(self):
+        """
+        Stop the multiplexer, the streams raise ConnectionError. The connection isn't closed.
+
+        :return:
+        """
+
+        self._fail("The multiplexer was closed")
+
+    def _add(self, stream_id: int) -> MuxStream:
+        stream = MuxStream(self, stream_id)
+        self._streams[stream_id] = stream
+        return stream
+
+    def _queue_frame(self, stream_id: int, type_: int, payload: bytes = b""):
+        # Called with the condition held.
+        self._control.append((Multiplexer.HEADER.pack(stream_id, type_), payload))
+        self._condition.notify()
+
+    def _schedule(self, stream: MuxStream):
+        # Called with the condition held.
+        if not stream._scheduled and not stream._writing and stream._outbox and stream._credit > 0:
+            stream._scheduled = True
+            self._ready.append(stream)
+            self._condition.notify()
+
+    def _end(self, stream: MuxStream, reason: str):
+        # Called with the condition held. Fails the messages of the stream, and wakes its receivers.
+        for message in stream._outbox:
+            message.fail(ConnectionError(reason))
+        stream._outbox.clear()
+        if stream._scheduled:
+            self._ready.remove(stream)
+            stream._scheduled = False
+        if stream._reason is None:
+            stream._reason = reason
+            stream._inbox.put(None)
+
+    def _fail(self, reason: str):
+        with self._condition:
+            if self._error is not None:
+                return
+            self._error = reason
+            for stream in self._streams.values():
+                self._end(stream, reason)
+            self._accepted.put(None)
+            self._condition.notify_all()
+
+    def _send(self, stream: MuxStream, message: _MuxMessage):
+        if message.size > self.maxMessageSize:
+            raise ValueError(f"Message of {message.size} bytes is bigger than the maximum of {self.maxMessageSize}")
+        with self._condition:
+            if self._error is not None:
+                raise ConnectionError(self._error)
+            if stream.closed or stream.remoteClosed:
+                raise ConnectionError(f"Stream {stream.id} is closed")
+            stream._outbox.append(message)
+            direct = len(stream._outbox) == 1 and stream._credit > 0 and not self._direct and not self._ready and \
+                not self._control
+            if direct:
+                # Nothing else waits for the connection, the fragment is written without waking the writer thread.
+                self._direct = stream._writing = True
+                header, parts, finished = self._fragment(stream)
+            else:
+                self._schedule(stream)
+
+        if direct:
+            try:
+                self.pak.send_frame(header, *parts)
+            except Exception as e:
+                self._fail(f"Connection lost: {e}")
+                message.fail(ConnectionError(f"Connection lost: {e}"))
+            with self._condition:
+                self._direct = stream._writing = False
+                # The rest of a message bigger than the fragment goes through the writer thread.
+                self._schedule(stream)
+            if finished is not None:
+                message.done.set()
+        message.done.wait()
+        if message.error is not None:
+            raise message.error
+
+    def _close(self, stream: MuxStream):
+        with self._condition:
+            if stream.closed:
+                return
+            stream.closed = True
+            self._streams.pop(stream.id, None)
+            self._end(stream, f"Stream {stream.id} is closed")
+            if not stream.remoteClosed and self._error is None:
+                self._queue_frame(stream.id, Multiplexer.CLOSE)
+
+    def _grant(self, stream: MuxStream, size: int):
+        # Called with the condition held. The window is granted in halves, not for every message.
+        stream._consumed += size
+        if stream._consumed >= self.window // 2 and not stream.closed and not stream.remoteClosed:
+            stream._unacked -= stream._consumed
+            self._queue_frame(stream.id, Multiplexer.WINDOW, stream._consumed.to_bytes(8, "big", signed=False))
+            stream._consumed = 0
+
+    def _consume(self, stream: MuxStream, buffer: bytearray, held: int):
+        with self._condition:
+            if stream._current is not None and len(stream._buffers) < self.retainedBuffers and \
+                    len(stream._current) <= self.maxRetainedSize:
+                stream._buffers.append(stream._current)
+            stream._current = buffer
+            stream._waiting -= 1
+            if not stream._waiting:
+                held += stream._partialHeld
+                stream._partialHeld = 0
+            self._grant(stream, held)
+
+    def _buffer(self, stream: MuxStream, size: int) -> memoryview:
+        # Called with the condition held. Takes the smallest free buffer of the stream that fits.
+        fitting = [buffer for buffer in stream._buffers if len(buffer) >= size]
+        if fitting:
+            buffer = min(fitting, key=len)
+            stream._buffers.remove(buffer)
+        else:
+            buffer = bytearray(size)
+        return memoryview(buffer)[:size]
+
+    def _receive(self, stream: MuxStream, payload: memoryview, type_: int):
+        # Called with the condition held.
+        if type_ & Multiplexer.FIRST:
+            if stream._partial is not None:
+                raise ConnectionError(f"The peer started a message on stream {stream.id} before the last one ended")
+            size = Multiplexer.SIZE.unpack_from(payload)[0]
+            if size > self.maxMessageSize:
+                raise ConnectionError(f"The peer started a message of {size} bytes on stream {stream.id}")
+            stream._partial = self._buffer(stream, size)
+            stream._partialSize = 0
+            payload = payload[Multiplexer.SIZE.size:]
+        elif stream._partial is None:
+            raise ConnectionError(f"The peer continued a message on stream {stream.id} that wasn't started")
+
+        size = len(payload)
+        if stream._unacked + size > self.window:
+            raise ConnectionError(f"The peer sent more than the window of stream {stream.id}")
+        if stream._partialSize + size > len(stream._partial):
+            raise ConnectionError(f"The peer sent more than the size of a message on stream {stream.id}")
+        stream._unacked += size
+        stream._partialHeld += size
+        stream._partial[stream._partialSize:stream._partialSize + size] = payload
+        stream._partialSize += size
+
+        if type_ & Multiplexer.FINAL:
+            if stream._partialSize != len(stream._partial):
+                raise ConnectionError(f"The peer ended a message on stream {stream.id} before its size")
+            stream._inbox.put((bool(type_ & Multiplexer.BLOCK), stream._partial, stream._partialHeld))
+            stream._waiting += 1
+            stream._partial = None
+            stream._partialHeld = 0
+            return
+
+        if not stream._waiting:
+            # The stream is read up to this message, so a message bigger than the window doesn't stop its sender.
+            self._grant(stream, stream._partialHeld)
+            stream._partialHeld = 0
+
+    def _read(self):
+        try:
+            while True:
+                _, body = self.pak.recv_frame()
+                stream_id, type_ = Multiplexer.HEADER.unpack_from(body)
+                payload = body[Multiplexer.HEADER.size:]
+                kind = type_ & Multiplexer.TYPE_MASK
+
+                with self._condition:
+                    stream = self._streams.get(stream_id)
+                    if kind == Multiplexer.OPEN:
+                        if stream_id % 2 == self._nextId % 2 or stream is not None:
+                            raise ConnectionError(f"The peer opened stream {stream_id}, which isn't its to open")
+                        self._accepted.put(self._add(stream_id))
+                    elif stream is None:
+                        # Streams closed on this side drop the frames that were underway.
+                        continue
+                    elif kind == Multiplexer.DATA:
+                        self._receive(stream, payload, type_)
+                    elif kind == Multiplexer.WINDOW:
+                        stream._credit += int.from_bytes(payload, "big", signed=False)
+                        self._schedule(stream)
+                    elif kind == Multiplexer.CLOSE:
+                        stream.remoteClosed = True
+                        self._end(stream, f"Stream {stream.id} was closed by the peer")
+                    else:
+                        raise ConnectionError(f"Unknown multiplexer frame type {type_}")
+        except Exception as e:
+            # Any error ends the multiplexer, so the streams don't wait for a reader that's gone.
+            self._fail(f"Connection lost: {e}")
+
+    def _fragment(self, stream: MuxStream) -> Tuple[bytes, list, Optional[_MuxMessage]]:
+        # Called with the condition held. Takes the next fragment of the first message of the stream, and returns its
+        # header, its parts and the message if this is its last fragment.
+        current = stream._outbox[0]
+        type_ = Multiplexer.DATA | (Multiplexer.BLOCK if current.block else 0)
+        first = current.remaining == current.size
+        limit = self.fragmentSize if self._ready or self._control else self.bulkFragmentSize
+        size = min(limit, stream._credit, current.remaining)
+        parts = current.take(size)
+        stream._credit -= size
+        if first:
+            type_ |= Multiplexer.FIRST
+            parts.insert(0, Multiplexer.SIZE.pack(current.size))
+        message = None
+        if not current.remaining:
+            message = stream._outbox.popleft()
+            type_ |= Multiplexer.FINAL
+        return Multiplexer.HEADER.pack(stream.id, type_), parts, message
+
+    def _write(self):
+        message = None
+        try:
+            while True:
+                message = None
+                with self._condition:
+                    while not self._control and not self._ready and self._error is None:
+                        self._condition.wait()
+                    if self._error is not None:
+                        return
+                    if self._control:
+                        header, payload = self._control.popleft()
+                        parts = [payload]
+                    else:
+                        stream = self._ready.popleft()
+                        stream._scheduled = False
+                        header, parts, message = self._fragment(stream)
+                        # Back in line after the other streams.
+                        self._schedule(stream)
+                self.pak.send_frame(header, *parts)
+                if message is not None:
+                    message.done.set()
+        except Exception as e:
+            if message is not None:
+                message.fail(ConnectionError(f"Connection lost: {e}"))
+            self._fail(f"Connection lost: {e}")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} streams={len(self._streams)} error={self._error}>"
+
+
+class AsyncPacketSystem(object):
+    def __init__(self, reader, writer):
+        """
+        Packet System for asyncio streams, uses the same frames as the PacketSystem class.
+        Frames are read with StreamReader.readexactly(...), and written with one StreamWriter.writelines(...) call, so
+        concurrent senders in the event loop never interleave frames.
+
+        :param reader: The asyncio stream reader.
+        :param writer: The asyncio stream writer.
+        """
+
+        import asyncio
+
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.lengthByteSize = 8
+        self._asyncio = asyncio
+
+        # Frames bigger than this fail the connection, like FrameReader.maxFrameSize.
+        self.maxFrameSize = 256 * 1024 * 1024
+
+        # The codecs for encoding packets, in order of preference. Set to the negotiated codecs of the connection.
+        self.codecs: List[str] = list(DEFAULT_CODECS)
+
+    async def _write_frame(self, *parts, flags=0):
+        length = sum(len(part) for part in parts)
+        self.writer.writelines([(length | flags).to_bytes(self.lengthByteSize, "big", signed=False), *parts])
+        await self.writer.drain()
+
+    async def _read_exactly(self, size: int) -> bytes:
+        if size > self.maxFrameSize:
+            raise ConnectionError(f"The peer sent a frame of {size} bytes, the maximum is {self.maxFrameSize}")
+        try:
+            return await self.reader.readexactly(size)
+        except self._asyncio.IncompleteReadError as e:
+            raise ConnectionError(f"Connection closed after {len(e.partial)} of {size} bytes of a frame")
+
+    async def send(self, o):
+        """
+        Send a packet to the connection.
+
+        :param o: The data to send.
+        :return:
+        """
+
+        await self._write_frame(*PacketEncoder(o, self.codecs).get_parts())
 
-        obj2 = ARC4.new(key.encode())
-        return obj2.decrypt(b)
+    async def send_block(self, transfer_id: UUID, offset: int, data, flags: int = 0, compression: CompressionStage = None):
+        """
+        Send a raw file-data block, see PacketSystem.send_block(...).
+
+        :param transfer_id: The UUID of the transfer.
+        :param offset: The offset of the block in the file.
+        :param data: The bytes-like data of the block.
+        :param flags: The block flags, like DataBlock.LAST_BLOCK. With DataBlock.ZERO_BLOCK only the length of the data is
+                      sent.
+        :param compression: The compression stage of the transfer, the data is sent uncompressed when None.
+        :return:
+        """
 
-    def send_c(self, o, key):
-        _, data = PacketEncoder(o).get_encoded()
-        # print(value, key)
-        data = self._encrypt(data, key)
         length = len(data)
+        if flags & DataBlock.ZERO_BLOCK:
+            data = b""
+        elif compression is not None:
+            bits, data = compression.process(data)
+            flags |= bits
+        block = DataBlock(transfer_id, offset, data, flags, length)
+        await self._write_frame(block.pack_header(), data, flags=RAW_FRAME)
+
+    async def recv(self):
+        """
+        Recieve a packet from the connection. Heartbeats are answered and skipped.
+
+        :return: The decoded packet, or a DataBlock instance for raw data frames.
+        """
+
+        length = int.from_bytes(await self._read_exactly(self.lengthByteSize), "big", signed=False)
+        while length & CONTROL_FRAME:
+            if await self._read_exactly(length & ~CONTROL_FRAME) == PING:
+                await self._write_frame(PONG, flags=CONTROL_FRAME)
+            length = int.from_bytes(await self._read_exactly(self.lengthByteSize), "big", signed=False)
+        if length & RAW_FRAME:
+            return DataBlock.from_frame(memoryview(await self._read_exactly(length & ~RAW_FRAME)))
+
+        return PacketDecoder(await self._read_exactly(length)).get_decoded()
+
+    def get_peername(self):
+        return self.writer.get_extra_info("peername")
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} peername={repr(self.get_peername())}>"
+
+
+class AsyncBridge(object):
+    def __init__(self):
+        """
+        Bridge between an asyncio event loop thread and a UI thread (like the Tk mainloop).
+        The event loop posts callbacks with #post(...), the UI thread runs them with #poll(). The UI thread submits
+        coroutines to the event loop with #submit(...).
+        """
+
+        import queue
+
+        self.loop = None
+        self._calls = queue.Queue()
+        self._queue = queue
+
+    def post(self, func: Callable, *args):
+        """
+        Post a callback to the UI thread, can be called from any thread.
+
+        :param func: The callback.
+        :param args: The arguments of the callback.
+        :return:
+        """
+
+        self._calls.put((func, args))
+
+    def poll(self, limit: int = 100):
+        """
+        Runs the posted callbacks, must be called from the UI thread.
+
+        :param limit: The maximum amount of callbacks to run, so a flood of updates doesn't block the UI.
+        :return:
+        """
 
-        self.conn.send(length.to_bytes(self.lengthByteSize, "big", signed=False))
-        self.conn.send(data)
+        for _ in range(limit):
+            try:
+                func, args = self._calls.get_nowait()
+            except self._queue.Empty:
+                return
+            func(*args)
+
+    def submit(self, coro):
+        """
+        Submit a coroutine to the event loop, can be called from any thread.
+
+        :param coro: The coroutine.
+        :return: A concurrent.futures.Future for the result of the coroutine.
+        """
+
+        import asyncio
+
+        if self.loop is None:
+            raise RuntimeError("The event loop isn't running")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class AsyncServer(Server):
+    """
+    Server using asyncio, all connections are handled by one event loop in one thread.
+    """
+
+    def __init__(self, port_):
+        """
+        Asyncio server constructor, used for communicate between clients and server.
+        The runner hook is a coroutine function, called with an AsyncPacketSystem for the connection and the secret.
+
+        Example
+        --------
+        >>> async def s_runner(pak, secret):
+        ...     await pak.send("Hello World")
+        ...     print(await pak.recv())
+        >>>
+        >>> server_ = AsyncServer(36673)
+        >>> server_.runner = s_runner
+        >>> server_.start()
+
+        :param port_: The port number to use for the server, used for clients to connect to
+        """
+
+        super(AsyncServer, self).__init__(port_)
+
+        import asyncio
+        self._asyncio = asyncio
+
+        # Asyncio servers always use the accepted connections directly.
+        self.singlePort = True
+
+        self.bridge = AsyncBridge()
+        self._server = None
+
+    async def runner(self, conn: AsyncPacketSystem, secret):
+        """
+        Used for the handling the connection, like sending packages, or recieving packages.
+        Must be overridden in subclass to take effect.
+
+        :param conn:
+        :param secret:
+        :return:
+        """
+
+        pass
+
+    async def _handle(self, reader, writer):
+        pak = AsyncPacketSystem(reader, writer)
+        if self.tcpNoDelay:
+            writer.get_extra_info("socket").setsockopt(self._socket.IPPROTO_TCP, self._socket.TCP_NODELAY, 1)
+
+        # Extra data streams aren't supported, only new connections are accepted.
+        try:
+            hello = await self._asyncio.wait_for(pak.recv(), self.helloTimeout)
+        except (OSError, ValueError, self._asyncio.TimeoutError):
+            hello = None
+        if not isinstance(hello, dict) or hello.get("type") != "hello":
+            await pak.close()
+            return
+
+        self.conn_array.append(pak)
+        self.event(CONN_SUCCESS, self)
+
+        try:
+            # send the group and my public value, the secret is computed off the event loop
+            a, public = self.keyExchange.keypair()
+            await pak.send(KeyExchange.GENERATOR)
+            await pak.send(KeyExchange.PRIME)
+            await pak.send(public)
+
+            b = await pak.recv()
+            secret = await self._asyncio.get_running_loop().run_in_executor(None, KeyExchange.secret, a, b)
+            self.secret_array[pak] = secret
+
+            # negotiate the packet codecs, the client picks from the offered codecs
+            await pak.send(CodecRegistry.available())
+            pak.codecs = self.codec_array[pak] = await pak.recv()
+
+            # no encryption, the frames of asyncio streams aren't encrypted
+            await pak.send(None)
+            await pak.recv()
+
+            # no multiplexing, the runner gets the asyncio streams
+            await pak.send(False)
+            await pak.recv()
+
+            # no session token, the client doesn't open extra data streams
+            await pak.send(None)
+
+            self.postInitHook(self, pak, pak.get_peername(), secret)
+
+            await self.runner(pak, secret)
+        except ConnectionError:
+            self.event(CONN_LOST, self)
+        finally:
+            self.conn_array.remove(pak)
+            self.secret_array.pop(pak, None)
+            self.codec_array.pop(pak, None)
+            await pak.close()
+
+    async def serve(self):
+        """
+        Serves the connections in the running event loop, until the server is closed.
+
+        :return:
+        """
+
+        self.bridge.loop = self._asyncio.get_running_loop()
+        try:
+            self._server = await self._asyncio.start_server(self._handle, '', self.port, backlog=self.backlog)
+        except OSError:
+            return
+
+        self.event(CONN_SUCCESS, "server")
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except self._asyncio.CancelledError:
+                pass
+
+    def close(self):
+        """
+        Closes the server, can be called from any thread.
+
+        :return:
+        """
+
+        if self._server is not None:
+            self.bridge.loop.call_soon_threadsafe(self._server.close)
+
+    def run(self):
+        """
+        Starts the server in non-thread-mode.
+
+        :return: Nothing
+        """
+
+        self._asyncio.run(self.serve())
+
+    def start(self):
+        """
+        Starts the server in thread-mode.
+
+        :returns: The Thread(...) instance of the event loop thread
+        """
+
+        t_ = self._threading.Thread(target=self.run, name="AsyncServer")
+        t_.start()
+        return t_
+
+
+class AsyncClient(Client):
+    """
+    Client using asyncio, the connection is handled by an event loop in one thread.
+    """
+
+    def __init__(self, host, port_):
+        """
+        Asyncio client constructor, used for communicate between client and server.
+        The runner hook is a coroutine function, called with an AsyncPacketSystem for the connection and the secret.
+
+        Example
+        --------
+        >>> async def c_runner(pak, secret):
+        ...     print(await pak.recv())
+        ...     await pak.send("Hello Server")
+        >>>
+        >>> client_ = AsyncClient("127.0.0.1", 36673)
+        >>> client_.runner = c_runner
+        >>> client_.start()
+
+        :param host: The IP adress for the client
+        :param port_: The port number for the client
+        """
+
+        super(AsyncClient, self).__init__(host, port_)
+
+        import asyncio
+        self._asyncio = asyncio
+
+        # Asyncio clients always connect directly to the server port.
+        self.singlePort = True
+
+        self.bridge = AsyncBridge()
+
+    async def runner(self, conn: AsyncPacketSystem, secret):
+        """
+        Used for the handling the connection, like sending packages, or recieving packages.
+        Must be overridden in subclass to take effect.
+
+        :param conn:
+        :param secret:
+        :return:
+        """
+
+        pass
+
+    async def connect(self):
+        """
+        Connects to the server and runs the runner in the running event loop.
+
+        :return:
+        """
+
+        self.bridge.loop = self._asyncio.get_running_loop()
+        try:
+            reader, writer = await self._asyncio.wait_for(self._asyncio.open_connection(self.host, self.port), 5.0)
+        except self._asyncio.TimeoutError:
+            self.event(CONN_TIMEOUT, self)
+            return
+        except OSError:
+            self.event(CONN_LOST, self)
+            return
+
+        pak = AsyncPacketSystem(reader, writer)
+        if self.tcpNoDelay:
+            writer.get_extra_info("socket").setsockopt(self._socket.IPPROTO_TCP, self._socket.TCP_NODELAY, 1)
+
+        self.event(CONN_SUCCESS, self)
+        self.conn_array.append(pak)
 
-    def recv_c(self, key):
         try:
-            length = self.conn.recv(self.lengthByteSize)
-            data = self.conn.recv(int.from_bytes(length, "big", signed=False))
-        except ValueError:
-            return None
-        return PacketDecoder(self._decrypt(data, key)).get_decoded()
+            await pak.send({"type": "hello"})
+
+            # Get my base, prime, and A values, only the known group is accepted
+            base = await pak.recv()
+            prime = await pak.recv()
+            a = await pak.recv()
+            if (base, prime) != (KeyExchange.GENERATOR, KeyExchange.PRIME):
+                raise ConnectionRefusedError("The server uses an unknown key exchange group")
+            b, public = self.keyExchange.keypair()
+            # Send the 'B' value
+            await pak.send(public)
+            secret = await self._asyncio.get_running_loop().run_in_executor(None, KeyExchange.secret, b, a)
+            self.secret_array[pak] = secret
+
+            # Pick the codecs from the codecs offered by the server
+            codecs = CodecRegistry.negotiate(await pak.recv())
+            await pak.send(codecs)
+            pak.codecs = self.codec_array[pak] = codecs
+
+            # No encryption, the frames of asyncio streams aren't encrypted
+            await pak.recv()
+            await pak.send(None)
+
+            # No multiplexing, the runner gets the asyncio streams
+            await pak.recv()
+            await pak.send(False)
+
+            # Extra data streams aren't supported, the session token is ignored
+            await pak.recv()
+
+            self.postInitHook(self, pak, secret)
+
+            await self.runner(pak, secret)
+        except ConnectionError:
+            self.event(CONN_LOST, self)
+        finally:
+            self.conn_array.remove(pak)
+            self.secret_array.pop(pak, None)
+            self.codec_array.pop(pak, None)
+            await pak.close()
+
+    def run(self):
+        """
+        Starts the client in non-thread-mode
+
+        :returns: Nothing
+        """
+
+        self._asyncio.run(self.connect())
+
+    def start(self):
+        """
+        Starts the client in thread-mode
+
+        :returns: The Thread(...) instance of the event loop thread
+        """
+
+        t_ = self._threading.Thread(target=self.run, name="AsyncClient")
+        t_.start()
+        return t_
 
 
 class NetworkInfo(object):
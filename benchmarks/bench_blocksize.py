@@ -0,0 +1,100 @@
+"""
+Benchmark for the block size of file uploads, over a TCP connection on loopback.
+Sends the same file with fixed block sizes from 4 KiB to 8 MiB and with adaptive block sizes, and prints the
+throughput per block size, for sendfile(...) and for blocks read into Python.
+
+Usage: python -m benchmarks.bench_blocksize
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+from threading import Thread
+
+from advUtils.network import PacketSystem
+from lib import FileSize
+from old.downloader import FileDownloader
+from old.manifest import TransferManifest
+from old.uploader import FileUploader
+
+BLOCK_SIZES = [4096 << shift for shift in range(12)]
+
+
+def connect():
+    server = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return PacketSystem(client), PacketSystem(conn)
+
+
+def transfer(source: str, target: str, block_size, zero_copy: bool) -> float:
+    """
+    Uploads the source file to the target path.
+
+    :param source: The path of the file to send.
+    :param target: The path to save the file to.
+    :param block_size: The fixed block size, or None for adaptive block sizes.
+    :param zero_copy: True to send with sendfile(...).
+    :return: The seconds the transfer took.
+    """
+
+    FileUploader.blockSize = block_size
+    FileUploader.zeroCopy = zero_copy
+    sender, receiver = connect()
+    errors = []
+    uploader = FileUploader(sender, source, None, canvas_item=None, on_error=errors.append)
+
+    # The replies of the receiver, normally routed by the connection.
+    def route():
+        try:
+            while True:
+                uploader.replies.put(sender.recv())
+        except (ConnectionError, OSError):
+            pass
+
+    Thread(target=route, daemon=True).start()
+    start = time.perf_counter()
+    uploader.start()
+    downloader = FileDownloader(False, receiver, target, None, canvas_item=None, on_error=errors.append)
+    downloader.start()
+    downloader.join()
+    uploader._thread.join()
+    elapsed = time.perf_counter() - start
+
+    sender.conn.close()
+    receiver.conn.close()
+    if errors:
+        raise errors[0]
+    os.remove(target)
+    return elapsed
+
+
+def main(size: int = 256 * 1024 * 1024):
+    directory = tempfile.mkdtemp()
+    TransferManifest.directory = os.path.join(directory, "manifests")
+    source = os.path.join(directory, "source.bin")
+    with open(source, "wb") as fd:
+        for _ in range(size // 1048576):
+            fd.write(os.urandom(1048576))
+
+    # Compression would measure the compressor instead of the block size.
+    FileUploader.compressor = None
+    try:
+        for zero_copy in (True, False):
+            print(f"Upload of {FileSize.get_string(size)} {'with sendfile' if zero_copy else 'read into Python'}:")
+            results = []
+            for block_size in BLOCK_SIZES + [None]:
+                name = "adaptive" if block_size is None else FileSize.get_string(block_size)
+                results.append((name, size / transfer(source, os.path.join(directory, "target.bin"), block_size, zero_copy)))
+            fastest = max(throughput for _, throughput in results)
+            for name, throughput in results:
+                print(f"    {name:>10} {FileSize.get_string(int(throughput)):>10}/s {'#' * round(throughput / fastest * 50)}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Benchmark for the packet codecs, on the packets QCopyOverPC sends.
+
+Usage: python -m benchmarks.bench_codecs
+"""
+
+import os
+import timeit
+from uuid import uuid3, NAMESPACE_X500
+
+from advUtils.network import CodecRegistry, PacketEncoder, PacketDecoder
+
+CONTROL_MESSAGES = {
+    "file-offer": {"type": "file", "filename": "holiday-photos.zip"},
+    "folder-offer": {"type": "folder", "name": "build"},
+    "create-folder": {"type": "create-folder", "rel-path": "src/main/python"},
+    "create-file": {"type": "create-file", "rel-path": "src/main/python/__init__.py", "size": 1893},
+    "end": {"type": "end"},
+    "uuid": uuid3(NAMESPACE_X500, "C:/Users/Quinten/Downloads/holiday-photos.zip"),
+    "file-size": 4_831_838_208,
+}
+
+DATA_MESSAGES = {
+    "data-32k": {"type": "data", "data": {"size": 32767, "data": os.urandom(32767), "last-block": False}},
+    "data-rel-path-64k": {"type": "data-rel-path", "rel-path": "assets/texture.png",
+                          "data": {"size": 65536, "data": os.urandom(65536), "last-block": False}},
+}
+
+
+def bench(name: str, message, number: int):
+    print(f"{name}:")
+    for codec in CodecRegistry.available():
+        encoder = PacketEncoder(message, [codec])
+        try:
+            encoded = b"".join(encoder.get_parts())
+        except ValueError:
+            print(f"    {codec:<10} unsupported")
+            continue
+
+        encode = timeit.timeit(encoder.get_parts, number=number) / number
+        decode = timeit.timeit(lambda: PacketDecoder(encoded).get_decoded(), number=number) / number
+        print(f"    {codec:<10} encode {encode * 1e6:9.2f} us   decode {decode * 1e6:9.2f} us   "
+              f"size {len(encoded):>7} B")
+
+
+if __name__ == '__main__':
+    print(f"Available codecs: {', '.join(CodecRegistry.available())}\n")
+    for name_, message_ in CONTROL_MESSAGES.items():
+        bench(name_, message_, 20000)
+    for name_, message_ in DATA_MESSAGES.items():
+        bench(name_, message_, 2000)
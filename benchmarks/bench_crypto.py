@@ -0,0 +1,83 @@
+"""
+Benchmark for the throughput of encrypted connections, over a TCP connection on loopback.
+Sends raw data blocks with a PacketSystem and with a CryptedPacketSystem, and prints the throughput of both. The
+receiver runs in another process, like on a real connection, so sender and receiver don't share a core.
+
+Usage: python -m benchmarks.bench_crypto
+"""
+
+import os
+import socket
+import time
+from multiprocessing import Process
+from uuid import uuid4
+
+from advUtils.network import CryptedPacketSystem, FrameCipher, PacketSystem, SessionKey
+from lib import FileSize
+
+BLOCK_SIZES = [64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def packet_system(conn: socket.socket, salt, is_server: bool) -> PacketSystem:
+    if salt is None:
+        return PacketSystem(conn)
+    return CryptedPacketSystem(conn, SessionKey.from_secret(0x5EC12E7, salt, is_server))
+
+
+def receive(conn: socket.socket, salt, size: int):
+    pak = packet_system(conn, salt, False)
+    received = 0
+    while received < size:
+        received += pak.recv().length
+    pak.send("done")
+
+
+def measure(salt, block_size: int, size: int) -> float:
+    """
+    Sends blocks to a receiver process.
+
+    :param salt: The salt of the session key, None for a plain connection.
+    :param block_size: The size of the blocks.
+    :param size: The amount of bytes to send.
+    :return: The throughput in bytes per second.
+    """
+
+    server = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+
+    receiver = Process(target=receive, args=(client, salt, size))
+    receiver.start()
+    pak = packet_system(conn, salt, True)
+    data = os.urandom(block_size)
+    transfer_id = uuid4()
+
+    start = time.perf_counter()
+    for offset in range(0, size, block_size):
+        pak.send_block(transfer_id, offset, data)
+    pak.recv()
+    elapsed = time.perf_counter() - start
+
+    receiver.join()
+    conn.close()
+    client.close()
+    return size / elapsed
+
+
+def main(size: int = 1024 * 1024 * 1024):
+    if not FrameCipher.available():
+        print("No AES-GCM implementation, install cryptography or pycryptodome.")
+        return
+
+    salt = os.urandom(32)
+    print(f"Blocks of {FileSize.get_string(size)}, plain and encrypted:")
+    for block_size in BLOCK_SIZES:
+        plain = measure(None, block_size, size)
+        encrypted = measure(salt, block_size, size)
+        print(f"    {FileSize.get_string(block_size):>10} {FileSize.get_string(int(plain)):>10}/s plain "
+              f"{FileSize.get_string(int(encrypted)):>10}/s encrypted {encrypted / plain:6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark for the connection handshake of Server and Client in single-port mode, over loopback.
+Measures the time from connecting until the key exchange and the codec negotiation are done, for clients connecting one
+after another and for clients connecting at once. The same is measured while stalled connections that never send their
+hello packet are pending, they must not hold up the accept loop.
+
+Usage: python -m benchmarks.bench_handshake
+"""
+
+import os
+import socket
+import statistics
+import time
+from threading import Event
+
+from advUtils.network import Client, KeyExchange, Server
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def handshake(port: int) -> float:
+    """
+    Connects a client and waits until its handshake is done.
+
+    :param port: The port of the server.
+    :return: The seconds the handshake took.
+    """
+
+    done = Event()
+    client = Client("127.0.0.1", port)
+    client.singlePort = True
+    client.tcpNoDelay = True
+    client.encrypted = True
+    client.postInitHook = lambda client_, conn, secret: done.set()
+
+    start = time.perf_counter()
+    client.start()
+    if not done.wait(30.0):
+        raise TimeoutError("Handshake didn't finish")
+    return time.perf_counter() - start
+
+
+def concurrent_handshakes(port: int, count: int) -> list:
+    """
+    Connects clients at once, and waits until all handshakes are done.
+
+    :param port: The port of the server.
+    :param count: The amount of clients.
+    :return: The seconds every handshake took.
+    """
+
+    events, clients = [], []
+    for _ in range(count):
+        done = Event()
+        client = Client("127.0.0.1", port)
+        client.singlePort = True
+        client.tcpNoDelay = True
+        client.encrypted = True
+        client.postInitHook = lambda client_, conn, secret, done_=done: done_.set()
+        events.append(done)
+        clients.append(client)
+
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    latencies = []
+    for done in events:
+        if not done.wait(30.0):
+            raise TimeoutError("Handshake didn't finish")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    print(f"{name}:")
+    print(f"    mean   {statistics.mean(latencies) * 1000:8.3f} ms")
+    print(f"    median {statistics.median(latencies) * 1000:8.3f} ms")
+    print(f"    p99    {latencies[int(len(latencies) * 0.99)] * 1000:8.3f} ms")
+    print(f"    max    {latencies[-1] * 1000:8.3f} ms")
+
+
+def main(count: int = 200, stalled: int = 4):
+    start = time.perf_counter()
+    for _ in range(20):
+        KeyExchange.generate_keypair()
+    print(f"Keypair generation: {(time.perf_counter() - start) / 20 * 1000:.3f} ms")
+
+    port = free_port()
+    server = Server(port)
+    server.singlePort = True
+    server.tcpNoDelay = True
+    server.encrypted = True
+    server.start()
+    time.sleep(0.5)
+
+    report(f"{count} handshakes one after another", [handshake(port) for _ in range(count)])
+    report(f"{count // 4} handshakes at once", concurrent_handshakes(port, count // 4))
+
+    # Connections that never send a hello packet, the server waits helloTimeout seconds for each.
+    idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(stalled)]
+    time.sleep(0.1)
+    report(f"{count} handshakes with {stalled} stalled connections pending",
+           [handshake(port) for _ in range(count)])
+    for sock in idle:
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
+
+    # The accept loop and the runner threads run forever.
+    os._exit(0)
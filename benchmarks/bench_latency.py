@@ -0,0 +1,66 @@
+"""
+Benchmark for the round trip of a file-offer message between two QCopyOverPC peers over loopback.
+Measures the time between queueing an offer on one peer and receiving the reply from the other peer.
+
+Usage: python -m benchmarks.bench_latency
+"""
+
+import os
+import socket
+import statistics
+import time
+from queue import Queue
+
+# old.server and old.__main__ import each other, importing through old.__main__ resolves the cycle.
+from old.__main__ import Server
+
+
+class EchoMain(object):
+    def __init__(self, reply: bool):
+        """
+        Stand-in for QCopyOverPC, replies to file offers or records the replies.
+
+        :param reply: True to reply to offers, False to record replies.
+        """
+
+        self.connection: Server = None
+        self.reply = reply
+        self.replies = Queue()
+
+    def do(self, conn: socket.socket, data: object):
+        if self.reply:
+            self.connection.send(conn, {"type": "file-accept", "filename": data["filename"]})
+        else:
+            self.replies.put(time.perf_counter())
+
+    def add_error_item(self, name, description):
+        print(f"{name}: {description}")
+
+
+def main(count: int = 1000):
+    sock_a, sock_b = socket.socketpair()
+    main_a, main_b = EchoMain(False), EchoMain(True)
+    peer_a, peer_b = Server(main_a), Server(main_b)
+    main_a.connection, main_b.connection = peer_a, peer_b
+    peer_a.runner(sock_a, None)
+    peer_b.runner(sock_b, None)
+
+    round_trips = []
+    for _ in range(count):
+        start = time.perf_counter()
+        peer_a.send(sock_a, {"type": "file", "filename": "holiday-photos.zip"})
+        round_trips.append(main_a.replies.get() - start)
+
+    round_trips.sort()
+    print(f"File-offer round trip over {count} messages:")
+    print(f"    mean   {statistics.mean(round_trips) * 1000:8.3f} ms")
+    print(f"    median {statistics.median(round_trips) * 1000:8.3f} ms")
+    print(f"    p99    {round_trips[int(count * 0.99)] * 1000:8.3f} ms")
+    print(f"    max    {round_trips[-1] * 1000:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
+
+    # The sender and receiver threads of the peers run forever.
+    os._exit(0)
@@ -0,0 +1,148 @@
+"""
+Benchmark for multiplexed connections, over a TCP connection on loopback.
+Sends raw data blocks over a plain PacketSystem and over streams of a Multiplexer, and prints the throughput of both. It
+also measures the round trip of small control packets while a bulk transfer runs, over its own stream and, without a
+multiplexer, behind the blocks. The receiver runs in another process, like on a real connection.
+
+Usage: python -m benchmarks.bench_mux
+"""
+
+import os
+import socket
+import statistics
+import time
+from multiprocessing import Process
+from threading import Thread
+from uuid import uuid4
+
+from advUtils.network import Multiplexer, PacketSystem
+from lib import FileSize
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def connection():
+    server = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return conn, client
+
+
+def receive(conn: socket.socket, streams: int):
+    pak = PacketSystem(conn)
+    if streams == 0:
+        # Without a multiplexer, control packets are answered in between the blocks.
+        while True:
+            received = pak.recv()
+            if received == "done":
+                break
+            if isinstance(received, dict):
+                pak.send(received)
+        pak.send("done")
+        return
+
+    mux = Multiplexer(pak, False)
+    mux.start()
+
+    def drain(stream):
+        while stream.recv() != "done":
+            pass
+        stream.send("done")
+
+    def echo():
+        while True:
+            received = mux.control.recv()
+            if received == "done":
+                return
+            mux.control.send(received)
+
+    threads = [Thread(target=drain, args=(mux.accept(),)) for _ in range(streams)]
+    threads.append(Thread(target=echo))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def measure(streams: int, size: int, pings: int = 0):
+    """
+    Sends blocks to a receiver process.
+
+    :param streams: The amount of streams, 0 for a plain connection.
+    :param size: The amount of bytes to send, split over the streams.
+    :param pings: The amount of control packets to send while the blocks are sent.
+    :return: The throughput in bytes per second, and the round trips of the control packets in seconds.
+    """
+
+    conn, client = connection()
+    receiver = Process(target=receive, args=(client, streams))
+    receiver.start()
+    pak = PacketSystem(conn)
+    data = os.urandom(BLOCK_SIZE)
+    latencies = []
+
+    if streams == 0:
+        start = time.perf_counter()
+        transfer_id = uuid4()
+        interval = max(size // BLOCK_SIZE // (pings + 1), 1)
+        for index, offset in enumerate(range(0, size, BLOCK_SIZE)):
+            pak.send_block(transfer_id, offset, data)
+            if pings and index % interval == interval - 1 and len(latencies) < pings:
+                sent = time.perf_counter()
+                pak.send({"ping": index})
+                while not isinstance(pak.recv(), dict):
+                    pass
+                latencies.append(time.perf_counter() - sent)
+        pak.send("done")
+        pak.recv()
+        elapsed = time.perf_counter() - start
+    else:
+        mux = Multiplexer(pak, True)
+        mux.start()
+        opened = [mux.open() for _ in range(streams)]
+
+        def send(stream):
+            transfer_id = uuid4()
+            for offset in range(0, size // streams, BLOCK_SIZE):
+                stream.send_block(transfer_id, offset, data)
+            stream.send("done")
+            stream.recv()
+
+        threads = [Thread(target=send, args=(stream,)) for stream in opened]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for index in range(pings):
+            time.sleep(0.01)
+            sent = time.perf_counter()
+            mux.control.send({"ping": index})
+            mux.control.recv()
+            latencies.append(time.perf_counter() - sent)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        mux.control.send("done")
+        mux.close()
+
+    receiver.join()
+    conn.close()
+    client.close()
+    return size / elapsed, latencies
+
+
+def main(size: int = 1024 * 1024 * 1024, pings: int = 20):
+    print(f"Blocks of {FileSize.get_string(BLOCK_SIZE)}, {FileSize.get_string(size)} in total:")
+    for streams, name in [(0, "plain"), (1, "1 stream"), (4, "4 streams")]:
+        throughput, _ = measure(streams, size)
+        print(f"    {name:>10} {FileSize.get_string(int(throughput)):>10}/s")
+
+    print(f"Round trip of {pings} control packets during a transfer:")
+    for streams, name in [(0, "plain"), (1, "1 stream")]:
+        _, latencies = measure(streams, size // 4, pings)
+        print(f"    {name:>10} median {statistics.median(latencies) * 1000:8.3f} ms "
+              f"max {max(latencies) * 1000:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -73,13 +73,14 @@ import os
 # exit(1)
 from socket import socket
 from tkinter import ttk, filedialog, simpledialog, PhotoImage
-from typing import Optional, Union, BinaryIO
+from typing import Optional, Union, BinaryIO, List
 
-from threadsafe_tkinter import Tk, Canvas, Frame, TclError
+from threadsafe_tkinter import Tk, Canvas, Frame, Menu, TclError
 
 from old.client import Client
 from old.downloader import Downloader
 from old.gui import QCanvasButton, ScrolledWindow, DownloadItem, UploadItem, ErrorItem, CanvasItem, ColorType
+from old.scheduler import Transfer
 from old.server import Server
 from old.uploader import Uploader
 
@@ -213,6 +214,11 @@ class QCopyOverPC(Tk):
             self.openButton.create_dynamictext(5, 5, text="Open File", anchor="nw", font=("helvetica", 16))
             self.openButton.create_dynamictext(5, 30, text="Open a file, and send it to all the connected clients", anchor="nw", font=("helvetica", 10))
             self.openButton.pack(fill="x", padx=5, pady=5)
+
+            self.limitButton = QCanvasButton(self.frame, command=self.set_limits, height=64)
+            self.limitButton.create_dynamictext(5, 5, text="Bandwidth Limit", anchor="nw", font=("helvetica", 16))
+            self.limitButton.create_dynamictext(5, 30, text="Limit the upload and download rate of all transfers", anchor="nw", font=("helvetica", 10))
+            self.limitButton.pack(fill="x", padx=5, pady=5)
             self.frame.pack(fill="both", expand=True)
 
             # Bahavior
@@ -265,6 +271,7 @@ class QCopyOverPC(Tk):
                             downloader.done = True
                     if downloader.done:
                         self.connection.downloaders().remove(downloader)
+
                 self.update()
                 self.update_idletasks()
         except TclError:
@@ -311,7 +318,7 @@ class QCopyOverPC(Tk):
         self.canvass[-1].pack(fill="x")
         self.frames[-1].pack(fill="x")
 
-    def add_file_upload(self, name, description, path):
+    def add_file_upload(self, name, description, path, offer: dict = None):
         self.frames.append(Frame(self.frame_sw, height=150, width=790, bg="#6f6f6f"))
 
         item = UploadItem(self, name, description, height=150, width=790, bg="#6f6f6f", highlightthickness=0)
@@ -321,11 +328,13 @@ class QCopyOverPC(Tk):
         self.canvass[-1].pack(fill="x")
         self.frames[-1].pack(fill="x")
 
-        self.connection.upload(
+        transfers = self.connection.upload(
             path, item.progressbar,
             on_complete=lambda _canv=item: self.on_complete(
                 _canv, None, item.progressbar, item.desc, "Upload complete!"),
-            on_error=lambda exc, _canv=item: self.on_error(_canv, item.progressbar, item.desc, exc), canvas_item=item)
+            on_error=lambda exc, _canv=item: self.on_error(_canv, item.progressbar, item.desc, exc), canvas_item=item,
+            offer=offer)
+        self.bind_transfer_menu(item, transfers)
 
     def add_file_download(self, conn: socket, name, description, path):
         self.frames.append(Frame(self.frame_sw, height=150, width=790, bg="#6f6f6f"))
@@ -343,7 +352,7 @@ class QCopyOverPC(Tk):
                 canvas, None, item.progressbar, item.desc, "Download complete!"),
             on_error=lambda exc, _canv=item: self.on_error(_canv, item.progressbar, item.desc, exc), canvas_item=item)
 
-    def add_folder_upload(self, name, description, path):
+    def add_folder_upload(self, name, description, path, offer: dict = None):
         self.frames.append(Frame(self.frame_sw, height=150, width=790, bg="#6f6f6f"))
 
         item = UploadItem(self, name, description, height=150, width=790, bg="#6f6f6f", highlightthickness=0)
@@ -353,11 +362,41 @@ class QCopyOverPC(Tk):
         self.canvass[-1].pack(fill="x")
         self.frames[-1].pack(fill="x")
 
-        self.connection.upload_folder(
+        transfers = self.connection.upload_folder(
             path, item.progressbar,
             on_complete=lambda _canv=item: self.on_complete(
                 _canv, None, item.progressbar, item.desc, "Upload complete!"),
-            on_error=lambda exc, _canv=item: self.on_error(_canv, item.progressbar, item.desc, exc), canvas_item=item)
+            on_error=lambda exc, _canv=item: self.on_error(_canv, item.progressbar, item.desc, exc), canvas_item=item,
+            offer=offer)
+        self.bind_transfer_menu(item, transfers)
+
+    def bind_transfer_menu(self, item: UploadItem, transfers: List[Transfer]):
+        """
+        Binds the context menu of a queued upload, to pause, resume or move it in the queue.
+
+        @param item: the canvas item of the upload.
+        @param transfers: the scheduled transfers of the upload, one per peer.
+        @author: Quinten Jungblut
+        """
+
+        scheduler = self.connection.scheduler
+
+        def pause():
+            if any([scheduler.pause(transfer) for transfer in transfers]):
+                item.set_description("Paused")
+
+        def resume():
+            item.set_description("Upload in queue...")
+            for transfer in transfers:
+                scheduler.resume(transfer)
+
+        menu = Menu(self, tearoff=0)
+        menu.add_command(label="Pause", command=pause)
+        menu.add_command(label="Resume", command=resume)
+        menu.add_separator()
+        menu.add_command(label="Move to Top", command=lambda: [scheduler.move_to_front(transfer) for transfer in transfers])
+        menu.add_command(label="Move to Bottom", command=lambda: [scheduler.move_to_back(transfer) for transfer in transfers])
+        item.bind("<Button-3>", lambda event: menu.tk_popup(event.x_root, event.y_root))
 
     def add_folder_download(self, conn: socket, name, description, path):
         self.frames.append(Frame(self.frame_sw, height=150, width=790, bg="#6f6f6f"))
@@ -509,6 +548,19 @@ class QCopyOverPC(Tk):
 
         self.add_file_download(conn, data["filename"], "Download in queue...", path)
 
+    def savefolder(self, conn: socket, name, data):
+        # Ask for a folder, an existing folder with the same name is synced.
+        f: str = filedialog.askdirectory(title=f"Save Folder: {name}", mustexist=True)
+
+        # Return if no folder is selected.
+        if f is None:
+            return
+        if f == "":
+            return
+
+        path: str = os.path.join(f, name)
+        self.add_folder_download(conn, data["name"], "Download in queue...", path)
+
     def open(self):
         self.selectWindow = Tk()
         self.theme(self.selectWindow)
@@ -526,13 +578,28 @@ class QCopyOverPC(Tk):
         self.selectWindow.mainloop()
 
 
-    def openfile(self):
+    def set_limits(self):
+        """
+        Asks the upload and download rate limits, running transfers use the new limits immediately.
+        @author: Quinten Jungblut
+        """
+
         # Return if there's no connection.
         if self.connection is None:
             return
 
-        # Return if there's already a upload
-        if len(self.connection.uploaders()) >= 1:
+        for name, limiter in (("Upload", self.connection.uploadLimiter), ("Download", self.connection.downloadLimiter)):
+            rate = simpledialog.askfloat(f"{name} Limit", f"Enter the {name.lower()} limit in MB/s, 0 for unlimited.",
+                                         initialvalue=(limiter.rate or 0) / 1048576, minvalue=0)
+
+            # Keep the limit if the dialog is cancelled.
+            if rate is None:
+                continue
+            limiter.rate = rate * 1048576
+
+    def openfile(self):
+        # Return if there's no connection.
+        if self.connection is None:
             return
 
         # Ask for file to upload.
@@ -551,11 +618,8 @@ class QCopyOverPC(Tk):
             # Data to send
             data_send = {"type": "file", "filename": os.path.split(str(f.name))[-1]}
 
-            # Queue the upload
-            self.connection.up_queue_all(data_send)
-
-            # Add item
-            self.add_file_upload(data_send["filename"], "Upload in queue...", f.name)
+            # Add item, and schedule the upload. The offer is sent when the upload starts.
+            self.add_file_upload(data_send["filename"], "Upload in queue...", f.name, data_send)
             del data_send
 
     def openfolder(self):
@@ -563,10 +627,6 @@ class QCopyOverPC(Tk):
         if self.connection is None:
             return
 
-        # Return if there's already a upload.
-        if len(self.connection.uploaders()) >= 1:
-            return
-
         # Ask for folder to upload.
         files = [('Any File', f'*.*')]
         f: str = filedialog.askdirectory(title=f"Open Folder for Upload...", mustexist=True)
@@ -582,11 +642,8 @@ class QCopyOverPC(Tk):
             # Data to send
             data_send = {"type": "folder", "name": os.path.split(str(f))[-1]}
 
-            # Queue the upload
-            self.connection.up_queue_all(data_send)
-
-            # Add item
-            self.add_folder_upload(data_send["filename"], "Upload in queue...", f)
+            # Add item, and schedule the upload. The offer is sent when the upload starts.
+            self.add_folder_upload(data_send["name"], "Upload in queue...", f, data_send)
             del data_send
 
     def do(self, conn: socket, data: object):
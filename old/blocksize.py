@@ -0,0 +1,101 @@
+from time import perf_counter
+
+
+class BlockSizer(object):
+    """
+    Sizes the blocks of an upload from the measured throughput and round trip time.
+    A block should take about the target time to send: on fast links blocks grow to several megabytes, so fewer
+    blocks and frames are handled per second, and on slow links they shrink, so the progress still moves several times
+    per second. A block that takes much longer than expected, like after packet loss, halves the block size at once.
+    @author: Quinten Jungblut
+    """
+
+    # Blocks are a multiple of this size.
+    alignment = 4096
+
+    def __init__(self, initial: int = 65536, *, minimum: int = 16384, maximum: int = 8 * 1024 * 1024, target: float = 0.1, rtt: float = 0.0):
+        """
+        @param initial: the first block size.
+        @param minimum: the smallest block size.
+        @param maximum: the largest block size.
+        @param target: the seconds a block should take to send.
+        @param rtt: the round trip time of the connection, if already measured.
+        """
+
+        self.minimum: int = minimum
+        self.maximum: int = maximum
+        self.target: float = target
+        self.rtt: float = rtt
+
+        # Smoothed throughput in bytes per second, None until the first block was sent.
+        self.throughput = None
+        self.size: int = self._clamp(initial)
+
+        self._start = 0.0
+
+    @classmethod
+    def fixed(cls, size: int) -> 'BlockSizer':
+        """
+        Returns a block sizer that doesn't adapt, like for benchmarks.
+
+        @param size: the block size.
+        @return: the block sizer.
+        """
+
+        return cls(size, minimum=size, maximum=size)
+
+    def _clamp(self, size: int) -> int:
+        if self.minimum == self.maximum:
+            return self.minimum
+        return min(max(int(size) // self.alignment * self.alignment, self.minimum), self.maximum)
+
+    def observe_rtt(self, seconds: float):
+        """
+        Adds a round trip measurement, like the time until a reply of the receiver. Replies include the time the
+        receiver spent on the request, so the lowest measurement is kept.
+
+        @param seconds: the measured round trip time.
+        """
+
+        self.rtt = seconds if not self.rtt else min(self.rtt, seconds)
+
+    def start(self):
+        """
+        Marks the start of sending a block.
+        """
+
+        self._start = perf_counter()
+
+    def sent(self, size: int):
+        """
+        Marks the end of sending a block, and adapts the block size.
+
+        @param size: the amount of bytes sent.
+        """
+
+        self.update(size, perf_counter() - self._start)
+
+    def update(self, size: int, seconds: float):
+        """
+        Adapts the block size to a measurement.
+
+        @param size: the amount of bytes sent.
+        @param seconds: the time it took.
+        """
+
+        seconds = max(seconds, 1e-6)
+        rate = size / seconds
+        self.throughput = rate if self.throughput is None else 0.7 * self.throughput + 0.3 * rate
+
+        # On links with a long round trip, a block covers at least one round trip, so the socket buffer stays full.
+        target = max(self.target, self.rtt)
+        if seconds > 4 * target and size >= self.size:
+            self.size = self._clamp(min(self.size // 2, rate * target))
+            self.throughput = rate
+            return
+
+        # Grow at most twice per block, a burst into an empty socket buffer is no measurement of the link.
+        self.size = self._clamp(min(self.throughput * target, self.size * 2))
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} size={self.size} throughput={self.throughput} rtt={self.rtt}>"
@@ -0,0 +1,137 @@
+import os
+import zlib
+from hashlib import blake2b
+from math import isqrt
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Modulus of the adler32 weak checksum.
+_MOD = 65521
+
+
+def block_size_for(size: int) -> int:
+    """
+    Returns the signature block size for a file, about the square root of the file size like rsync.
+
+    @param size: the file size.
+    @return: the block size, from 2 KiB to 128 KiB.
+    """
+
+    return min(max(isqrt(size) & ~1023, 2048), 131072)
+
+
+def strong_hash(data) -> bytes:
+    return blake2b(data, digest_size=16).digest()
+
+
+def signature(path: str) -> Tuple[int, int, List[List]]:
+    """
+    Calculates the block signatures of an existing file, the adler32 weak checksum and BLAKE2b strong hash per block.
+
+    @param path: the path of the file.
+    @return: the file size, the block size and the [weak, strong] signatures.
+    """
+
+    size = os.path.getsize(path)
+    block_size = block_size_for(size)
+    blocks = []
+    buffer = memoryview(bytearray(block_size))
+    with open(path, "rb") as fd:
+        while True:
+            read = fd.readinto(buffer)
+            if not read:
+                break
+            blocks.append([zlib.adler32(buffer[:read]), strong_hash(buffer[:read])])
+    return size, block_size, blocks
+
+
+class DeltaGenerator(object):
+    """
+    Finds the blocks of a signature in a new version of the file, and yields copy instructions and literal ranges.
+
+    Blocks are looked up at every block boundary with the C adler32. After a miss the checksum is rolled byte by byte
+    for two blocks, which finds the blocks again after an insertion or deletion. Past that it steps a block at a time,
+    so a file that changed completely is scanned at block speed instead of byte speed.
+    """
+
+    def __init__(self, size: int, block_size: int, blocks: List[List]):
+        self.size: int = size
+        self.blockSize: int = block_size
+        self._blocks: Dict[int, List[Tuple[int, bytes]]] = {}
+        for index, (weak, strong) in enumerate(blocks):
+            self._blocks.setdefault(weak, []).append((index, strong))
+
+        # The last block is shorter when the size isn't a multiple of the block size.
+        self._tailLength = size % block_size if blocks else 0
+        self._tailIndex = len(blocks) - 1
+
+    def _match(self, weak: int, data, pos: int, length: int) -> Optional[int]:
+        candidates = self._blocks.get(weak)
+        if candidates is None:
+            return None
+        strong = strong_hash(data[pos:pos + length])
+        for index, candidate in candidates:
+            if candidate == strong:
+                return index
+        return None
+
+    def generate(self, data, size: int) -> Iterator[Tuple]:
+        """
+        Generates the delta of the new file.
+
+        @param data: the new file data, like a mmap.
+        @param size: the size of the new file.
+        @return: iterator of ("copy", old_offset, new_offset, length) and ("literal", start, end) tuples.
+        """
+
+        bs = self.blockSize
+        pos = 0
+        literal = 0
+        weak: Optional[int] = None
+        budget = 2 * bs
+        while self._blocks and pos + bs <= size:
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + bs])
+            index = self._match(weak, data, pos, bs)
+            if index is not None:
+                if literal < pos:
+                    yield "literal", literal, pos
+                yield "copy", index * bs, pos, bs
+                pos += bs
+                literal = pos
+                weak = None
+                budget = 2 * bs
+            elif budget > 0 and pos + bs < size:
+                # Roll the window one byte.
+                x_out, x_in = data[pos], data[pos + bs]
+                a = ((weak & 0xffff) - x_out + x_in) % _MOD
+                b = ((weak >> 16) - bs * x_out + a - 1) % _MOD
+                weak = (b << 16) | a
+                pos += 1
+                budget -= 1
+            else:
+                pos += bs
+                weak = None
+
+        # The short last block can only match at the end of the new file.
+        tail = size - pos
+        if self._tailLength and tail == self._tailLength and \
+                self._match(zlib.adler32(data[pos:size]), data, pos, tail) == self._tailIndex:
+            if literal < pos:
+                yield "literal", literal, pos
+            yield "copy", self._tailIndex * bs, pos, tail
+            literal = size
+        if literal < size:
+            yield "literal", literal, size
+
+
+def merge_copies(copies: List[List[int]], old_offset: int, new_offset: int, length: int):
+    """
+    Adds a copy instruction, merged with the previous one when both ranges are contiguous.
+    """
+
+    if copies:
+        last = copies[-1]
+        if last[0] + last[2] == old_offset and last[1] + last[2] == new_offset:
+            last[2] += length
+            return
+    copies.append([old_offset, new_offset, length])
@@ -1,17 +1,65 @@
 import os
 import shutil
 from abc import ABC, abstractmethod
+from hashlib import blake2b
 from socket import socket
-from threading import Thread
+from threading import Thread, Lock, Condition
 from tkinter.ttk import Progressbar
-from typing import Callable, Optional, BinaryIO
+from typing import Callable, Optional, BinaryIO, Dict, List, Set
 from uuid import UUID
 
-from advUtils.network import PacketSystem
+from advUtils.network import PacketSystem, DataBlock, CompressorRegistry
+from old.delta import signature
 from old.gui import DownloadItem, CanvasItem
+from old.integrity import ChunkVerifier, chunk_ranges, file_digest
+from old.manifest import TransferManifest
+from old.store import ContentStore, hash_file
+from old.throttle import RateLimiter, RateShare
 from lib import FileSize
 
 
+def _write_at(fd: BinaryIO, offset: int, data):
+    """
+    Writes data at an offset of the file, with pwrite(...) when the platform has it.
+
+    @param fd: the file, opened for writing without append mode.
+    @param offset: the offset to write at.
+    @param data: the bytes-like data to write.
+    """
+
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        fd.seek(offset)
+        fd.write(data)
+        fd.flush()
+
+
+def _preallocate(fd: BinaryIO, size: int):
+    """
+    Allocates the blocks of a file up front, with posix_fallocate(...) where the platform and file system support it.
+    Otherwise the file is only extended to the size.
+
+    @param fd: the file, opened for writing.
+    @param size: the file size.
+    """
+
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    if os.fstat(fd.fileno()).st_size < size:
+        fd.truncate(size)
+
+
 class PreDownloader(ABC):
     def __init__(self):
         self.path: str
@@ -21,12 +69,27 @@ class PreDownloader(ABC):
         self.onComplete: Callable[[], None]
         self.canvasItem: CanvasItem
 
+        # Extra data streams of the connection, and the condition notified when one is attached, set by the connection
+        # when the download is started.
+        self.streams: Dict[int, PacketSystem] = {}
+        self.streamCondition: Optional[Condition] = None
+
+        # Weight of the download in the bandwidth of the connection, and its share, set by the connection.
+        self.weight: float = 1.0
+        self.throttle: Optional[RateShare] = None
+
+        # Handles the packets of the connection that aren't for the download, set by the connection.
+        self.route: Optional[Callable[[object], None]] = None
+
     @abstractmethod
     def get_downloader(self, is_server: bool, pak: PacketSystem):
         pass
 
 
 class Downloader(ABC):
+    # Replies of this side for the uploads to the peer, they can arrive while a download reads the connection.
+    replyTypes = {"resume", "verified", "resend", "have", "signature", "want", "decline"}
+
     # noinspection PyTypeChecker
     def __init__(self):
         self.message: str = ""
@@ -38,6 +101,27 @@ class Downloader(ABC):
         self.onComplete: Callable[[], None] = None
         self.progressbar: Progressbar = None
 
+        # Share of the download in the rate limiter of the connection.
+        self.throttle: RateShare = RateLimiter().share()
+
+        # Handles the packets of the connection that aren't for the download, like the replies for the uploads to the
+        # peer. They're dropped without a route.
+        self.route: Callable[[object], None] = lambda packet: None
+
+    def recv(self):
+        """
+        Receives the next packet of the download, replies for the uploads to the peer are routed on the way.
+
+        @return: the packet.
+        """
+
+        while True:
+            received = self.conn.recv()
+            if isinstance(received, dict) and received.get("type") in self.replyTypes:
+                self.route(received)
+                continue
+            return received
+
     @abstractmethod
     def download(self):
         pass
@@ -46,6 +130,14 @@ class Downloader(ABC):
     def start(self):
         pass
 
+    def join(self):
+        """
+        Waits until the download is finished.
+        """
+
+        if self._thread is not None:
+            self._thread.join()
+
 
 class PreFileDownloader(PreDownloader):
     """
@@ -71,7 +163,7 @@ class PreFileDownloader(PreDownloader):
         @return: the downloader.
         @author: Quinten Jungblut
         """
-        a = FileDownloader(is_server, pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem)
+        a = FileDownloader(is_server, pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem, streams=self.streams, stream_condition=self.streamCondition, throttle=self.throttle, route=self.route)
         a.start()
         return a
 
@@ -79,22 +171,29 @@ class PreFileDownloader(PreDownloader):
 class FileDownloader(Downloader):
     """
     Downloader, downloads a file.
+    Completed ranges are kept in a manifest, so an interrupted download is resumed when the same file is saved to the
+    same path again. Ranges sent over the extra data streams of the connection are written concurrently at their offsets.
+    The target is preallocated, except for sparse files, which keep their holes.
+    Written chunks are hashed while the download runs, and compared to the digests of the uploader at the end, corrupt
+    chunks are sent again.
     @author: Quinten Jungblut
     """
-    def __init__(self, is_server: bool, pak: PacketSystem, path: str, progressbar: Progressbar, *, canvas_item: DownloadItem, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None):
+    def __init__(self, is_server: bool, pak: PacketSystem, path: str, progressbar: Progressbar, *, canvas_item: DownloadItem, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, streams: Dict[int, PacketSystem] = None, stream_condition: Condition = None, throttle: RateShare = None, route: Callable[[object], None] = None):
         super().__init__()
         self.conn: PacketSystem = pak
+        if throttle is not None:
+            self.throttle = throttle
+        if route is not None:
+            self.route = route
         self.isServer = is_server
+        self.streams: Dict[int, PacketSystem] = {} if streams is None else streams
+        self.streamCondition: Optional[Condition] = stream_condition
+        self.manifest: Optional[TransferManifest] = None
+        self.verifier: Optional[ChunkVerifier] = None
+        self.verifyChunkSize: Optional[int] = None
+        self._progressLock = Lock()
 
         try:
-            if os.path.exists(path):
-                if os.path.isfile(path):
-                    os.remove(path)
-                elif os.path.isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.remove(path)
-            self._fd = open(path, "ab+")
             self._thread: Optional[Thread] = None
 
             self.onError = on_error
@@ -104,17 +203,23 @@ class FileDownloader(Downloader):
             self.progressbar: Progressbar = progressbar
 
             try:
-                uuid = self.conn.recv()
+                uuid = self.recv()
                 if isinstance(uuid, UUID):
                     uuid: UUID
                     self.uuid: UUID = uuid
 
-                size = self.conn.recv()
-                if isinstance(size, int):
-                    size: int
-                    self.fileSize: int = size
+                # Uploaders send the file info, broadcasts only the size.
+                info = self.recv()
+                self.sparse: bool = False
+                if isinstance(info, dict) and info.get("type") == "file-info":
+                    self.fileSize: int = info["size"]
+                    self.sparse = bool(info.get("sparse"))
+                    self.verifyChunkSize = info.get("verify")
+                elif isinstance(info, int):
+                    self.fileSize: int = info
 
                 self.bytesReceived = 0
+                self.open_target(path)
             except Exception as e:
                 self.done = True
                 self.onError(e)
@@ -125,6 +230,73 @@ class FileDownloader(Downloader):
             self.done = True
             on_error(e)
 
+    def open_target(self, path: str):
+        """
+        Opens the target file, and replies the ranges that are kept from an interrupted download of the same file.
+
+        @param path: the target path.
+        """
+
+        self.manifest = TransferManifest.load(self.uuid, path, self.fileSize)
+        if self.manifest is not None:
+            self._fd = open(path, "r+b")
+            tails = self.manifest.tails(self._fd)
+            self.bytesReceived = self.manifest.completed()
+        else:
+            if os.path.exists(path):
+                if os.path.isfile(path):
+                    os.remove(path)
+                elif os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            self._fd = open(path, "w+b")
+            self.manifest = TransferManifest(self.uuid, path, self.fileSize)
+            tails = []
+
+        # Zero blocks are skipped in a new sparse file, its holes read as zeros. Other files get the blocks allocated
+        # up front, so large downloads don't fragment and blocks can be written in any order.
+        self._holes = self.sparse and not tails and not self.manifest.ranges
+        if self.sparse:
+            self._fd.truncate(self.fileSize)
+        else:
+            _preallocate(self._fd, self.fileSize)
+
+        # Kept ranges are verified with the rest of the file.
+        if self.verifyChunkSize:
+            self.verifier = ChunkVerifier(path, self.fileSize, self.verifyChunkSize)
+            for start, end in self.manifest.ranges:
+                self.verifier.add(start, end - start)
+
+        self.conn.send({"type": "resume", "uuid": str(self.uuid), "ranges": self.manifest.ranges, "tails": tails,
+                        "compressors": CompressorRegistry.available()})
+
+    def write_block(self, fd: BinaryIO, block: DataBlock):
+        """
+        Writes a block at its offset, and marks it as completed in the manifest.
+
+        @param fd: the target file.
+        @param block: the received block.
+        """
+
+        self.throttle.consume(len(block.data))
+        if block.zero_block:
+            if not self._holes:
+                zeros = bytes(min(block.length, 1048576))
+                for offset in range(block.offset, block.offset + block.length, len(zeros)):
+                    _write_at(fd, offset, zeros[:block.offset + block.length - offset])
+        else:
+            _write_at(fd, block.offset, block.data)
+        if self.verifier is not None:
+            self.verifier.add(block.offset, block.length)
+        with self._progressLock:
+            self.bytesReceived += block.length
+            self.manifest.add(block.offset, block.offset + block.length)
+            self.manifest.save(fd)
+            self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
+                           f"File size: {FileSize.get_string(self.fileSize)}" + \
+                           (f"\nStreams: {len(self.streams)}" if fd is not self._fd else "")
+
     # noinspection PyUnreachableCode
     def download(self):
         """
@@ -134,31 +306,129 @@ class FileDownloader(Downloader):
         print(f"Expecting to receive: {self.fileSize} Bytes")
         try:
             while True:
-                receive_block = self.conn.recv()
-                if receive_block["type"] == "data":
-                    t_data = receive_block["data"]
-                    block = t_data["data"]
-
-                    self._fd.write(block)
-                    self.bytesReceived += t_data["size"]
-                    self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
-                                   f"File size: {FileSize.get_string(self.fileSize)}"
-                    if t_data["last-block"]:
+                receive_block = self.recv()
+                if isinstance(receive_block, DataBlock):
+                    self.write_block(self._fd, receive_block)
+                    if receive_block.last_block:
                         break
-                    self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
-                                   f"File size: {FileSize.get_string(self.fileSize)}"
+                elif isinstance(receive_block, dict) and receive_block.get("type") == "parallel":
+                    self.download_parallel(receive_block["streams"])
+                    break
+                elif isinstance(receive_block, dict) and receive_block.get("type") == "error" and \
+                        receive_block.get("uuid") == str(self.uuid):
+                    raise ConnectionError("The uploader couldn't send the file")
+                else:
+                    self.route(receive_block)
+            if self.verifier is not None:
+                self.verify()
+
+            missing = self.manifest.missing()
+            if missing:
+                raise ConnectionError(f"Download incomplete, missing {sum(end - start for start, end in missing)} bytes")
             self._fd.close()
+            self.manifest.remove()
             print("Received:", os.path.getsize(self._fd.name), "Bytes")
 
             self.done = True
             self.onComplete()
         except Exception as e:
             self.done = True
+            if self.manifest is not None and not self._fd.closed:
+                self.manifest.save(self._fd, force=True)
+                self._fd.close()
             try:
                 self.conn.send({"type": "error", "error": {"exception": e}})
             except ConnectionError:
                 pass
             self.onError(e)
+        finally:
+            if self.verifier is not None:
+                self.verifier.close()
+
+    def verify(self):
+        """
+        Compares the written chunks to the digests of the uploader, and receives corrupt chunks again until all chunks
+        match.
+        """
+
+        while True:
+            message = self.recv()
+            if not isinstance(message, dict) or message.get("type") not in ("error", "verify"):
+                self.route(message)
+                continue
+            if message.get("type") == "error":
+                raise ConnectionError("The uploader couldn't send the file")
+
+            digests: List[str] = message["digests"]
+            if len(digests) != self.verifier.chunkCount or file_digest(digests) != message["digest"]:
+                raise ValueError("The chunk digests of the uploader are corrupt")
+            self.message = f"Verifying: {FileSize.get_string(self.fileSize)}"
+            received = self.verifier.wait()
+            corrupt = [index for index, digest in enumerate(digests) if received.get(index) != digest]
+            if not corrupt:
+                self.conn.send({"type": "verified", "uuid": str(self.uuid)})
+                return
+
+            # Zero blocks are written out again, the holes of the chunks may hold corrupt data now.
+            self.verifier.reset(corrupt)
+            with self._progressLock:
+                for start, end in chunk_ranges(corrupt, self.verifier.chunkSize, self.fileSize):
+                    self.manifest.discard(start, end)
+                self.bytesReceived = self.manifest.completed()
+            self._holes = False
+            self.conn.send({"type": "resend", "uuid": str(self.uuid), "chunks": corrupt})
+            while True:
+                receive_block = self.recv()
+                if isinstance(receive_block, DataBlock):
+                    self.write_block(self._fd, receive_block)
+                    if receive_block.last_block:
+                        break
+                else:
+                    self.route(receive_block)
+
+    def download_parallel(self, indices: List[int]):
+        """
+        Receives the ranges of the file over the extra data streams, and writes them at their offsets.
+
+        @param indices: the indices of the streams used by the uploader.
+        """
+
+        # The streams are registered by the accept thread, and can arrive just after the connection.
+        if self.streamCondition is not None:
+            with self.streamCondition:
+                self.streamCondition.wait_for(lambda: all(index in self.streams for index in indices), 5.0)
+        missing = [index for index in indices if index not in self.streams]
+        if missing:
+            raise ConnectionError(f"The connection has no data streams {missing}")
+
+        errors: List[Exception] = []
+        threads = [Thread(target=lambda p=self.streams[index]: self._receive_range(p, errors)) for index in indices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _receive_range(self, pak: PacketSystem, errors: List[Exception]):
+        """
+        Receives a range of the file from a stream, until the last block of the range.
+
+        @param pak: the packet-system of the stream.
+        @param errors: list for the exceptions of the stream threads.
+        """
+
+        try:
+            with open(self._fd.name, "r+b") as fd:
+                while True:
+                    receive_block = pak.recv()
+                    if not isinstance(receive_block, DataBlock):
+                        continue
+                    self.write_block(fd, receive_block)
+                    if receive_block.last_block:
+                        return
+        except Exception as e:
+            errors.append(e)
 
     def start(self):
         """
@@ -194,30 +464,41 @@ class PreFolderDownloader(PreDownloader):
         @return: the downloader.
         @author: Quinten Jungblut
         """
-        a = FolderDownloader(is_server, pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem)
+        a = FolderDownloader(is_server, pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem, throttle=self.throttle, route=self.route)
         a.start()
         return a
 
 
 class FolderDownloader(Downloader):
     """
-    Downloader, downloads a file.
+    Downloader, downloads a folder.
+    An existing folder is synced instead of replaced: for every file the signature of the existing version is replied,
+    and the new version is built from the sent blocks and the unchanged blocks of the existing version.
+    Items the uploaded folder doesn't have are removed at the end.
+    Files found in the content store by their hash are linked from there instead of received, and received files are
+    added to it. Batched small files that are already present aren't received again.
     @author: Quinten Jungblut
     """
-    def __init__(self, is_server: bool, pak: PacketSystem, path: str, progressbar: Progressbar, *, canvas_item: DownloadItem, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None):
+    def __init__(self, is_server: bool, pak: PacketSystem, path: str, progressbar: Progressbar, *, canvas_item: DownloadItem, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, throttle: RateShare = None, route: Callable[[object], None] = None):
         super().__init__()
         self._fd: Optional[BinaryIO] = None
         self.conn: PacketSystem = pak
+        if throttle is not None:
+            self.throttle = throttle
+        if route is not None:
+            self.route = route
         self.isServer = is_server
+        self._received: Set[str] = set()
+        # Files the uploader couldn't send, their place in a batch is skipped.
+        self._failed: Set[str] = set()
+        self.store: ContentStore = ContentStore.default()
+
+        # The wanted files of the batch whose contents are expected, as (rel-path, size, hash) lists.
+        self._wantedBatch: List[List] = []
 
         try:
-            if os.path.exists(path):
-                if os.path.isfile(path):
-                    os.remove(path)
-                elif os.path.isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.remove(path)
+            if os.path.exists(path) and not os.path.isdir(path):
+                os.remove(path)
             self._thread: Optional[Thread] = None
 
             self.onError = on_error
@@ -227,12 +508,12 @@ class FolderDownloader(Downloader):
             self.progressbar: Progressbar = progressbar
 
             try:
-                uuid = self.conn.recv()
+                uuid = self.recv()
                 if isinstance(uuid, UUID):
                     uuid: UUID
                     self.uuid: UUID = uuid
 
-                size = self.conn.recv()
+                size = self.recv()
                 if isinstance(size, int):
                     size: int
                     self.fileSize: int = size
@@ -257,33 +538,39 @@ class FolderDownloader(Downloader):
         """
         print(f"Expecting to receive: {self.fileSize} Bytes")
         try:
+            os.makedirs(self.path, exist_ok=True)
             while True:
-                receive_block = self.conn.recv()
-                if receive_block["type"] == "create_file":
+                receive_block = self.recv()
+                if isinstance(receive_block, DataBlock):
+                    self.unpack_batch(receive_block)
+                elif not isinstance(receive_block, dict):
+                    self.route(receive_block)
+                elif receive_block["type"] == "batch":
+                    self.receive_batch(receive_block["files"])
+                elif receive_block["type"] == "create-file":
                     rel_path = receive_block["rel-path"]
-                    self._fd = open(os.path.join(self.path, rel_path), "ab+")
-                if receive_block["type"] == "create_folder":
+                    self._received.add(rel_path)
+                    self.download_file(os.path.join(self.path, rel_path), rel_path, receive_block["size"], receive_block.get("hash"))
+                elif receive_block["type"] == "create-folder":
                     rel_path = receive_block["rel-path"]
-                    os.makedirs(self.path, rel_path)
-                    continue
+                    self._received.add(rel_path)
+                    if os.path.exists(os.path.join(self.path, rel_path)) and not os.path.isdir(os.path.join(self.path, rel_path)):
+                        os.remove(os.path.join(self.path, rel_path))
+                    os.makedirs(os.path.join(self.path, rel_path), exist_ok=True)
+                elif receive_block["type"] == "error" and "rel-path" in receive_block:
+                    # The uploader couldn't read a file, the existing version is kept.
+                    self._received.add(receive_block["rel-path"])
+                    self._failed.add(receive_block["rel-path"])
+                elif receive_block["type"] == "error" and receive_block.get("uuid") == str(self.uuid):
+                    raise ConnectionAbortedError("The uploader couldn't send the folder")
                 elif receive_block["type"] == "end":
                     break
-                while True:
-                    receive_block = self.conn.recv()
-                    if receive_block["type"] == "data-rel-path":
-                        t_data = receive_block["data"]
-                        # rel_path = receive_block["rel-path"]
-                        block = t_data["data"]
-                        self._fd.write(block)
-                        self.bytesReceived += t_data["size"]
-                        if t_data["last-block"]:
-                            self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
-                                           f"File size: {FileSize.get_string(self.fileSize)}"
-                            break
-                    self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
-                                   f"File size: {FileSize.get_string(self.fileSize)}"
-                self._fd.close()
-            print("Received:", os.path.getsize(self._fd.name), "Bytes")
+                else:
+                    self.route(receive_block)
+            self.remove_unreceived()
+            self.store.prune()
+            self.store.save()
+            print("Received:", self.bytesReceived, "Bytes")
 
             self.done = True
             self.onComplete()
@@ -295,6 +582,162 @@ class FolderDownloader(Downloader):
                 pass
             self.onError(e)
 
+    def download_file(self, path: str, rel_path: str, size: int, file_hash: Optional[str] = None):
+        """
+        Downloads a file of the folder, as a delta against the existing version when there is one.
+
+        @param path: the target path.
+        @param rel_path: the path relative to the folder.
+        @param size: the file size.
+        @param file_hash: the content hash announced by the uploader.
+        """
+
+        blob = self.store.get(file_hash, size) if file_hash is not None else None
+        if blob is not None:
+            self.store.link(blob, path)
+            self.conn.send({"type": "have", "uuid": str(self.uuid), "rel-path": rel_path})
+            self.bytesReceived += size
+            return
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            old_size, block_size, blocks = signature(path)
+        else:
+            old_size, block_size, blocks = 0, 0, []
+        self.conn.send({"type": "signature", "uuid": str(self.uuid), "rel-path": rel_path, "size": old_size,
+                        "block-size": block_size, "blocks": blocks, "compressors": CompressorRegistry.available()})
+
+        # Replace instead of truncate, the existing file can be a hard link of a blob in the store.
+        part = path + ".part" if blocks else path
+        if os.path.exists(part):
+            os.remove(part)
+        literal = 0
+        self._fd = open(part, "wb")
+        try:
+            while True:
+                receive_block = self.recv()
+                if isinstance(receive_block, DataBlock):
+                    self.throttle.consume(len(receive_block.data))
+                    _write_at(self._fd, receive_block.offset, receive_block.data)
+                    self.bytesReceived += receive_block.length
+                    literal += receive_block.length
+                    self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
+                                   f"File size: {FileSize.get_string(self.fileSize)}"
+                    if receive_block.last_block:
+                        break
+                elif isinstance(receive_block, dict) and receive_block.get("type") == "delta":
+                    copies = receive_block["copies"]
+                    if not literal and copies == [[0, 0, size]] and old_size == size:
+                        # Unchanged, keep the existing version.
+                        self._fd.close()
+                        os.remove(part)
+                        self.bytesReceived += size
+                        self.add_to_store(path, rel_path, file_hash)
+                        return
+                    with open(path, "rb") as old:
+                        for old_offset, new_offset, length in copies:
+                            old.seek(old_offset)
+                            for offset in range(0, length, 1048576):
+                                _write_at(self._fd, new_offset + offset, old.read(min(1048576, length - offset)))
+                            self.bytesReceived += length
+                    break
+                elif isinstance(receive_block, dict) and receive_block.get("type") == "error":
+                    # The uploader couldn't send the file, and continues with the next one.
+                    self._fd.close()
+                    os.remove(part)
+                    return
+                else:
+                    self.route(receive_block)
+            self._fd.truncate(size)
+        finally:
+            self._fd.close()
+        if part != path:
+            os.replace(part, path)
+        self.add_to_store(path, rel_path, file_hash)
+
+    def add_to_store(self, path: str, rel_path: str, file_hash: Optional[str]):
+        """
+        Verifies a received file against its announced content hash, and adds it to the content store.
+
+        @param path: the path of the received file.
+        @param rel_path: the path relative to the folder.
+        @param file_hash: the content hash announced by the uploader.
+        """
+
+        if file_hash is None:
+            return
+        if hash_file(path) != file_hash:
+            raise ValueError(f"Content hash mismatch for received file: {rel_path}")
+        self.store.add(file_hash, path)
+
+    def receive_batch(self, files: List[List]):
+        """
+        Replies the files of a batch that aren't present yet, files with the same content are kept or linked.
+
+        @param files: the [rel-path, size, hash] lists of the batch.
+        """
+
+        wanted = []
+        self._wantedBatch = []
+        for index, (rel_path, size, file_hash) in enumerate(files):
+            self._received.add(rel_path)
+            path = os.path.join(self.path, rel_path)
+            if os.path.isfile(path) and os.path.getsize(path) == size and hash_file(path) == file_hash:
+                self.bytesReceived += size
+                continue
+            blob = self.store.get(file_hash, size)
+            if blob is not None:
+                self.store.link(blob, path)
+                self.bytesReceived += size
+                continue
+            wanted.append(index)
+            self._wantedBatch.append([rel_path, size, file_hash])
+        self.conn.send({"type": "want", "uuid": str(self.uuid), "files": wanted,
+                        "compressors": CompressorRegistry.available()})
+
+    def unpack_batch(self, block: DataBlock):
+        """
+        Writes the files of a batch from the contents block.
+
+        @param block: the block with the concatenated contents of the wanted files.
+        """
+
+        self.throttle.consume(len(block.data))
+        view = memoryview(block.data)
+        offset = 0
+        for rel_path, size, file_hash in self._wantedBatch:
+            data = view[offset:offset + size]
+            offset += size
+            if rel_path in self._failed:
+                continue
+            if blake2b(data, digest_size=32).hexdigest() != file_hash:
+                raise ValueError(f"Content hash mismatch for received file: {rel_path}")
+            path = os.path.join(self.path, rel_path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            with open(path, "wb") as fd:
+                fd.write(data)
+            self.bytesReceived += size
+        self._wantedBatch = []
+        self.message = f"Downloaded: {FileSize.get_string(self.bytesReceived)}\n" \
+                       f"File size: {FileSize.get_string(self.fileSize)}"
+
+    def remove_unreceived(self):
+        """
+        Removes the items of the existing folder that the uploaded folder doesn't have.
+        """
+
+        for root, dirs, files in os.walk(self.path, topdown=False):
+            for name in files:
+                if os.path.relpath(os.path.join(root, name), self.path).replace(os.sep, "/") not in self._received:
+                    os.remove(os.path.join(root, name))
+            for name in dirs:
+                if os.path.relpath(os.path.join(root, name), self.path).replace(os.sep, "/") not in self._received:
+                    shutil.rmtree(os.path.join(root, name))
+
     def start(self):
         """
         Starts a download.
@@ -0,0 +1,189 @@
+import os
+from hashlib import blake2b
+from queue import Queue
+from threading import Thread, Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+
+def chunk_digest(data) -> str:
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(digests: List[str]) -> str:
+    """
+    Returns the digest of a whole file, the BLAKE2b hash of its chunk digests.
+
+    @param digests: the hex digests of the chunks.
+    @return: the hex digest.
+    """
+
+    hash_ = blake2b(digest_size=32)
+    for digest in digests:
+        hash_.update(bytes.fromhex(digest))
+    return hash_.hexdigest()
+
+
+def chunk_ranges(chunks: List[int], chunk_size: int, size: int) -> List[Tuple[int, int]]:
+    """
+    Returns the byte ranges of chunks, adjacent chunks are merged.
+
+    @param chunks: the sorted chunk indices.
+    @param chunk_size: the chunk size.
+    @param size: the file size.
+    @return: the ranges.
+    """
+
+    ranges: List[Tuple[int, int]] = []
+    for index in chunks:
+        start, end = index * chunk_size, min((index + 1) * chunk_size, size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+class FileHasher(object):
+    """
+    Hashes the chunks of a file on a worker thread, while the file is sent.
+    The file is read again for this, from the page cache, so blocks sent with sendfile(...) are hashed too.
+    @author: Quinten Jungblut
+    """
+
+    def __init__(self, path: str, size: int, chunk_size: int):
+        self.path: str = path
+        self.size: int = size
+        self.chunkSize: int = chunk_size
+
+        self._digests: List[str] = []
+        self._error: Optional[Exception] = None
+        self._thread = Thread(target=lambda: self._run(), name="FileHasher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        try:
+            buffer = memoryview(bytearray(self.chunkSize))
+            with open(self.path, "rb") as fd:
+                for _ in range(0, self.size, self.chunkSize):
+                    read = fd.readinto(buffer)
+                    self._digests.append(chunk_digest(buffer[:read]))
+        except Exception as e:
+            self._error = e
+
+    def result(self) -> List[str]:
+        """
+        Waits until the file is hashed.
+
+        @return: the hex digests of the chunks.
+        """
+
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._digests
+
+
+class ChunkVerifier(object):
+    """
+    Hashes the chunks of a received file on a worker thread, as soon as they're written.
+    A chunk is hashed when the bytes written to it add up to its length, and again when it's written after that, like
+    when ranges are sent again. Chunks that never added up are hashed when the digests are needed.
+    @author: Quinten Jungblut
+    """
+
+    def __init__(self, path: str, size: int, chunk_size: int):
+        self.path: str = path
+        self.size: int = size
+        self.chunkSize: int = chunk_size
+        self.chunkCount: int = -(-size // chunk_size)
+
+        self.digests: Dict[int, str] = {}
+        self._written: Dict[int, int] = {}
+        self._queued: Set[int] = set()
+        self._lock = Lock()
+        self._queue: Queue = Queue()
+        self._fd = open(path, "rb")
+        self._thread = Thread(target=lambda: self._run(), name="ChunkVerifier", daemon=True)
+        self._thread.start()
+
+    def _length(self, index: int) -> int:
+        return min(self.chunkSize, self.size - index * self.chunkSize)
+
+    def _read(self, index: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self._fd.fileno(), self._length(index), index * self.chunkSize)
+        self._fd.seek(index * self.chunkSize)
+        return self._fd.read(self._length(index))
+
+    def _run(self):
+        while True:
+            index = self._queue.get()
+            try:
+                if index is None:
+                    return
+                with self._lock:
+                    self._queued.discard(index)
+                digest = chunk_digest(self._read(index))
+                with self._lock:
+                    self.digests[index] = digest
+            except OSError:
+                pass
+            finally:
+                self._queue.task_done()
+
+    def _enqueue(self, index: int):
+        if index not in self._queued:
+            self._queued.add(index)
+            self._queue.put(index)
+
+    def add(self, offset: int, length: int):
+        """
+        Counts bytes written to the file, after they're written.
+
+        @param offset: the offset of the bytes.
+        @param length: the amount of bytes.
+        """
+
+        end = min(offset + length, self.size)
+        with self._lock:
+            while offset < end:
+                index = offset // self.chunkSize
+                chunk_end = min((index + 1) * self.chunkSize, end)
+                self._written[index] = self._written.get(index, 0) + chunk_end - offset
+                if self._written[index] >= self._length(index):
+                    self.digests.pop(index, None)
+                    self._enqueue(index)
+                offset = chunk_end
+
+    def reset(self, chunks: List[int]):
+        """
+        Forgets chunks that will be sent again.
+
+        @param chunks: the chunk indices.
+        """
+
+        with self._lock:
+            for index in chunks:
+                self._written.pop(index, None)
+                self.digests.pop(index, None)
+
+    def wait(self) -> Dict[int, str]:
+        """
+        Waits until all chunks are hashed.
+
+        @return: the hex digests by chunk index.
+        """
+
+        with self._lock:
+            for index in range(self.chunkCount):
+                if index not in self.digests:
+                    self._enqueue(index)
+        self._queue.join()
+        return self.digests
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._fd.close()
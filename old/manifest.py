@@ -0,0 +1,206 @@
+import json
+import os
+from bisect import bisect_left
+from hashlib import blake2b
+from time import monotonic
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+
+class TransferManifest(object):
+    """
+    Manifest of the completed ranges of a download, persisted so an interrupted download can be resumed.
+    @author: Quinten Jungblut
+    """
+
+    directory = os.path.join(os.path.expanduser("~"), ".qcopyoverpc", "manifests")
+
+    # Minimal seconds between two saves, and size of the tail that is re-verified on resume.
+    saveInterval = 2.0
+    tailSize = 65536
+
+    def __init__(self, uuid: UUID, path: str, size: int, ranges: List[List[int]] = None):
+        self.uuid: UUID = uuid
+        self.path: str = path
+        self.size: int = size
+        self.ranges: List[List[int]] = [] if ranges is None else ranges
+
+        self._lastSave = monotonic()
+
+    @property
+    def file(self) -> str:
+        """
+        Returns the file of the manifest.
+
+        @return: the path to the manifest file.
+        """
+
+        return os.path.join(self.directory, f"{self.uuid}.json")
+
+    @classmethod
+    def load(cls, uuid: UUID, path: str, size: int) -> Optional['TransferManifest']:
+        """
+        Loads the manifest of a download, when the download went to the same target with the same size.
+
+        @param uuid: the transfer uuid.
+        @param path: the target path of the download.
+        @param size: the file size of the download.
+        @return: the manifest, or None if the download can't be resumed.
+        """
+
+        manifest = cls(uuid, path, size)
+        try:
+            with open(manifest.file, "r") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("path") != path or data.get("size") != size or not os.path.isfile(path):
+            return None
+        manifest.ranges = [[start, end] for start, end in data.get("ranges", []) if 0 <= start < end <= size]
+        if manifest.ranges and os.path.getsize(path) < manifest.ranges[-1][1]:
+            return None
+        return manifest
+
+    def add(self, start: int, end: int):
+        """
+        Marks a range as completed.
+
+        @param start: the start offset.
+        @param end: the end offset.
+        """
+
+        if start >= end:
+            return
+
+        # Blocks mostly arrive in order, and extend the last range.
+        if self.ranges and self.ranges[-1][0] <= start <= self.ranges[-1][1]:
+            self.ranges[-1][1] = max(self.ranges[-1][1], end)
+            return
+
+        index = bisect_left(self.ranges, [start, end])
+        self.ranges.insert(index, [start, end])
+        merged: List[List[int]] = []
+        for range_ in self.ranges:
+            if merged and range_[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_[1])
+            else:
+                merged.append(range_)
+        self.ranges = merged
+
+    def discard(self, start: int, end: int):
+        """
+        Marks a range as not completed, like a range that failed verification.
+
+        @param start: the start offset.
+        @param end: the end offset.
+        """
+
+        self.ranges = _subtract(self.ranges, start, end)
+
+    def completed(self) -> int:
+        """
+        Returns the amount of completed bytes.
+
+        @return: the completed bytes.
+        """
+
+        return sum(end - start for start, end in self.ranges)
+
+    def missing(self) -> List[Tuple[int, int]]:
+        """
+        Returns the ranges that are not completed.
+
+        @return: the missing ranges.
+        """
+
+        missing = []
+        offset = 0
+        for start, end in self.ranges:
+            if start > offset:
+                missing.append((offset, start))
+            offset = end
+        if offset < self.size:
+            missing.append((offset, self.size))
+        return missing
+
+    def tails(self, fd) -> List[List]:
+        """
+        Hashes the tail of every completed range, the tail is the last write before an interruption.
+
+        @param fd: the target file, opened for reading.
+        @return: list of [offset, length, digest] lists.
+        """
+
+        tails = []
+        for start, end in self.ranges:
+            offset = max(start, end - self.tailSize)
+            fd.seek(offset)
+            tails.append([offset, end - offset, blake2b(fd.read(end - offset), digest_size=16).hexdigest()])
+        return tails
+
+    def save(self, fd=None, force: bool = False):
+        """
+        Saves the manifest, at most once per save interval unless forced.
+        The target file is synced first, so the manifest never covers data that isn't on disk.
+
+        @param fd: the target file, to sync before saving.
+        @param force: save even if the interval didn't pass.
+        """
+
+        if not force and monotonic() - self._lastSave < self.saveInterval:
+            return
+        self._lastSave = monotonic()
+
+        if fd is not None:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.file + ".tmp", "w") as manifest:
+            json.dump({"uuid": str(self.uuid), "path": self.path, "size": self.size, "ranges": self.ranges}, manifest)
+        os.replace(self.file + ".tmp", self.file)
+
+    def remove(self):
+        """
+        Removes the manifest, after the download completed.
+        """
+
+        try:
+            os.remove(self.file)
+        except FileNotFoundError:
+            pass
+
+
+def resume_ranges(fd, size: int, reply: dict) -> List[Tuple[int, int]]:
+    """
+    Returns the ranges the sender still has to send, from the resume reply of the receiver.
+    Tails that don't match the sender's file are sent again.
+
+    @param fd: the source file, opened for reading.
+    @param size: the file size.
+    @param reply: the resume reply.
+    @return: the ranges to send.
+    """
+
+    have = TransferManifest(UUID(reply["uuid"]), "", size)
+    for start, end in reply.get("ranges", []):
+        have.add(max(0, start), min(size, end))
+    for offset, length, digest in reply.get("tails", []):
+        fd.seek(offset)
+        if blake2b(fd.read(length), digest_size=16).hexdigest() != digest:
+            have.ranges = _subtract(have.ranges, offset, offset + length)
+    return have.missing()
+
+
+def _subtract(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    result = []
+    for a, b in ranges:
+        if b <= start or a >= end:
+            result.append([a, b])
+            continue
+        if a < start:
+            result.append([a, start])
+        if b > end:
+            result.append([end, b])
+    return result
@@ -0,0 +1,117 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, NamedTuple, Set, Tuple
+
+
+class ScanEntry(NamedTuple):
+    """
+    Entry of a folder manifest.
+    """
+
+    rel_path: str
+    path: str
+    size: int
+    mtime_ns: int
+    is_dir: bool
+
+
+class FolderScanner(object):
+    """
+    Scans a folder tree once with os.scandir, for both the size calculation and the upload.
+    Folders are listed in parallel by a thread pool, which mostly helps on network file systems where every listing is
+    a round trip. Symbolic links are followed like os.path.isdir does, a folder that was already scanned is skipped.
+    @author: Quinten Jungblut
+    """
+
+    # Folders listed at once.
+    workers = 8
+
+    def __init__(self, path: str, *, workers: int = None, on_progress: Callable[[int, int], None] = lambda files, size: None):
+        self.path: str = path
+        self.workers: int = self.workers if workers is None else workers
+        self.onProgress: Callable[[int, int], None] = on_progress
+
+        self.errors: List[OSError] = []
+        self.totalSize: int = 0
+        self.fileCount: int = 0
+
+        self._visited: Set[Tuple[int, int]] = set()
+        self._lock = Lock()
+
+    def _list(self, path: str, rel_path: str) -> Tuple[List[ScanEntry], List[Tuple[str, str]]]:
+        entries: List[ScanEntry] = []
+        folders: List[Tuple[str, str]] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    rel = f"{rel_path}/{entry.name}" if rel_path else entry.name
+                    try:
+                        if entry.is_dir():
+                            # Only symbolic links can make a loop, other folders don't need the extra stat call.
+                            if entry.is_symlink():
+                                stat = entry.stat()
+                                with self._lock:
+                                    if (stat.st_dev, stat.st_ino) in self._visited:
+                                        continue
+                                    self._visited.add((stat.st_dev, stat.st_ino))
+                            entries.append(ScanEntry(rel, entry.path, 0, 0, True))
+                            folders.append((entry.path, rel))
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            entries.append(ScanEntry(rel, entry.path, stat.st_size, stat.st_mtime_ns, False))
+                    except OSError as e:
+                        self.errors.append(e)
+        except OSError as e:
+            self.errors.append(e)
+        return entries, folders
+
+    def scan(self) -> List[ScanEntry]:
+        """
+        Scans the folder.
+
+        @return: the entries in upload order, every folder comes before its contents.
+        """
+
+        stat = os.stat(self.path)
+        self._visited.add((stat.st_dev, stat.st_ino))
+        listings: Dict[str, List[ScanEntry]] = {}
+
+        def done(rel_path: str, entries: List[ScanEntry]):
+            listings[rel_path] = entries
+            for entry in entries:
+                if not entry.is_dir:
+                    self.fileCount += 1
+                    self.totalSize += entry.size
+            self.onProgress(self.fileCount, self.totalSize)
+
+        if self.workers <= 1:
+            pending = [(self.path, "")]
+            while pending:
+                path, rel_path = pending.pop()
+                entries, folders = self._list(path, rel_path)
+                done(rel_path, entries)
+                pending.extend(folders)
+        else:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix="FolderScanner") as executor:
+                pending = {executor.submit(self._list, self.path, ""): ""}
+                while pending:
+                    future = next(iter(pending))
+                    rel_path = pending.pop(future)
+                    entries, folders = future.result()
+                    done(rel_path, entries)
+                    for path, rel in folders:
+                        pending[executor.submit(self._list, path, rel)] = rel
+
+        # Without recursion, trees can be deeper than the recursion limit.
+        manifest: List[ScanEntry] = []
+        stack = [iter(listings[""])]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+            manifest.append(entry)
+            if entry.is_dir:
+                stack.append(iter(listings.get(entry.rel_path, [])))
+        return manifest
@@ -0,0 +1,230 @@
+import heapq
+from itertools import count
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class Transfer(object):
+    """
+    Transfer of the scheduler, the packets that start the transfer on a peer, like the pre-uploader.
+    @author: Quinten Jungblut
+    """
+
+    QUEUED = "queued"
+    PAUSED = "paused"
+    RUNNING = "running"
+    DONE = "done"
+
+    def __init__(self, conn, items: List[Any], size: Optional[int] = None, priority: int = 0):
+        """
+        @param conn: the connection of the peer.
+        @param items: the packets to queue for the peer when the transfer starts.
+        @param size: the size of the transfer, None if unknown, like for folders.
+        @param priority: the priority, higher priorities start first.
+        """
+
+        self.conn = conn
+        self.items: List[Any] = items
+        self.size: Optional[int] = size
+        self.priority: int = priority
+        self.state: str = Transfer.QUEUED
+
+        self._seq = 0
+        self._version = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} state={self.state} priority={self.priority} size={self.size}>"
+
+
+class TransferScheduler(object):
+    """
+    Priority queue of the transfers to the peers, with a limit of running transfers per peer, which can be set per peer.
+    Transfers with a higher priority start first. With the same priority, files up to the small-file size start before
+    larger ones, smallest first, so a queue of small files isn't stuck behind a large one. The rest starts in order.
+    Queued transfers can be paused, resumed and moved.
+    @author: Quinten Jungblut
+    """
+
+    def __init__(self, dispatch: Callable[[Any, Any], None], *, concurrency: int = 1, small_file_size: int = 16 * 1024 * 1024):
+        """
+        @param dispatch: queues a packet for a peer, called with the connection and the packet.
+        @param concurrency: the amount of running transfers per peer.
+        @param small_file_size: the size up to which files are started smallest first.
+        """
+
+        self.dispatch: Callable[[Any, Any], None] = dispatch
+        self.concurrency: int = concurrency
+        self.smallFileSize: int = small_file_size
+
+        self._queues: Dict[Any, List[Tuple[tuple, int, Transfer]]] = {}
+        self._running: Dict[Any, List[Transfer]] = {}
+        self._concurrency: Dict[Any, int] = {}
+        self._counter = count()
+        self._lock = Lock()
+
+    def _key(self, transfer: Transfer) -> tuple:
+        if transfer.size is not None and transfer.size <= self.smallFileSize:
+            return -transfer.priority, 0, transfer.size, transfer._seq
+        return -transfer.priority, 1, 0, transfer._seq
+
+    def _push(self, transfer: Transfer):
+        # Entries aren't removed from the heap, a changed transfer gets a new entry and the old one is skipped.
+        transfer._version += 1
+        heapq.heappush(self._queues.setdefault(transfer.conn, []), (self._key(transfer), transfer._version, transfer))
+
+    def submit(self, transfer: Transfer):
+        """
+        Queues a transfer, it starts immediately when the peer has room.
+
+        @param transfer: the transfer.
+        """
+
+        with self._lock:
+            transfer._seq = next(self._counter)
+            transfer.state = Transfer.QUEUED
+            self._push(transfer)
+            started = self._start(transfer.conn)
+        self._dispatch(started)
+
+    def finished(self, transfer: Transfer):
+        """
+        Marks a transfer as finished, completed or failed, and starts the next transfers of the peer.
+
+        @param transfer: the transfer.
+        """
+
+        with self._lock:
+            if transfer.state == Transfer.DONE:
+                return
+            running = self._running.get(transfer.conn, [])
+            if transfer in running:
+                running.remove(transfer)
+            transfer.state = Transfer.DONE
+            transfer._version += 1
+            started = self._start(transfer.conn)
+        self._dispatch(started)
+
+    def on_finished(self, transfer: Transfer, callback: Callable) -> Callable:
+        """
+        Wraps a complete or error callback of a transfer, so the transfer is marked as finished first.
+
+        @param transfer: the transfer.
+        @param callback: the callback.
+        @return: the wrapped callback.
+        """
+
+        def finished(*args):
+            self.finished(transfer)
+            return callback(*args)
+
+        return finished
+
+    def pause(self, transfer: Transfer) -> bool:
+        """
+        Pauses a queued transfer, it doesn't start until it's resumed.
+
+        @param transfer: the transfer.
+        @return: True if the transfer was paused, running transfers can't be paused.
+        """
+
+        with self._lock:
+            if transfer.state != Transfer.QUEUED:
+                return False
+            transfer.state = Transfer.PAUSED
+            transfer._version += 1
+            return True
+
+    def resume(self, transfer: Transfer):
+        """
+        Resumes a paused transfer, it keeps its place in the queue.
+
+        @param transfer: the transfer.
+        """
+
+        with self._lock:
+            if transfer.state != Transfer.PAUSED:
+                return
+            transfer.state = Transfer.QUEUED
+            self._push(transfer)
+            started = self._start(transfer.conn)
+        self._dispatch(started)
+
+    def move(self, transfer: Transfer, priority: int):
+        """
+        Changes the priority of a queued or paused transfer.
+
+        @param transfer: the transfer.
+        @param priority: the new priority.
+        """
+
+        with self._lock:
+            transfer.priority = priority
+            if transfer.state == Transfer.QUEUED:
+                self._push(transfer)
+
+    def move_to_front(self, transfer: Transfer):
+        """
+        Moves a transfer before the other queued transfers of the peer.
+
+        @param transfer: the transfer.
+        """
+
+        self.move(transfer, max([other.priority for other in self.queued(transfer.conn)] + [transfer.priority]) + 1)
+
+    def move_to_back(self, transfer: Transfer):
+        """
+        Moves a transfer after the other queued transfers of the peer.
+
+        @param transfer: the transfer.
+        """
+
+        self.move(transfer, min([other.priority for other in self.queued(transfer.conn)] + [transfer.priority]) - 1)
+
+    def set_concurrency(self, conn, concurrency: int):
+        """
+        Sets the amount of running transfers of a peer, like for a connection that runs transfers side by side.
+
+        @param conn: the connection of the peer.
+        @param concurrency: the amount of running transfers.
+        """
+
+        with self._lock:
+            self._concurrency[conn] = concurrency
+            started = self._start(conn)
+        self._dispatch(started)
+
+    def queued(self, conn) -> List[Transfer]:
+        """
+        Returns the queued transfers of a peer, in the order they start.
+
+        @param conn: the connection of the peer.
+        @return: the transfers.
+        """
+
+        with self._lock:
+            entries = sorted(self._queues.get(conn, []), key=lambda entry: entry[0])
+            return [transfer for _, version, transfer in entries
+                    if version == transfer._version and transfer.state == Transfer.QUEUED]
+
+    def running(self, conn) -> List[Transfer]:
+        with self._lock:
+            return list(self._running.get(conn, []))
+
+    def _start(self, conn) -> List[Transfer]:
+        queue = self._queues.get(conn, [])
+        running = self._running.setdefault(conn, [])
+        started = []
+        while queue and len(running) < self._concurrency.get(conn, self.concurrency):
+            _, version, transfer = heapq.heappop(queue)
+            if version != transfer._version or transfer.state != Transfer.QUEUED:
+                continue
+            transfer.state = Transfer.RUNNING
+            running.append(transfer)
+            started.append(transfer)
+        return started
+
+    def _dispatch(self, transfers: List[Transfer]):
+        # Outside the lock, the dispatch can block on the queue of the peer.
+        for transfer in transfers:
+            for item in transfer.items:
+                self.dispatch(transfer.conn, item)
@@ -1,17 +1,20 @@
+import os
 from pickle import UnpicklingError
+from queue import Queue, Empty
 from socket import socket
-from threading import Thread
-from time import sleep
+from threading import Lock, Thread
 from tkinter.ttk import Progressbar
 from typing import List, Callable, Dict
 from uuid import UUID, uuid3, NAMESPACE_X500
 
 from old import __main__
 from advUtils import network
-from advUtils.network import PacketSystem
+from advUtils.network import Multiplexer, MuxStream, PacketSystem
 from old.downloader import PreFileDownloader, PreFolderDownloader, PreDownloader, Downloader
 from old.gui import DownloadItem, UploadItem
-from old.uploader import PreFileUploader, PreFolderUploader, PreUploader, Uploader
+from old.scheduler import Transfer, TransferScheduler
+from old.throttle import RateLimiter
+from old.uploader import FileBroadcast, PreBroadcastUploader, PreFileUploader, PreFolderUploader, PreUploader, Uploader
 
 
 class Server(network.Server):
@@ -21,8 +24,14 @@ class Server(network.Server):
 
     def __init__(self, main: '__main__.QCopyOverPC'):
         super(Server, self).__init__(43393)
-        self._upQueue: Dict[socket, List[object]] = {}
-        self._downQueue: List[object] = []
+        self.tcpNoDelay = True
+        self.singlePort = True
+        self.encrypted = True
+        # Uploads and downloads to one peer run side by side, each over a stream of the connection.
+        self.multiplexed = True
+        self._upQueue: Dict[socket, Queue] = {}
+        self._downQueue: Queue = Queue()
+        self._paks: Dict[socket, PacketSystem] = {}
 
         self.uploading: Dict[UUID, List[socket]] = {}
 
@@ -30,6 +39,18 @@ class Server(network.Server):
         self._uploaders: List[Uploader] = []
         self._downloaders: List[Downloader] = []
 
+        # Bandwidth of all uploads and all downloads, set from the UI.
+        self.uploadLimiter: RateLimiter = RateLimiter()
+        self.downloadLimiter: RateLimiter = RateLimiter()
+
+        # Transfers that run at once over a multiplexed connection, each over its own stream. Other connections run one
+        # transfer at a time.
+        self.transfersPerPeer = 4
+        self._offerLock = Lock()
+
+        # Uploads wait here for their turn.
+        self.scheduler: TransferScheduler = TransferScheduler(self.up_queue)
+
     def on_complete(self, conn: socket, path: str, complete: Callable[[], None]):
         """
         File-upload complete callback.
@@ -54,7 +75,7 @@ class Server(network.Server):
         @author: Quinten Jungblut
         """
 
-        self._upQueue[conn].append(data)
+        self._upQueue[conn].put(data)
 
     def up_queue_all(self, data: object):
         """
@@ -64,7 +85,7 @@ class Server(network.Server):
         @author: Quinten Jungblut
         """
         for conn in self.conn_array:
-            self._upQueue[conn].append(data)
+            self._upQueue[conn].put(data)
 
     def down_queue(self, data: object):
         """
@@ -74,7 +95,7 @@ class Server(network.Server):
         @author: Quinten Jungblut
         """
 
-        self._downQueue.append(data)
+        self._downQueue.put(data)
 
     def send(self, conn: socket, o: object):
         self.up_queue(conn, o)
@@ -82,28 +103,68 @@ class Server(network.Server):
     def sendall(self, o: object):
         self.up_queue_all(o)
 
-    def upload_folder(self, path: str, progressbar: Progressbar, *, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, canvas_item: UploadItem):
+    def upload_folder(self, path: str, progressbar: Progressbar, *, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, canvas_item: UploadItem, offer: dict = None, priority: int = 0) -> List[Transfer]:
+        """
+        Schedules a folder upload to all sockets.
+
+        @param path: the path to the folder to be uploaded.
+        @param progressbar: the progressbar.
+        @param on_complete: callable event for when upload completes.
+        @param on_error: callable event for when an error occurs.
+        @param canvas_item: the canvas item for displaying the upload progress.
+        @param offer: the offer sent to the peer when the upload starts.
+        @param priority: the priority in the scheduler.
+        @return: the scheduled transfers, one per socket.
+        @author: Quinten Jungblut
+        """
+
         self.uploading[uuid3(NAMESPACE_X500, path)] = []
+        transfers = []
         for conn in self.conn_array:
             self.uploading[uuid3(NAMESPACE_X500, path)].append(conn)
-            self.up_queue(conn, PreFolderUploader(path, progressbar, on_complete=lambda a_=conn, b_=path, c_=on_complete: self.on_complete(a_, b_, c_), on_error=on_error, canvas_item=canvas_item))
-
-    def upload(self, path: str, progressbar: Progressbar, *, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, canvas_item: UploadItem):
+            transfer = Transfer(conn, [], None, priority)
+            pre = PreFolderUploader(path, progressbar, on_complete=self.scheduler.on_finished(transfer, lambda a_=conn, b_=path, c_=on_complete: self.on_complete(a_, b_, c_)), on_error=self.scheduler.on_finished(transfer, on_error), canvas_item=canvas_item)
+            pre.offer = offer
+            transfer.items.append(pre)
+            transfers.append(transfer)
+            self.scheduler.submit(transfer)
+        return transfers
+
+    def upload(self, path: str, progressbar: Progressbar, *, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, canvas_item: UploadItem, offer: dict = None, priority: int = 0) -> List[Transfer]:
         """
-        Download a file to the socket.
+        Schedules a file upload to all sockets.
 
         @param path: the path to the file to be uploaded.
         @param progressbar: the progressbar.
         @param on_complete: callable event for when upload completes.
         @param on_error: callable event for when an error occurs.
         @param canvas_item: the canvas item for displaying the upload progress.
+        @param offer: the offer sent to the peer when the upload starts.
+        @param priority: the priority in the scheduler.
+        @return: the scheduled transfers, one per socket.
         @author: Quinten Jungblut
         """
 
         self.uploading[uuid3(NAMESPACE_X500, path)] = []
+
+        # With multiple peers, a broadcast reads the file once for all of them.
+        broadcast = FileBroadcast(path, len(self.conn_array)) if len(self.conn_array) > 1 else None
+        size = os.path.getsize(path)
+        transfers = []
         for conn in self.conn_array:
             self.uploading[uuid3(NAMESPACE_X500, path)].append(conn)
-            self.up_queue(conn, PreFileUploader(path, progressbar, on_complete=lambda a_=conn, b_=path, c_=on_complete: self.on_complete(a_, b_, c_), on_error=on_error, canvas_item=canvas_item))
+            transfer = Transfer(conn, [], size, priority)
+            complete = self.scheduler.on_finished(transfer, lambda a_=conn, b_=path, c_=on_complete: self.on_complete(a_, b_, c_))
+            error = self.scheduler.on_finished(transfer, on_error)
+            if broadcast is not None:
+                pre = PreBroadcastUploader(broadcast, progressbar, on_complete=complete, on_error=error, canvas_item=canvas_item)
+            else:
+                pre = PreFileUploader(path, progressbar, on_complete=complete, on_error=error, canvas_item=canvas_item)
+            pre.offer = offer
+            transfer.items.append(pre)
+            transfers.append(transfer)
+            self.scheduler.submit(transfer)
+        return transfers
 
     def download_folder(self, conn: socket, path: str, progressbar: Progressbar, *, on_complete: Callable[[], None] = lambda: None, on_error: Callable[[Exception], None] = lambda exc: None, canvas_item: DownloadItem):
         """
@@ -155,39 +216,206 @@ class Server(network.Server):
 
         return self._downloaders
 
-    def receiver(self, conn: socket):
+    def is_busy(self, conn: socket) -> bool:
         """
-        Receiver for server connections.
+        Checks if a transfer runs over the connection, the connection pool leaves busy connections alone.
+
+        @param conn: the socket connection.
+        @return: True if an upload or a download runs over the connection.
+        @author: Quinten Jungblut
+        """
+
+        return bool(self.scheduler.running(conn)) or \
+            any(not downloader.done and downloader.conn.conn is conn for downloader in self._downloaders)
+
+    def connection_closed(self, conn: socket):
+        """
+        Forgets a connection that was closed by the connection pool, and stops its sender.
+
+        @param conn: the socket connection.
+        @author: Quinten Jungblut
+        """
+
+        super(Server, self).connection_closed(conn)
+        self._paks.pop(conn, None)
+        if conn in self._upQueue:
+            self._upQueue[conn].put(None)
+
+    def route_reply(self, pak: PacketSystem, received: object) -> bool:
+        """
+        Routes a reply of a receiver to the uploader of the transfer.
+
+        @param pak: the packet-system the reply was received from.
+        @param received: the received packet.
+        @return: True if the packet was a reply.
+        @author: Quinten Jungblut
+        """
+
+        if not isinstance(received, dict) or "uuid" not in received:
+            return False
+        for uploader in list(self._uploaders):
+            if uploader.pak is pak and not uploader.done and str(uploader.uuid) == received["uuid"]:
+                uploader.replies.put(received)
+                break
+        return True
+
+    def route_packet(self, pak: PacketSystem, received: object):
+        """
+        Handles a packet that a download received for another transfer, while it reads the connection.
+        Replies are routed to their uploader, and transfers offered by the peer are declined.
+
+        @param pak: the packet-system the packet was received from.
+        @param received: the received packet.
+        @author: Quinten Jungblut
+        """
+
+        if isinstance(received, UUID):
+            pak.send({"type": "decline", "uuid": str(received)})
+            return
+        self.route_reply(pak, received)
+
+    def route_stream(self, stream: MuxStream):
+        """
+        Routes the replies on the stream of an upload to its uploader, until the receiver closes the stream.
+
+        @param stream: the stream of the upload.
+        @author: Quinten Jungblut
+        """
+
+        try:
+            while True:
+                self.route_reply(stream, stream.recv())
+        except ConnectionError:
+            stream.close()
+
+    @staticmethod
+    def on_upload_end(stream: MuxStream, callback: Callable) -> Callable:
+        """
+        Wraps a complete or error callback of an upload, so the stream of the upload is closed first.
+
+        @param stream: the stream of the upload.
+        @param callback: the callback.
+        @return: the wrapped callback.
+        @author: Quinten Jungblut
+        """
+
+        def ended(*args):
+            stream.close()
+            return callback(*args)
+
+        return ended
+
+    def handle(self, conn: socket, received: object):
+        """
+        Handles a received packet, like an offer, and returns the download it queued.
+        Offers are handled one at a time, so every offer gets its own download.
+
+        @param conn: the socket connection.
+        @param received: the received packet.
+        @return: the queued download, or None.
+        @author: Quinten Jungblut
+        """
+
+        with self._offerLock:
+            if received is not None:
+                self.main.do(conn, received)
+            try:
+                return self._downQueue.get_nowait()
+            except Empty:
+                return None
+
+    def acceptor(self, conn: socket, mux: Multiplexer):
+        """
+        Accepts the streams the peer opens for its uploads on a multiplexed connection, and receives every stream on
+        its own thread.
 
         @param conn: the socket connection.
+        @param mux: the multiplexer of the connection.
         @author: Quinten Jungblut
         """
 
-        pak = PacketSystem(conn)
+        try:
+            while True:
+                stream = mux.accept()
+                Thread(target=lambda stream_=stream: self.stream_receiver(conn, stream_)).start()
+        except ConnectionError:
+            pass
+
+    def stream_receiver(self, conn: socket, stream: MuxStream):
+        """
+        Receiver for the stream of a transfer on a multiplexed connection.
+        The stream starts with the offer, the downloader of an accepted offer reads the rest of the stream.
+
+        @param conn: the socket connection.
+        @param stream: the stream of the transfer.
+        @author: Quinten Jungblut
+        """
+
+        try:
+            received = stream.recv()
+            if not isinstance(received, UUID):
+                data = self.handle(conn, received)
+                if isinstance(data, PreDownloader):
+                    data.streams = self.streams(conn)
+                    data.streamCondition = self.stream_condition(conn)
+                    data.throttle = self.downloadLimiter.share(data.weight)
+                    data.route = lambda packet: self.route_packet(stream, packet)
+                    downloader = data.get_downloader(True, stream)
+                    self._downloaders.append(downloader)
+                    downloader.join()
+                    return
+                received = stream.recv()
+            if isinstance(received, UUID):
+                # The transfer wasn't accepted, its uploader waits for a reply and closes the stream.
+                stream.send({"type": "decline", "uuid": str(received)})
+                while True:
+                    stream.recv()
+        except ConnectionError:
+            pass
+        finally:
+            stream.close()
+
+    def receiver(self, conn: socket, pak: PacketSystem):
+        """
+        Receiver for server connections.
+        Blocks on the socket, and while a download is active waits for the downloader that reads the socket. On
+        multiplexed connections it receives the control stream, the transfers have streams of their own.
+
+        @param conn: the socket connection.
+        @param pak: the packet-system of the connection.
+        @author: Quinten Jungblut
+        """
 
         try:
             while True:
-                sleep(0.1)
-                # if not self._queue:
-                #     continue
-                if not self._downloaders:
-                    received = pak.recv()
-                    if received is not None:
-                        self.main.do(conn, received)
-                    if not self._downQueue:
-                        continue
-                    data = self._downQueue.pop(0)
-                    if isinstance(data, PreDownloader):
-                        self._downloaders.append(data.get_downloader(True, pak))
-                        continue
+                received = pak.recv()
+                if isinstance(received, UUID):
+                    # The transfer wasn't accepted, its uploader waits for a reply.
+                    pak.send({"type": "decline", "uuid": str(received)})
+                    continue
+                if self.route_reply(pak, received):
+                    continue
+                data = self.handle(conn, received)
+                if isinstance(data, PreDownloader):
+                    data.streams = self.streams(conn)
+                    data.streamCondition = self.stream_condition(conn)
+                    data.throttle = self.downloadLimiter.share(data.weight)
+                    data.route = lambda packet: self.route_packet(pak, packet)
+                    downloader = data.get_downloader(True, pak)
+                    self._downloaders.append(downloader)
+                    downloader.join()
         except OverflowError:
-            Thread(target=lambda: self.receiver(conn)).start()
+            Thread(target=lambda: self.receiver(conn, pak)).start()
         except MemoryError:
-            Thread(target=lambda: self.receiver(conn)).start()
+            Thread(target=lambda: self.receiver(conn, pak)).start()
         except UnpicklingError:
-            Thread(target=lambda: self.receiver(conn)).start()
+            Thread(target=lambda: self.receiver(conn, pak)).start()
         except Exception as e:
-            self.main.add_error_item(e.__class__.__name__, "Error occurred in receiver\n" + e.__str__())
+            # Connections closed on purpose, or by an idle peer, aren't errors.
+            closed = conn not in self._paks or isinstance(e, ConnectionError) and not self.is_busy(conn)
+            if not closed:
+                self.main.add_error_item(e.__class__.__name__, "Error occurred in receiver\n" + e.__str__())
+            self.pool.close(conn)
 
     def runner(self, conn: socket, secret):
         """
@@ -198,28 +426,52 @@ class Server(network.Server):
         @author: Quinten Jungblut
         """
 
-        self._upQueue[conn] = []
-        Thread(target=lambda: self.sender(conn)).start()
-        Thread(target=lambda: self.receiver(conn)).start()
-
-    def sender(self, conn: socket):
+        self._upQueue[conn] = Queue()
+        mux = self.multiplexer(conn)
+        if mux is not None:
+            # Packets go over the control stream, every transfer gets a stream of its own.
+            self.scheduler.set_concurrency(conn, self.transfersPerPeer)
+            self._paks[conn] = pak = mux.control
+            Thread(target=lambda: self.acceptor(conn, mux)).start()
+        else:
+            self._paks[conn] = pak = self.packet_system(conn)
+        Thread(target=lambda: self.sender(conn, pak)).start()
+        Thread(target=lambda: self.receiver(conn, pak)).start()
+
+    def sender(self, conn: socket, pak: PacketSystem):
         """
         Sender for server connections.
+        Blocks on the upload queue, so queued packets are sent immediately.
 
         @param conn: the socket connection.
+        @param pak: the packet-system of the connection.
         @author: Quinten Jungblut
         """
 
-        pak = PacketSystem(conn)
-
         try:
             while True:
-                sleep(0.1)
-                if not self._upQueue[conn]:
-                    continue
-                data = self._upQueue[conn].pop(0)
+                data = self._upQueue[conn].get()
+                if data is None and conn not in self._paks:
+                    # The connection was closed.
+                    return
                 if isinstance(data, PreUploader):
-                    self._uploaders.append(data.get_uploader(pak))
+                    data.streams = self.streams(conn)
+                    data.streamLock = self.stream_lock(conn)
+                    mux = self.multiplexer(conn)
+                    target = pak
+                    if mux is not None:
+                        target = mux.open()
+                        data.onComplete = self.on_upload_end(target, data.onComplete)
+                        data.onError = self.on_upload_end(target, data.onError)
+                    if data.offer is not None:
+                        target.send(data.offer)
+                    # Registered before it starts, so the replies of the receiver can be routed to it.
+                    uploader = data.get_uploader(target)
+                    uploader.throttle = self.uploadLimiter.share(data.weight)
+                    self._uploaders.append(uploader)
+                    if mux is not None:
+                        Thread(target=lambda stream=target: self.route_stream(stream)).start()
+                    uploader.start()
                     continue
                 # print(data)
                 if data:
@@ -0,0 +1,250 @@
+import json
+import os
+import shutil
+import time
+from hashlib import blake2b
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(...) request to clone a file on Linux, supported by Btrfs, XFS and others.
+_FICLONE = 0x40049409
+
+
+def hash_file(path: str) -> str:
+    """
+    Hashes the content of a file.
+
+    @param path: the path of the file.
+    @return: the hex BLAKE2b digest.
+    """
+
+    hash_ = blake2b(digest_size=32)
+    buffer = memoryview(bytearray(1048576))
+    with open(path, "rb") as fd:
+        while True:
+            read = fd.readinto(buffer)
+            if not read:
+                break
+            hash_.update(buffer[:read])
+    return hash_.hexdigest()
+
+
+def _reflink(src: str, dst: str) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as source, open(dst, "wb") as target:
+            fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+class HashIndex(object):
+    """
+    Index of the content hashes of local files, so unchanged files aren't hashed again for every upload.
+    An entry is valid while the size and modification time of the file are the same.
+    @author: Quinten Jungblut
+    """
+
+    file = os.path.join(os.path.expanduser("~"), ".qcopyoverpc", "hashes.json")
+    _default: Optional['HashIndex'] = None
+
+    def __init__(self):
+        self._entries: Dict[str, List] = {}
+        self._lock = Lock()
+        try:
+            with open(self.file, "r") as fd:
+                self._entries = json.load(fd)
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def default(cls) -> 'HashIndex':
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def get(self, path: str, stat: Tuple[int, int] = None) -> str:
+        """
+        Returns the content hash of a file, hashing it if the index has no valid entry.
+
+        @param path: the real path of the file.
+        @param stat: the size and modification time of the file, if already known.
+        @return: the hex digest.
+        """
+
+        if stat is None:
+            stat_result = os.stat(path)
+            stat = stat_result.st_size, stat_result.st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] == stat[0] and entry[1] == stat[1]:
+            return entry[2]
+
+        digest = hash_file(path)
+        with self._lock:
+            self._entries[path] = [stat[0], stat[1], digest]
+        return digest
+
+    def save(self):
+        with self._lock:
+            entries = dict(self._entries)
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with open(self.file + ".tmp", "w") as fd:
+            json.dump(entries, fd)
+        os.replace(self.file + ".tmp", self.file)
+
+
+class ContentStore(object):
+    """
+    Content-addressed store of received files, blobs are named by their content hash.
+    Blobs are reflinks of the received files where the file system supports it, hard links otherwise, so the store
+    takes no extra disk space while the received files exist. A hard linked blob shares its inode with the received
+    file, so editing that file in place edits the blob too, a blob whose size or modification time changed is dropped.
+    Files placed from a blob are reflinks or copies, never hard links, so they can be edited on their own.
+    Hard linked blobs whose received file was deleted are pruned, and reflinked blobs, which may hold the only copy of
+    their data, are limited to the max size, least recently used first.
+    @author: Quinten Jungblut
+    """
+
+    directory = os.path.join(os.path.expanduser("~"), ".qcopyoverpc", "store")
+    _default: Optional['ContentStore'] = None
+
+    # Bytes of reflinked blobs kept by #prune(self).
+    maxSize = 1024 * 1024 * 1024
+
+    def __init__(self):
+        # Entries are [size, modification time, last used, reflinked] lists.
+        self._index: Dict[str, List] = {}
+        self._lock = Lock()
+        try:
+            with open(os.path.join(self.directory, "index.json"), "r") as fd:
+                self._index = json.load(fd)
+        except (OSError, ValueError):
+            pass
+        for entry in self._index.values():
+            # Entries of older versions have no use time, and their blobs aren't reflinks.
+            entry.extend([0.0, False][len(entry) - 2:])
+
+    @classmethod
+    def default(cls) -> 'ContentStore':
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def blob(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, digest: str, size: int) -> Optional[str]:
+        """
+        Returns the blob of a content hash.
+
+        @param digest: the hex digest.
+        @param size: the expected size.
+        @return: the path of the blob, or None if the store doesn't have it.
+        """
+
+        with self._lock:
+            entry = self._index.get(digest)
+            if entry is None:
+                return None
+            try:
+                stat = os.stat(self.blob(digest))
+            except OSError:
+                stat = None
+            if stat is None or stat.st_size != size or [stat.st_size, stat.st_mtime_ns] != entry[:2]:
+                del self._index[digest]
+                return None
+            entry[2] = time.time()
+            return self.blob(digest)
+
+    def add(self, digest: str, path: str) -> bool:
+        """
+        Adds a received file to the store.
+
+        @param digest: the content hash of the file, verified by the caller.
+        @param path: the path of the file.
+        @return: True if the file was added.
+        """
+
+        blob = self.blob(digest)
+        with self._lock:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if os.path.exists(blob):
+                os.remove(blob)
+            reflinked = _reflink(path, blob)
+            if not reflinked:
+                try:
+                    os.link(path, blob)
+                except OSError:
+                    return False
+            stat = os.stat(blob)
+            self._index[digest] = [stat.st_size, stat.st_mtime_ns, time.time(), reflinked]
+            return True
+
+    def link(self, blob: str, path: str):
+        """
+        Places a blob at a path, as reflink or as copy if the file system doesn't support reflinks.
+        Not as hard link, the placed file would share its inode with the blob and the other places of it.
+
+        @param blob: the path of the blob.
+        @param path: the target path.
+        """
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        if not _reflink(blob, path):
+            shutil.copyfile(blob, path)
+
+    def prune(self):
+        """
+        Removes the hard linked blobs whose received file was deleted, and the least recently used reflinked blobs
+        over the max size.
+        """
+
+        with self._lock:
+            reflinked = []
+            for digest, entry in list(self._index.items()):
+                try:
+                    stat = os.stat(self.blob(digest))
+                except OSError:
+                    del self._index[digest]
+                    continue
+                if entry[3]:
+                    reflinked.append((entry[2], stat.st_size, digest))
+                elif stat.st_nlink <= 1:
+                    self._remove(digest)
+
+            total = sum(size for _, size, _ in reflinked)
+            for _, size, digest in sorted(reflinked):
+                if total <= self.maxSize:
+                    break
+                self._remove(digest)
+                total -= size
+
+    def _remove(self, digest: str):
+        del self._index[digest]
+        try:
+            os.remove(self.blob(digest))
+        except OSError:
+            pass
+
+    def save(self):
+        with self._lock:
+            index = dict(self._index)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "index.json.tmp"), "w") as fd:
+            json.dump(index, fd)
+        os.replace(os.path.join(self.directory, "index.json.tmp"), os.path.join(self.directory, "index.json"))
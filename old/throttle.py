@@ -0,0 +1,95 @@
+from threading import Condition
+from time import monotonic
+from typing import Optional
+from weakref import WeakSet
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter, shared by the transfers of a connection in one direction.
+    Every transfer has a share with a weight, the rate is divided over the active shares by weight. A share that wasn't
+    used for a second, like a transfer waiting for a reply, doesn't count, so its part goes to the other transfers.
+    The rate can be changed at any time, waiting transfers pick up the new rate immediately.
+    @author: Quinten Jungblut
+    """
+
+    # Seconds a share stays active after it was used.
+    activeTime = 1.0
+
+    def __init__(self, rate: Optional[float] = None, *, burst: float = 0.25):
+        """
+        @param rate: the rate in bytes per second, None for unlimited.
+        @param burst: the seconds of its rate a share can save up.
+        """
+
+        self._rate: Optional[float] = rate
+        self.burst: float = burst
+        self._shares: WeakSet = WeakSet()
+        self._condition = Condition()
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: Optional[float]):
+        with self._condition:
+            self._rate = rate if rate else None
+            self._condition.notify_all()
+
+    def share(self, weight: float = 1.0) -> 'RateShare':
+        """
+        Returns a new share of the rate, for a transfer.
+
+        @param weight: the weight of the share.
+        @return: the share.
+        """
+
+        share = RateShare(self, weight)
+        with self._condition:
+            self._shares.add(share)
+        return share
+
+    def _active_weight(self, now: float) -> float:
+        return sum(share.weight for share in self._shares
+                   if share.waiting or now - share.lastUse < self.activeTime)
+
+
+class RateShare(object):
+    """
+    Share of a transfer in a rate limiter.
+    @author: Quinten Jungblut
+    """
+
+    def __init__(self, limiter: RateLimiter, weight: float):
+        self.limiter: RateLimiter = limiter
+        self.weight: float = weight
+        self.tokens = 0.0
+        self.waiting = False
+        self.lastUse = monotonic()
+        self._lastFill = self.lastUse
+
+    def consume(self, amount: int):
+        """
+        Takes bytes from the share, waits until the share has tokens. Blocks bigger than the burst are allowed, the
+        share goes into debt and the next block waits for it.
+
+        @param amount: the amount of bytes.
+        """
+
+        limiter = self.limiter
+        with limiter._condition:
+            self.waiting = True
+            try:
+                while limiter.rate is not None:
+                    now = monotonic()
+                    rate = limiter.rate * self.weight / max(limiter._active_weight(now), self.weight)
+                    self.tokens = min(self.tokens + (now - self._lastFill) * rate, rate * limiter.burst)
+                    self._lastFill = now
+                    if self.tokens >= 0:
+                        break
+                    limiter._condition.wait(-self.tokens / rate)
+                self.tokens = self.tokens - amount if limiter.rate is not None else 0.0
+                self.lastUse = monotonic()
+            finally:
+                self.waiting = False
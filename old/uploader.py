@@ -1,12 +1,24 @@
+import mmap
 import os
+import socket
 from abc import ABC, abstractmethod
-from threading import Thread
+from hashlib import blake2b
+from queue import Queue, Full, Empty
+from threading import Thread, Condition, Lock
+from time import monotonic
 from tkinter.ttk import Progressbar
-from typing import Callable, Any, Optional, BinaryIO
+from typing import Callable, Any, Optional, BinaryIO, List, Dict, Tuple
 from uuid import uuid3, NAMESPACE_X500, UUID
 
-from advUtils.network import PacketSystem
+from advUtils.network import PacketSystem, DataBlock, CompressionStage, CompressorRegistry
 from old.gui import UploadItem, CanvasItem
+from old.blocksize import BlockSizer
+from old.delta import DeltaGenerator, merge_copies
+from old.integrity import FileHasher, chunk_ranges, file_digest
+from old.manifest import resume_ranges
+from old.scanner import FolderScanner, ScanEntry
+from old.store import HashIndex
+from old.throttle import RateLimiter, RateShare
 from lib import FileSize
 
 
@@ -19,12 +31,28 @@ class PreUploader(ABC):
         self.onComplete: Callable[[], None]
         self.canvasItem: CanvasItem
 
+        # Extra data streams of the connection, set by the connection when the upload is started.
+        self.streams: Dict[int, PacketSystem] = {}
+        self.streamLock: Optional[Lock] = None
+
+        # Weight of the upload in the bandwidth of the connection.
+        self.weight: float = 1.0
+
+        # The offer sent to the peer before the upload, over the stream of the upload on multiplexed connections.
+        self.offer: Optional[dict] = None
+
     @abstractmethod
     def get_uploader(self, pak: PacketSystem):
         pass
 
 
 class Uploader(ABC):
+    # Preferred block compressor, compression is disabled when None or when the receiver doesn't have it.
+    compressor: Optional[str] = "zlib"
+
+    # Seconds to wait for a reply of the receiver, it may ask its user where to save the transfer first.
+    replyTimeout: float = 600.0
+
     # noinspection PyTypeChecker
     def __init__(self):
         self.message: str = ""
@@ -36,6 +64,64 @@ class Uploader(ABC):
         self.onComplete: Callable[[], None] = None
         self.progressbar: Progressbar = None
 
+        # Replies of the receiver for this transfer, routed here by the connection.
+        self.uuid: Optional[UUID] = None
+        self.replies: Queue = Queue()
+
+        self.compression: Optional[CompressionStage] = None
+
+        # Share of the upload in the rate limiter of the connection, set by the connection before the upload starts.
+        self.throttle: RateShare = RateLimiter().share()
+
+    def wait_reply(self, *types: str, rel_path: Optional[str] = None) -> dict:
+        """
+        Waits for a reply of the receiver.
+
+        @param types: the reply types to wait for.
+        @param rel_path: the file of a folder the reply is for, replies for other files are stale and dropped.
+        @return: the reply.
+        @raise ConnectionAbortedError: if the receiver declined the transfer.
+        @raise ConnectionError: if the receiver didn't reply within the reply timeout.
+        """
+
+        deadline = monotonic() + self.replyTimeout
+        while True:
+            try:
+                reply: dict = self.replies.get(timeout=max(deadline - monotonic(), 0.0))
+            except Empty:
+                raise ConnectionError(f"The receiver didn't reply within {self.replyTimeout:.0f} seconds")
+            if reply.get("type") == "decline":
+                raise ConnectionAbortedError("The receiver declined the transfer")
+            if reply.get("type") in types and (rel_path is None or reply.get("rel-path") == rel_path):
+                return reply
+
+    def negotiate_compression(self, reply: dict) -> Optional[CompressionStage]:
+        """
+        Picks the compression of the transfer, from the compressors in a reply of the receiver.
+
+        @param reply: the reply.
+        @return: the compression stage, or None to send uncompressed.
+        """
+
+        if self.compressor is None:
+            return None
+        name = CompressorRegistry.negotiate(reply.get("compressors", []), self.compressor)
+        return CompressionStage(name) if name is not None else None
+
+    def compression_message(self) -> str:
+        """
+        Returns the compression ratio and throughput, for the message.
+
+        @return: the message lines, empty without compression.
+        """
+
+        if self.compression is None or not self.compression.bytesIn:
+            return ""
+        return f"\nCompression: {self.compression.compressor.name}, {self.compression.ratio:.0%} of " \
+               f"{FileSize.get_string(self.compression.bytesIn)}" + \
+               (" (skipping)" if self.compression.skipping else "") + \
+               f", {FileSize.get_string(int(self.compression.throughput))}/s"
+
     @abstractmethod
     def upload(self):
         pass
@@ -68,29 +154,59 @@ class PreFileUploader(PreUploader):
         @author: Quinten Jungblut
         @return: the uploader
         """
-        a = FileUploader(pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem)
-        a.start()
+        a = FileUploader(pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem, streams=self.streams, stream_lock=self.streamLock)
         return a
 
 
 class FileUploader(Uploader):
     """
     Uploader, uploads a file.
+    Only the ranges the receiver doesn't have yet are sent, so an interrupted transfer resumes where it stopped.
+    Large files are split into ranges, sent concurrently over the extra data streams of the connection.
+    Blocks of zeros in sparse files are sent without their data, so the receiver keeps the holes. Uncompressed files are
+    sent with sendfile(...), straight from the page cache to the socket. Block sizes adapt to the link, per stream.
+    The file is hashed per chunk on a worker thread while it's sent, and chunks the receiver can't verify are sent again.
     @author: Quinten Jungblut
     """
 
-    def __init__(self, pak: PacketSystem, path, progressbar, *, canvas_item: UploadItem, on_complete=lambda: None, on_error: Callable[[Exception], Any] = lambda exc: None):
+    # Files from this size are sent over the extra data streams, when the connection has them.
+    parallelThreshold = 64 * 1024 * 1024
+
+    # Fixed block size, None to adapt the block size to the link.
+    blockSize: Optional[int] = None
+
+    # Uncompressed, dense files are sent with sendfile(...), unless zero copy is disabled.
+    zeroCopy = True
+
+    # Size of the verified chunks, None to disable verification, and the times corrupt chunks are sent again.
+    verifyChunkSize: Optional[int] = 1048576
+    verifyRounds = 3
+
+    def __init__(self, pak: PacketSystem, path, progressbar, *, canvas_item: UploadItem, on_complete=lambda: None, on_error: Callable[[Exception], Any] = lambda exc: None, streams: Dict[int, PacketSystem] = None, stream_lock: Lock = None):
         super().__init__()
         self.pak: PacketSystem = pak
+        self.path: str = path
         self._fd = open(path, "rb")
         self._thread: Optional[Thread] = None
         self.uuid = uuid3(NAMESPACE_X500, path)
 
+        self.streams: Dict[int, PacketSystem] = {} if streams is None else streams
+        self.streamLock: Optional[Lock] = stream_lock
+        self.streamCount = 1
+        self._progressLock = Lock()
+
+        # Round trip time of the connection, measured with the resume reply.
+        self.rtt = 0.0
+
         self.progressbar: Progressbar = progressbar
 
         try:
             self.bytesSent = 0
-            self.fileSize = os.path.getsize(path)
+            stat = os.stat(path)
+            self.fileSize = stat.st_size
+
+            # Files with fewer allocated blocks than their size have holes, their zero blocks are sent without data.
+            self.sparse: bool = getattr(stat, "st_blocks", None) is not None and stat.st_blocks * 512 < stat.st_size
         except Exception as e:
             on_error(e)
 
@@ -109,24 +225,44 @@ class FileUploader(Uploader):
         """
         try:
             # a = self.totalFileSize.to_bytes(16, "big", signed=False)
+            hasher = None
+            if self.verifyChunkSize is not None:
+                hasher = FileHasher(self.path, self.fileSize, self.verifyChunkSize)
+                hasher.start()
+
             self.pak.send(self.uuid)
-            self.pak.send(self.fileSize)
+            sent = monotonic()
+            self.pak.send({"type": "file-info", "size": self.fileSize, "sparse": self.sparse,
+                           "verify": self.verifyChunkSize})
 
             print(f"Expected to send: {self.fileSize} Bytes")
 
-            while True:
-                self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
-                               f"File size: {FileSize.get_string(self.fileSize)}\n"
-                self.send_block(32767)
-                self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
-                               f"File size: {FileSize.get_string(self.fileSize)}\n"
-                if self.done:
-                    break
-                self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
-                               f"File size: {FileSize.get_string(self.fileSize)}\n"
+            # The receiver replies with the ranges it kept from an interrupted transfer, and its compressors.
+            reply = self.wait_reply("resume")
+            self.rtt = monotonic() - sent
+            ranges = resume_ranges(self._fd, self.fileSize, reply)
+            self.compression = self.negotiate_compression(reply)
+            remaining = sum(end - start for start, end in ranges)
+            self.bytesSent = self.fileSize - remaining
+
+            streams = self._acquire_streams(remaining)
+            if streams:
+                try:
+                    self.upload_parallel(streams, ranges)
+                finally:
+                    self.streamLock.release()
+            else:
+                self.send_ranges(self.pak, ranges)
+            if hasher is not None:
+                self.verify(hasher.result())
             self._fd.close()
         except Exception as e:
             self.done = True
+            if not isinstance(e, ConnectionError):
+                try:
+                    self.pak.send({"type": "error", "uuid": str(self.uuid), "error": {"exception": e}})
+                except OSError:
+                    pass
             self.onError(e)
             return
         print("Sent:", self.bytesSent, "Bytes")
@@ -139,29 +275,480 @@ class FileUploader(Uploader):
         @author: Quinten Jungblut
         """
 
-        # Disabled thread upload because upload conflicts caused by having 1 port used.
-        # self.upload()
-
+        # Uploads to one peer run side by side over a multiplexed connection, every upload has its own stream. Over other
+        # connections the scheduler runs one upload at a time.
         self._thread = Thread(target=lambda: self.upload())
         self._thread.start()
 
-    def send_block(self, size):
+    def verify(self, digests: List[str]):
         """
-        Sends a block.
+        Sends the chunk digests of the file, and sends the chunks again that the receiver couldn't verify.
 
-        @param size: size to send.
-        @author: Quinten Jungblut
+        @param digests: the hex digests of the chunks.
+        @raise ConnectionError: if chunks are still corrupt after the verify rounds.
         """
-        self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
-                       f"File size: {FileSize.get_string(self.fileSize)}\n"
-        data: bytes = self._fd.read(size)
-        size1 = len(data)
-        if size1 < size:
+
+        for _ in range(self.verifyRounds + 1):
+            self.pak.send({"type": "verify", "uuid": str(self.uuid), "digests": digests, "digest": file_digest(digests)})
+            reply = self.wait_reply("verified", "resend")
+            if reply["type"] == "verified":
+                return
+            ranges = chunk_ranges(reply["chunks"], self.verifyChunkSize, self.fileSize)
+            with self._progressLock:
+                self.bytesSent -= sum(end - start for start, end in ranges)
+            self.message = f"Sending {len(reply['chunks'])} corrupt chunks again"
+            self.send_ranges(self.pak, ranges)
+        error = ConnectionError(f"The file is still corrupt after sending it again {self.verifyRounds} times")
+        self.pak.send({"type": "error", "uuid": str(self.uuid), "error": {"exception": error}})
+        raise error
+
+    def _acquire_streams(self, remaining: int) -> List[Tuple[int, PacketSystem]]:
+        """
+        Acquires the extra data streams for a parallel upload, the streams are used by one upload at a time.
+
+        @param remaining: the amount of bytes to send.
+        @return: the streams by index, or an empty list for a sequential upload.
+        """
+
+        if not self.streams or self.streamLock is None or remaining < self.parallelThreshold:
+            return []
+        if not self.streamLock.acquire(blocking=False):
+            return []
+        return sorted(self.streams.items())
+
+    def upload_parallel(self, streams: List[Tuple[int, PacketSystem]], ranges: List[Tuple[int, int]]):
+        """
+        Splits the ranges to send into one part per stream, and sends the parts concurrently.
+
+        @param streams: the streams by index.
+        @param ranges: the ranges to send.
+        """
+
+        parts = list(zip(streams, _split_ranges(ranges, len(streams))))
+        self.streamCount = len(parts)
+        self.pak.send({"type": "parallel", "streams": [index for (index, _), _ in parts]})
+
+        errors: List[Exception] = []
+        threads = [Thread(target=lambda p=pak, r=part: self._send_stream(p, r, errors)) for (_, pak), part in parts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _send_stream(self, pak: PacketSystem, ranges: List[Tuple[int, int]], errors: List[Exception]):
+        try:
+            self.send_ranges(pak, ranges)
+        except Exception as e:
+            errors.append(e)
+
+    def send_ranges(self, pak: PacketSystem, ranges: List[Tuple[int, int]]):
+        """
+        Sends ranges of the file, the last block is flagged as last block.
+        Without ranges an empty last block is sent, so the receiver still completes.
+
+        @param pak: the packet-system to send to.
+        @param ranges: the ranges to send.
+        """
+
+        if not ranges:
+            pak.send_block(self.uuid, self.fileSize, b"", DataBlock.LAST_BLOCK)
+            return
+        sizer = BlockSizer(rtt=self.rtt) if self.blockSize is None else BlockSizer.fixed(self.blockSize)
+        if self.zeroCopy and self.compression is None and not self.sparse and hasattr(pak, "send_file_block"):
+            self.sendfile_ranges(pak, ranges, sizer)
+            return
+
+        buffer = memoryview(bytearray(sizer.size))
+        zeros = b""
+        with open(self.path, "rb") as fd:
+            for start, end in ranges:
+                fd.seek(start)
+                offset = start
+                while offset < end:
+                    if len(buffer) < sizer.size:
+                        buffer = memoryview(bytearray(sizer.size))
+                    size = fd.readinto(buffer[:min(sizer.size, end - offset)])
+                    if size == 0:
+                        raise EOFError(f"File ended at {offset} of {end} bytes: {self.path}")
+                    last = offset + size >= end and end == ranges[-1][1]
+                    flags = DataBlock.LAST_BLOCK if last else 0
+                    if self.sparse:
+                        if len(zeros) != len(buffer):
+                            zeros = bytes(len(buffer))
+                        if buffer[:size].tobytes() == zeros[:size]:
+                            flags |= DataBlock.ZERO_BLOCK
+                    sizer.start()
+                    if not flags & DataBlock.ZERO_BLOCK:
+                        self.throttle.consume(size)
+                    pak.send_block(self.uuid, offset, buffer[:size], flags, self.compression)
+                    if not flags & DataBlock.ZERO_BLOCK:
+                        sizer.sent(size)
+                    offset += size
+                    self.add_progress(size)
+
+    def sendfile_ranges(self, pak: PacketSystem, ranges: List[Tuple[int, int]], sizer: BlockSizer):
+        """
+        Sends ranges of the file with sendfile(...), the data isn't copied into Python.
+
+        @param pak: the packet-system to send to.
+        @param ranges: the ranges to send.
+        @param sizer: the block sizer of the stream.
+        """
+
+        with open(self.path, "rb") as fd:
+            for start, end in ranges:
+                offset = start
+                while offset < end:
+                    size = min(sizer.size, end - offset)
+                    last = offset + size >= end and end == ranges[-1][1]
+                    sizer.start()
+                    self.throttle.consume(size)
+                    try:
+                        pak.send_file_block(self.uuid, fd, offset, size, DataBlock.LAST_BLOCK if last else 0)
+                    except EOFError as e:
+                        # The writer shut the stream down in the middle of a frame, and a connection can't get a
+                        # stream back, so the connection is shut down too.
+                        try:
+                            self.pak.conn.shutdown(socket.SHUT_RDWR)
+                        except (AttributeError, OSError):
+                            pass
+                        raise ConnectionError(f"File ended during the upload: {self.path}") from e
+                    sizer.sent(size)
+                    offset += size
+                    self.add_progress(size)
+
+    def add_progress(self, size: int):
+        with self._progressLock:
+            self.bytesSent += size
+            self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
+                           f"File size: {FileSize.get_string(self.fileSize)}" + \
+                           (f"\nStreams: {self.streamCount}" if self.streamCount > 1 else "") + \
+                           self.compression_message()
+
+
+def _split_ranges(ranges: List[Tuple[int, int]], count: int) -> List[List[Tuple[int, int]]]:
+    """
+    Splits ranges into at most count parts of about equal size.
+    """
+
+    step = -(-sum(end - start for start, end in ranges) // count)
+    parts: List[List[Tuple[int, int]]] = [[]]
+    size = 0
+    for start, end in ranges:
+        while start < end:
+            if size == step:
+                parts.append([])
+                size = 0
+            cut = min(end, start + step - size)
+            parts[-1].append((start, cut))
+            size += cut - start
+            start = cut
+    return parts
+
+
+class FileBroadcast(object):
+    """
+    Broadcast engine, reads each block of a file once and fans it out to the uploaders of all peers.
+    Every peer has its own bounded block queue and reading waits for full queues. A peer that held back the other peers
+    for the stall timeout in total switches to reading the file by itself, so it doesn't stall the fast ones.
+    The file is hashed once for all peers, and every peer verifies its copy with the digests, like with the FileUploader.
+    """
+
+    def __init__(self, path: str, peers: int, *, block_size: int = 65536, window: int = 64, attach_timeout: float = 2.0, stall_timeout: float = 0.5):
+        """
+        @param path: the path to the file to broadcast.
+        @param peers: the amount of peers, reading starts when all of them are attached.
+        @param block_size: the size of the blocks.
+        @param window: the amount of blocks queued per peer.
+        @param attach_timeout: seconds to wait for all peers, late peers read the file by themselves.
+        @param stall_timeout: seconds a peer may hold back the other peers in total, before it reads the file by itself.
+        """
+
+        self.path: str = path
+        self.uuid: UUID = uuid3(NAMESPACE_X500, path)
+        self.fileSize: int = os.path.getsize(path)
+        self.blockSize: int = block_size
+        self.window: int = window
+        self.attachTimeout: float = attach_timeout
+        self.stallTimeout: float = stall_timeout
+
+        self.verifyChunkSize: Optional[int] = FileUploader.verifyChunkSize
+
+        self._expected: int = peers
+        self._uploaders: List['BroadcastFileUploader'] = []
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._hasher: Optional[FileHasher] = None
+        self._reading = False
+
+    def attach(self, uploader: 'BroadcastFileUploader'):
+        """
+        Attaches the uploader of a peer, the first peer starts the reader thread.
+
+        @param uploader: the uploader of the peer.
+        """
+
+        with self._condition:
+            if self._reading:
+                uploader.lagging = True
+            self._uploaders.append(uploader)
+            self._condition.notify_all()
+            if self._thread is None:
+                if self.verifyChunkSize is not None:
+                    self._hasher = FileHasher(self.path, self.fileSize, self.verifyChunkSize)
+                    self._hasher.start()
+                self._thread = Thread(target=lambda: self.read(), name="FileBroadcast")
+                self._thread.start()
+
+    def digests(self) -> List[str]:
+        """
+        Waits until the file is hashed.
+
+        @return: the hex digests of the chunks.
+        """
+
+        return self._hasher.result()
+
+    def _followers(self):
+        return (uploader for uploader in self._uploaders if not uploader.lagging and not uploader.done)
+
+    def notify(self):
+        """
+        Wakes up the reader, called by the uploaders when they took a block or finished.
+        """
+
+        with self._condition:
+            self._condition.notify_all()
+
+    def _wait_for_room(self) -> List['BroadcastFileUploader']:
+        """
+        Waits until every following peer has room for a block, peers that stall the others are switched to lagging.
+
+        @return: the following peers.
+        """
+
+        with self._condition:
+            while True:
+                followers = list(self._followers())
+                full = [uploader for uploader in followers if not uploader.has_room()]
+                if not full:
+                    return followers
+                if len(full) == len(followers):
+                    # All peers are slower than the disk, nobody is held back.
+                    self._condition.wait()
+                    continue
+
+                lagging = [uploader for uploader in full if uploader.stallTime >= self.stallTimeout]
+                if lagging:
+                    for uploader in lagging:
+                        uploader.lagging = True
+                    continue
+
+                start = monotonic()
+                self._condition.wait(self.stallTimeout - max(uploader.stallTime for uploader in full))
+                for uploader in full:
+                    uploader.stallTime += monotonic() - start
+
+    def read(self):
+        """
+        Reader loop, reads the blocks and offers them to the attached uploaders.
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._uploaders) >= self._expected, self.attachTimeout)
+            # Peers that attach from now on read the file by themselves.
+            self._reading = True
+
+        offset = 0
+        try:
+            with open(self.path, "rb") as fd:
+                while True:
+                    followers = self._wait_for_room()
+                    if not followers:
+                        return
+
+                    data: bytes = fd.read(self.blockSize)
+                    last = len(data) < self.blockSize
+                    for uploader in followers:
+                        uploader.offer(offset, data, last)
+                    offset += len(data)
+                    if last:
+                        return
+        except Exception:
+            # The followers read the rest of the file by themselves, and fail with the error of their own read.
+            with self._condition:
+                for uploader in list(self._followers()):
+                    uploader.lagging = True
+                    uploader.wake()
+
+
+class PreBroadcastUploader(PreUploader):
+    """
+    Pre-uploader for one peer of a broadcast, when queued the #get_uploader(self, pak: PacketSystem) method will be called.
+    """
+
+    def __init__(self, broadcast: FileBroadcast, progressbar: Progressbar, *, canvas_item: UploadItem, on_complete=lambda: None, on_error=lambda exc: None):
+        super().__init__()
+        self.broadcast = broadcast
+        self.path = broadcast.path
+        self.progressbar = progressbar
+
+        self.onError = on_error
+        self.onComplete = on_complete
+        self.canvasItem = canvas_item
+
+    def get_uploader(self, pak: PacketSystem) -> 'BroadcastFileUploader':
+        """
+        Returns a uploader.
+
+        @param pak:
+        @return: the uploader
+        """
+        a = BroadcastFileUploader(pak, self.broadcast, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem)
+        return a
+
+
+class BroadcastFileUploader(Uploader):
+    """
+    Uploader for one peer of a broadcast, sends the blocks read by the broadcast engine.
+    Uses the same packets as the FileUploader, so the peer downloads it with a FileDownloader. The whole file is sent to
+    every peer, the blocks are shared, so ranges a peer kept from an interrupted download aren't skipped, and blocks
+    aren't compressed. Corrupt chunks are sent again to their peer only.
+    """
+
+    # Corrupt chunks are sent again like by the FileUploader, with #send_ranges(self, pak, ranges).
+    verify = FileUploader.verify
+
+    def __init__(self, pak: PacketSystem, broadcast: FileBroadcast, progressbar, *, canvas_item: UploadItem, on_complete=lambda: None, on_error: Callable[[Exception], Any] = lambda exc: None):
+        super().__init__()
+        self.pak: PacketSystem = pak
+        self.broadcast: FileBroadcast = broadcast
+        self.uuid: UUID = broadcast.uuid
+        self.fileSize: int = broadcast.fileSize
+        self.bytesSent = 0
+
+        self.progressbar: Progressbar = progressbar
+        self.onError = on_error
+        self.onComplete = on_complete
+        self.canvasItem = canvas_item
+
+        # Set when the peer fell behind, the uploader then reads the rest of the file by itself.
+        self.lagging = False
+        # Seconds the peer held back the other peers of the broadcast.
+        self.stallTime = 0.0
+        self._blocks: Queue = Queue(broadcast.window)
+
+        self.verifyChunkSize: Optional[int] = broadcast.verifyChunkSize
+        self.verifyRounds: int = FileUploader.verifyRounds
+        self._progressLock = Lock()
+
+        self.done = False
+
+    def offer(self, offset: int, data: bytes, last: bool):
+        """
+        Offers a block read by the broadcast engine, called from the reader thread.
+
+        @param offset: the offset of the block.
+        @param data: the block data, shared between the peers.
+        @param last: True if it's the last block of the file.
+        """
+
+        try:
+            self._blocks.put_nowait((offset, data, last))
+        except Full:
+            self.lagging = True
+
+    def has_room(self) -> bool:
+        return not self._blocks.full()
+
+    def wake(self):
+        """
+        Wakes up the uploader when it waits for a block, after it was switched to lagging by the reader thread.
+        """
+
+        try:
+            self._blocks.put_nowait(None)
+        except Full:
+            # The uploader doesn't wait on a full queue, and it doesn't wait anymore once it emptied it.
+            pass
+
+    def _next_block(self):
+        try:
+            block = self._blocks.get(block=not self.lagging)
+            self.broadcast.notify()
+            if block is not None:
+                return block
+        except Empty:
+            pass
+
+        # Fell behind, read the rest of the file by itself.
+        if self._fd is None:
+            self._fd = open(self.broadcast.path, "rb")
+            self._fd.seek(self.bytesSent)
+        data: bytes = self._fd.read(self.broadcast.blockSize)
+        return self.bytesSent, data, len(data) < self.broadcast.blockSize
+
+    def upload(self):
+        """
+        Upload
+        """
+        try:
+            self.pak.send(self.uuid)
+            self.pak.send({"type": "file-info", "size": self.fileSize, "sparse": False, "verify": self.verifyChunkSize})
+            self.wait_reply("resume")
+
+            while True:
+                offset, data, last = self._next_block()
+                self.throttle.consume(len(data))
+                self.pak.send_block(self.uuid, offset, data, DataBlock.LAST_BLOCK if last else 0)
+                self.bytesSent += len(data)
+                self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
+                               f"File size: {FileSize.get_string(self.fileSize)}\n" \
+                               f"{'Reading from disk' if self.lagging else 'Shared read'}"
+                if last:
+                    break
+            if self.verifyChunkSize is not None:
+                self.verify(self.broadcast.digests())
+        except Exception as e:
             self.done = True
-        self.pak.send({"type": "data", "data": {"size": size1, "data": data, "last-block": self.done}})
-        self.bytesSent += size1
-        self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
-                       f"File size: {FileSize.get_string(self.fileSize)}\n"
+            self.broadcast.notify()
+            self.onError(e)
+            return
+        finally:
+            if self._fd is not None:
+                self._fd.close()
+        self.done = True
+        self.onComplete()
+
+    def send_ranges(self, pak: PacketSystem, ranges: List[Tuple[int, int]]):
+        """
+        Sends ranges of the file, read by the uploader itself, the last block is flagged as last block.
+
+        @param pak: the packet-system to send to.
+        @param ranges: the ranges to send.
+        """
+
+        with open(self.broadcast.path, "rb") as fd:
+            for start, end in ranges:
+                fd.seek(start)
+                for offset in range(start, end, self.broadcast.blockSize):
+                    data: bytes = fd.read(min(self.broadcast.blockSize, end - offset))
+                    last = offset + len(data) >= end and end == ranges[-1][1]
+                    self.throttle.consume(len(data))
+                    pak.send_block(self.uuid, offset, data, DataBlock.LAST_BLOCK if last else 0)
+                    with self._progressLock:
+                        self.bytesSent += len(data)
+
+    def start(self):
+        """
+        Start upload.
+        """
+
+        self.broadcast.attach(self)
+        self._thread = Thread(target=lambda: self.upload())
+        self._thread.start()
 
 
 class PreFolderUploader(PreUploader):
@@ -188,20 +775,31 @@ class PreFolderUploader(PreUploader):
         @return: the uploader
         """
         a = FolderUploader(pak, self.path, self.progressbar, on_complete=self.onComplete, on_error=self.onError, canvas_item=self.canvasItem)
-        a.start()
         return a
 
 
 class FolderUploader(Uploader):
     """
-    Uploader, uploads a file.
+    Uploader, uploads a folder.
+    For files the receiver already has a version of, only the changed parts are sent, rsync style: the receiver replies
+    the block signatures of its version, and the uploader sends the blocks it can't find there.
+    Files are announced with their content hash, and files the receiver has in its content store aren't sent at all.
+    Small files are batched: the receiver gets one manifest for many files, replies the files it wants, and gets their
+    contents in one block. The next batch is collected while the reply is underway.
     @author: Quinten Jungblut
     """
 
+    # Files up to this size are batched, and a batch is sent when it reaches the batch size or file count.
+    batchFileSize = 65536
+    batchSize = 1048576
+    batchCount = 1000
+
     def __init__(self, pak: PacketSystem, path, progressbar, *, canvas_item: UploadItem, on_complete=lambda: None, on_error: Callable[[Exception], Any] = lambda exc: None):
         super().__init__()
         self.doneFile = False
         self._fd: Optional[BinaryIO] = None
+        self._buffer = bytearray()
+        self.fileBytesSent = 0
         self.pak: PacketSystem = pak
         self._thread: Optional[Thread] = None
         self.uuid: UUID = uuid3(NAMESPACE_X500, path)
@@ -219,13 +817,25 @@ class FolderUploader(Uploader):
         self.onComplete: Callable[[], None] = on_complete
         self.canvasItem: UploadItem = canvas_item
         self.path: str = path
-        self.currentPath: str = path
+        self._realPath: str = os.path.realpath(path)
         self.currentFile: Optional[str] = None
 
         self.totalSize = 0
 
+        self.entries: List[ScanEntry] = []
         self.totalSize = self.calculate_size()
-        self.pak.sendall(self.totalSize)
+        self.hashIndex: HashIndex = HashIndex.default()
+
+        # The batch being collected, and the batch whose manifest is sent, as (rel-path, path, size, hash) tuples.
+        self._batch: List[Tuple[str, str, int, str]] = []
+        self._batchBytes = 0
+        self._pendingBatch: Optional[List[Tuple[str, str, int, str]]] = None
+
+        # Sizes the blocks of the files that are sent whole or as delta, the round trips are measured with the replies.
+        self.blockSizer = BlockSizer()
+
+        # Files that couldn't be sent, as (rel-path, exception) tuples, the receiver keeps its existing versions.
+        self.failed: List[Tuple[str, Exception]] = []
 
         self.done = False
 
@@ -236,59 +846,111 @@ class FolderUploader(Uploader):
         """
 
         # a = self.totalFileSize.to_bytes(16, "big", signed=False)
-        self.pak.sendall(self.uuid)
+        try:
+            self.pak.send(self.uuid)
+            self.pak.send(self.totalSize)
+
+            self.upload_folder()
+            self.flush_batches()
 
-        self.upload_folder(self.path)
+            self.pak.send({"type": "end"})
+        except Exception as e:
+            self.done = True
+            if not isinstance(e, ConnectionError):
+                try:
+                    self.pak.send({"type": "error", "uuid": str(self.uuid), "error": {"exception": e}})
+                except ConnectionError:
+                    pass
+            self.onError(e)
+            return
 
-        self.pak.sendall({"type": "end"})
+        try:
+            self.hashIndex.save()
+        except OSError:
+            # The index only saves hashing the files again.
+            pass
 
         self.done = True
+        if self.failed:
+            rel_path, error = self.failed[0]
+            self.onError(OSError(f"{len(self.failed)} files couldn't be sent, {rel_path}: {error}"))
+            return
         self.onComplete()
 
-    def upload_folder(self, path: str):
-        try:
-            print(f"Expected to send: {self.totalSize} Bytes")
+    def upload_folder(self):
+        print(f"Expected to send: {self.totalSize} Bytes")
 
-            self.currentPath = path
+        for entry in self.entries:
+            if entry.is_dir:
+                self.pak.send({"type": "create-folder", "rel-path": entry.rel_path})
+            else:
+                self.upload_file(entry)
+        print("Sent:", self.bytesSent, "Bytes")
 
-            for item in os.listdir(path):
-                i_path = os.path.join(path, item)
+    def fail_file(self, rel_path: str, error: Exception):
+        """
+        Skips a file that couldn't be sent, the receiver is told to keep its existing version.
 
-                if os.path.isdir(i_path):
-                    self.pak.sendall({"type": "create-folder", "rel-path": os.path.relpath(i_path, self.path).replace(os.sep, "/")})
-                    self.upload_folder(i_path)
-                elif os.path.isfile(i_path):
-                    self.upload_file(item)
-        except Exception as e:
-            self.onError(e)
-            self.done = True
-        print("Sent:", self.bytesSent, "Bytes")
+        @param rel_path: the path relative to the folder.
+        @param error: the exception.
+        """
 
-    def upload_file(self, filename: str):
-        try:
-            self.currentFile = path = os.path.join(self.currentPath, filename)
-            rel_path: str = os.path.relpath(path, self.path).replace(os.sep, "/")
-            norm_path: str = os.path.realpath(os.path.abspath(path))
-            file_size: int = os.path.getsize(norm_path)
-            self.pak.sendall({"type": "create-file", "rel-path": rel_path, "size": file_size})
+        self.failed.append((rel_path, error))
+        self.pak.send({"type": "error", "rel-path": rel_path, "error": {"exception": error}})
 
+    def upload_file(self, entry: ScanEntry):
+        try:
+            self.currentFile = path = entry.path
+            rel_path: str = entry.rel_path
+            norm_path: str = os.path.join(self._realPath, *rel_path.split("/"))
+            file_size: int = entry.size
+            self.message = f"Hashing: {path}"
+            file_hash: str = self.hashIndex.get(norm_path, (entry.size, entry.mtime_ns))
+            if file_size <= self.batchFileSize:
+                self.batch_file(rel_path, path, file_size, file_hash)
+                return
+
+            # Replies are awaited in order, so the pending batch is completed first.
+            self.flush_batches()
+
+            # Opened before it's announced, so a file that can't be read doesn't leave a reply behind.
             self._fd = open(path, "rb")
-
-            while True:
-                self.send_block(65536)
+            self.doneFile = False
+            self.fileBytesSent = 0
+
+            sent = monotonic()
+            self.pak.send({"type": "create-file", "rel-path": rel_path, "size": file_size, "hash": file_hash})
+
+            # The receiver replies it has the content, or the signature of its version of the file.
+            reply = self.wait_reply("have", "signature", rel_path=rel_path)
+            self.blockSizer.observe_rtt(monotonic() - sent)
+            if reply["type"] == "signature":
+                if self.compression is None:
+                    self.compression = self.negotiate_compression(reply)
+                else:
+                    self.compression.restart()
+            if reply["type"] == "have":
+                self.bytesSent += file_size
                 self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
                                f"Total size: {FileSize.get_string(self.totalSize)}\n" \
                                f"Current path: {path}"
-                if self.doneFile:
-                    break
+            elif reply["blocks"] and file_size > 0:
+                self.send_delta(DeltaGenerator(reply["size"], reply["block-size"], reply["blocks"]), file_size)
+            else:
+                while True:
+                    self.send_block(self.blockSizer.size)
+                    self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
+                                   f"Total size: {FileSize.get_string(self.totalSize)}\n" \
+                                   f"Current path: {path}" + self.compression_message()
+                    if self.doneFile:
+                        break
+            self._fd.close()
+        except ConnectionError:
+            raise
         except Exception as e:
-            self.onError(e)
-            try:
-                self.pak.sendall({"type": "error", "error": {"exception": e}})
-            except ConnectionError:
-                pass
-            except PermissionError:
-                pass
+            if self._fd is not None:
+                self._fd.close()
+            self.fail_file(entry.rel_path, e)
 
     def start(self):
         """
@@ -296,7 +958,9 @@ class FolderUploader(Uploader):
         @author: Quinten Jungblut
         """
 
-        self.upload()
+        # On its own thread like the FileUploader, the sender of the connection routes the replies of multiplexed uploads.
+        self._thread = Thread(target=lambda: self.upload())
+        self._thread.start()
 
     def send_block(self, size: int):
         """
@@ -306,31 +970,147 @@ class FolderUploader(Uploader):
         @author: Quinten Jungblut
         """
 
-        data: bytes = self._fd.read(size)
-        size1 = len(data)
+        if len(self._buffer) != size:
+            self._buffer = bytearray(size)
+        size1 = self._fd.readinto(self._buffer)
         if size1 < size:
-            self.done = True
-        self.pak.sendall({"type": "data-rel-path", "rel-path": os.path.relpath(self.currentFile, self.path), "data": {"size": size1, "data": data, "last-block": self.done}})
+            self.doneFile = True
+        self.blockSizer.start()
+        self.throttle.consume(size1)
+        self.pak.send_block(self.uuid, self.fileBytesSent, memoryview(self._buffer)[:size1], DataBlock.LAST_BLOCK if self.doneFile else 0, self.compression)
+        if size1:
+            self.blockSizer.sent(size1)
+        self.fileBytesSent += size1
         self.bytesSent += size1
 
+    def batch_file(self, rel_path: str, path: str, size: int, file_hash: str):
+        """
+        Adds a small file to the batch being collected, and sends the batch when it's full.
+
+        @param rel_path: the path relative to the folder.
+        @param path: the real path of the file.
+        @param size: the file size.
+        @param file_hash: the content hash.
+        """
+
+        self._batch.append((rel_path, path, size, file_hash))
+        self._batchBytes += size
+        if self._batchBytes >= self.batchSize or len(self._batch) >= self.batchCount:
+            self.rotate_batch()
+
+    def rotate_batch(self):
+        """
+        Completes the pending batch, and sends the manifest of the collected batch.
+        """
+
+        if self._pendingBatch is not None:
+            self.finish_batch()
+        self.pak.send({"type": "batch", "files": [[rel_path, size, file_hash] for rel_path, _, size, file_hash in self._batch]})
+        self._pendingBatch = self._batch
+        self._batch = []
+        self._batchBytes = 0
+
+    def finish_batch(self):
+        """
+        Waits for the files of the pending batch the receiver wants, and sends their contents in one block.
+        """
+
+        batch = self._pendingBatch
+        self._pendingBatch = None
+        reply = self.wait_reply("want")
+        if self.compression is None:
+            self.compression = self.negotiate_compression(reply)
+        else:
+            self.compression.restart()
+
+        contents = bytearray()
+        for index in reply["files"]:
+            rel_path, path, size, file_hash = batch[index]
+            try:
+                with open(path, "rb") as fd:
+                    data = fd.read(size)
+                if blake2b(data, digest_size=32).hexdigest() != file_hash:
+                    raise OSError(f"File changed during the upload: {path}")
+            except OSError as e:
+                # Sent before the contents, the receiver skips the place of the file in them.
+                self.fail_file(rel_path, e)
+                data = b""
+            contents += data.ljust(size, b"\0")
+        if reply["files"]:
+            self.throttle.consume(len(contents))
+            self.pak.send_block(self.uuid, 0, contents, 0, self.compression)
+
+        self.bytesSent += sum(size for _, _, size, _ in batch)
+        self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
+                       f"Total size: {FileSize.get_string(self.totalSize)}\n" \
+                       f"Batched: {len(reply['files'])} of {len(batch)} files sent" + self.compression_message()
+
+    def flush_batches(self):
+        """
+        Sends the collected batch and completes it.
+        """
+
+        if self._batch:
+            self.rotate_batch()
+        if self._pendingBatch is not None:
+            self.finish_batch()
+
+    def send_delta(self, generator: DeltaGenerator, file_size: int):
+        """
+        Sends the blocks the receiver doesn't have as data blocks, followed by the copy instructions for the rest.
+
+        @param generator: the delta generator for the signature of the receiver.
+        @param file_size: the file size.
+        """
+
+        copies: List[List[int]] = []
+        matched = 0
+        with mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for op in generator.generate(data, file_size):
+                if op[0] == "copy":
+                    _, old_offset, new_offset, length = op
+                    merge_copies(copies, old_offset, new_offset, length)
+                    matched += length
+                    self.bytesSent += length
+                    continue
+                _, start, end = op
+                offset = start
+                while offset < end:
+                    size = min(self.blockSizer.size, end - offset)
+                    self.blockSizer.start()
+                    self.throttle.consume(size)
+                    self.pak.send_block(self.uuid, offset, data[offset:offset + size], 0, self.compression)
+                    self.blockSizer.sent(size)
+                    offset += size
+                    self.bytesSent += size
+                    self.message = f"Uploaded: {FileSize.get_string(self.bytesSent)}\n" \
+                                   f"Total size: {FileSize.get_string(self.totalSize)}\n" \
+                                   f"Unchanged: {FileSize.get_string(matched)}\n" \
+                                   f"Current path: {self.currentFile}" + self.compression_message()
+        self.pak.send({"type": "delta", "uuid": str(self.uuid), "copies": copies})
+        self.doneFile = True
+
     def calculate_size(self) -> int:
-        def file(path):
-            return os.path.getsize(path)
-
-        def folder(path, total_size):
-            folder_size = 0
-            for item in os.listdir(path):
-                self.message = f"Calculating file size...\n" \
-                               f"Path: {path}\n" \
-                               f"Current size: {FileSize.get_string(folder_size + total_size)}"
-                i_path = os.path.join(path, item)
-                if os.path.isdir(i_path):
-                    folder_size += folder(i_path, folder_size + total_size)
-                elif os.path.isfile(i_path):
-                    folder_size += file(i_path)
-                self.message = f"Calculating file size...\n" \
-                               f"Path: {path}\n" \
-                               f"Current size: {FileSize.get_string(folder_size + total_size)}"
-            return folder_size
-
-        return folder(self.path, 0)
+        """
+        Scans the folder once, the entries are kept for the upload.
+
+        @return: the total size of the files.
+        @author: Quinten Jungblut
+        """
+
+        last_update = 0.0
+
+        def progress(files: int, size: int):
+            nonlocal last_update
+            if monotonic() - last_update < 0.1:
+                return
+            last_update = monotonic()
+            self.message = f"Calculating file size...\n" \
+                           f"Files: {files}\n" \
+                           f"Current size: {FileSize.get_string(size)}"
+
+        scanner = FolderScanner(self.path, on_progress=progress)
+        self.entries = scanner.scan()
+        for error in scanner.errors:
+            self.onError(error)
+        return scanner.totalSize
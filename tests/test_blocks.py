@@ -0,0 +1,138 @@
+import os
+import pickle
+import unittest
+from uuid import uuid4
+
+from advUtils.network import (CodecRegistry, CompressionStage, CompressorRegistry, DataBlock, PacketDecoder,
+                              PacketEncoder)
+
+
+class CodecTest(unittest.TestCase):
+    def round_trip(self, o, codecs):
+        parts = PacketEncoder(o, codecs).get_parts()
+        return parts[0], PacketDecoder(b"".join(parts)).get_decoded()
+
+    def test_marshal(self):
+        packet = {"type": "file", "size": 10, "ranges": [[0, 10]], "data": b"\x00"}
+        prefix, decoded = self.round_trip(packet, ["marshal", "pickle"])
+        self.assertEqual(prefix, CodecRegistry.get("marshal").prefix)
+        self.assertEqual(decoded, packet)
+
+    def test_fallback(self):
+        # Marshal doesn't take other objects, the next codec is used.
+        packet = {"uuid": uuid4(), "data": bytearray(b"data")}
+        prefix, decoded = self.round_trip(packet, ["marshal", "pickle"])
+        self.assertEqual(prefix, CodecRegistry.get("pickle").prefix)
+        self.assertEqual(decoded, packet)
+
+    def test_pickle_buffers(self):
+        # Pickle buffers are sent out-of-band, and copied from the receive buffer.
+        data = os.urandom(100000)
+        parts = PacketEncoder({"data": pickle.PickleBuffer(data)}, ["pickle"]).get_parts()
+        self.assertIn(data, [bytes(part) for part in parts])
+        self.assertEqual(bytes(PacketDecoder(b"".join(parts)).get_decoded()["data"]), data)
+
+    def test_no_codec(self):
+        with self.assertRaises(ValueError):
+            PacketEncoder(object(), ["marshal"]).get_parts()
+
+    def test_negotiate(self):
+        self.assertEqual(CodecRegistry.negotiate(["pickle", "marshal", "unknown"]), ["marshal", "pickle"])
+
+
+class DataBlockTest(unittest.TestCase):
+    def frame(self, block: DataBlock) -> memoryview:
+        return memoryview(block.pack_header() + bytes(block.data))
+
+    def test_round_trip(self):
+        transfer_id = uuid4()
+        block = DataBlock.from_frame(self.frame(DataBlock(transfer_id, 1 << 40, b"data", DataBlock.LAST_BLOCK)))
+        self.assertEqual((block.transferId, block.offset, block.length, bytes(block.data)),
+                         (transfer_id, 1 << 40, 4, b"data"))
+        self.assertTrue(block.last_block)
+        self.assertFalse(block.zero_block)
+
+    def test_zero_block(self):
+        block = DataBlock.from_frame(self.frame(DataBlock(uuid4(), 0, b"", DataBlock.ZERO_BLOCK, 4096)))
+        self.assertTrue(block.zero_block)
+        self.assertEqual(block.length, 4096)
+
+    def test_compressed(self):
+        data = bytes(100000)
+        for name in CompressorRegistry.available():
+            compressor = CompressorRegistry.get(name)
+            flags = compressor.id << DataBlock.COMPRESSOR_SHIFT
+            block = DataBlock.from_frame(self.frame(DataBlock(uuid4(), 0, compressor.compress(data), flags, len(data))))
+            self.assertEqual(bytes(block.data), data)
+
+    def test_compressed_length(self):
+        # A block that decompresses to more or less than its length is rejected, the extra data isn't decompressed.
+        data = bytes(100000)
+        for name in CompressorRegistry.available():
+            compressor = CompressorRegistry.get(name)
+            flags = compressor.id << DataBlock.COMPRESSOR_SHIFT
+            for length in (len(data) - 1, len(data) + 1):
+                with self.assertRaises(ValueError):
+                    DataBlock.from_frame(self.frame(DataBlock(uuid4(), 0, compressor.compress(data), flags, length)))
+            with self.assertRaises(ValueError):
+                DataBlock.from_frame(self.frame(DataBlock(uuid4(), 0, compressor.compress(data), flags,
+                                                          DataBlock.MAX_DECOMPRESSED + 1)))
+
+    def test_unknown_compressor(self):
+        with self.assertRaises(ValueError):
+            DataBlock.from_frame(self.frame(DataBlock(uuid4(), 0, b"data", DataBlock.COMPRESSOR_MASK)))
+
+
+class CompressionStageTest(unittest.TestCase):
+    def test_compressible(self):
+        stage = CompressionStage("zlib", sample_blocks=2)
+        for _ in range(10):
+            flags, out = stage.process(bytes(10000))
+            self.assertNotEqual(flags, 0)
+            self.assertLess(len(out), 10000)
+        self.assertFalse(stage.skipping)
+        self.assertLess(stage.ratio, 0.1)
+
+    def test_incompressible(self):
+        stage = CompressionStage("zlib", sample_blocks=2, probe_interval=4)
+        compressed = []
+        for _ in range(16):
+            flags, out = stage.process(os.urandom(10000))
+            compressed.append(flags != 0)
+            self.assertEqual(len(out), 10000)
+        self.assertTrue(stage.skipping)
+        self.assertEqual(stage.ratio, 1.0)
+        self.assertNotIn(True, compressed)
+
+    def test_probe(self):
+        # Skipping stops at the first probe after the data became compressible.
+        stage = CompressionStage("zlib", sample_blocks=2, probe_interval=4)
+        for _ in range(4):
+            stage.process(os.urandom(10000))
+        self.assertTrue(stage.skipping)
+        flags = [stage.process(bytes(10000))[0] for _ in range(8)]
+        self.assertFalse(stage.skipping)
+        self.assertNotEqual(flags[-1], 0)
+
+    def test_recheck(self):
+        # While compressing, the saving is checked again every probe interval.
+        stage = CompressionStage("zlib", sample_blocks=2, probe_interval=4)
+        for _ in range(4):
+            stage.process(bytes(10000))
+        self.assertFalse(stage.skipping)
+        for _ in range(8):
+            stage.process(os.urandom(10000))
+        self.assertTrue(stage.skipping)
+
+    def test_restart(self):
+        stage = CompressionStage("zlib", sample_blocks=2)
+        for _ in range(2):
+            stage.process(os.urandom(10000))
+        self.assertTrue(stage.skipping)
+        stage.restart()
+        self.assertFalse(stage.skipping)
+        self.assertNotEqual(stage.process(bytes(10000))[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
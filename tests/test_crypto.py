@@ -0,0 +1,124 @@
+import os
+import socket
+import unittest
+from threading import Thread
+from uuid import uuid4
+
+from advUtils.network import CryptedPacketSystem, DataBlock, FrameCipher, KeyExchange, SessionKey, hkdf_sha256
+
+
+@unittest.skipUnless(FrameCipher.available(), "no AES-GCM implementation")
+class FrameCipherTest(unittest.TestCase):
+    def setUp(self):
+        key, prefix = os.urandom(32), os.urandom(4)
+        self.sender = FrameCipher(key, prefix)
+        self.receiver = FrameCipher(key, prefix)
+
+    def test_round_trip(self):
+        for size in (0, 1, 100000):
+            data = os.urandom(size)
+            sealed = bytes(self.sender.seal([data[:size // 2], data[size // 2:]], b"header"))
+            self.assertEqual(len(sealed), size + FrameCipher.TAG_SIZE)
+            self.assertEqual(bytes(self.receiver.open(memoryview(sealed), b"header")), data)
+
+    def test_tampered(self):
+        sealed = bytearray(self.sender.seal([b"data"], b"header"))
+        sealed[0] ^= 1
+        with self.assertRaises(ConnectionError):
+            self.receiver.open(memoryview(sealed), b"header")
+
+    def test_header(self):
+        sealed = bytes(self.sender.seal([b"data"], b"header"))
+        with self.assertRaises(ConnectionError):
+            self.receiver.open(memoryview(sealed), b"other")
+
+    def test_reordered(self):
+        self.sender.seal([b"first"], b"")
+        second = bytes(self.sender.seal([b"second"], b""))
+        with self.assertRaises(ConnectionError):
+            self.receiver.open(memoryview(second), b"")
+
+    def test_short(self):
+        with self.assertRaises(ConnectionError):
+            self.receiver.open(memoryview(b"short"), b"")
+
+
+class KeyExchangeTest(unittest.TestCase):
+    def test_secret(self):
+        exchange = KeyExchange(1)
+        private_a, public_a = exchange.keypair()
+        private_b, public_b = exchange.keypair()
+        self.assertNotEqual(public_a, public_b)
+        self.assertEqual(KeyExchange.secret(private_a, public_b), KeyExchange.secret(private_b, public_a))
+
+    def test_public_out_of_range(self):
+        private, _ = KeyExchange.generate_keypair()
+        for public in (0, 1, KeyExchange.PRIME - 1, KeyExchange.PRIME):
+            with self.assertRaises(ValueError):
+                KeyExchange.secret(private, public)
+
+    def test_hkdf(self):
+        # Test case 1 of RFC 5869.
+        okm = hkdf_sha256(bytes.fromhex("0b" * 22), bytes.fromhex("000102030405060708090a0b0c"),
+                          bytes.fromhex("f0f1f2f3f4f5f6f7f8f9"), 42)
+        self.assertEqual(okm.hex(), "3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db02d56ecc4c5bf"
+                                    "34007208d5b887185865")
+
+
+@unittest.skipUnless(FrameCipher.available(), "no AES-GCM implementation")
+class CryptedPacketSystemTest(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+        self.key = SessionKey(os.urandom(32), True)
+
+    def pair(self, server: SessionKey, client_master: bytes):
+        return CryptedPacketSystem(self.a, server), CryptedPacketSystem(self.b, SessionKey(client_master, False))
+
+    def test_packets_and_blocks(self):
+        server, client = self.pair(self.key, self.key.master)
+        transfer_id = uuid4()
+        data = os.urandom(300000)
+
+        sender = Thread(target=lambda: (server.send({"type": "hello"}), server.send_block(transfer_id, 10, data),
+                                        server.ping(), server.send({"type": "bye"})))
+        sender.start()
+        self.assertEqual(client.recv(), {"type": "hello"})
+        block = client.recv()
+        self.assertIsInstance(block, DataBlock)
+        self.assertEqual((block.transferId, block.offset, bytes(block.data)), (transfer_id, 10, data))
+        self.assertEqual(client.recv(), {"type": "bye"})
+        sender.join()
+
+        client.send("reply")
+        self.assertEqual(server.recv(), "reply")
+
+    def test_file_block(self):
+        server, client = self.pair(self.key, self.key.master)
+        transfer_id = uuid4()
+        with open(__file__, "rb") as fd:
+            expected = fd.read()[5:105]
+            server.send_file_block(transfer_id, fd, 5, 100, DataBlock.LAST_BLOCK)
+        block = client.recv()
+        self.assertEqual(bytes(block.data), expected)
+        self.assertTrue(block.last_block)
+
+    def test_wrong_key(self):
+        server, client = self.pair(self.key, os.urandom(32))
+        server.send("secret")
+        with self.assertRaises(ConnectionError):
+            client.recv()
+
+    def test_derived_streams(self):
+        # Every stream label gives other keys, and both sides derive the same ones.
+        first = self.key.derive("1 salt")
+        second = self.key.derive("2 salt")
+        self.assertNotEqual(first.master, second.master)
+        server, client = self.pair(first, SessionKey(self.key.master, False).derive("1 salt").master)
+        server.send("stream")
+        self.assertEqual(client.recv(), "stream")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import random
+import tempfile
+import unittest
+
+from old.delta import DeltaGenerator, block_size_for, merge_copies, signature
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(0)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def delta(self, old: bytes, new: bytes):
+        with open(self.path, "wb") as fd:
+            fd.write(old)
+        return list(DeltaGenerator(*signature(self.path)).generate(new, len(new)))
+
+    def apply(self, old: bytes, new: bytes, delta) -> bytes:
+        result = bytearray(len(new))
+        for instruction in delta:
+            if instruction[0] == "copy":
+                _, old_offset, new_offset, length = instruction
+                result[new_offset:new_offset + length] = old[old_offset:old_offset + length]
+            else:
+                _, start, end = instruction
+                result[start:end] = new[start:end]
+        return bytes(result)
+
+    def copied(self, delta) -> int:
+        return sum(instruction[3] for instruction in delta if instruction[0] == "copy")
+
+    def test_block_size(self):
+        self.assertEqual(block_size_for(0), 2048)
+        self.assertEqual(block_size_for(1 << 40), 131072)
+        self.assertEqual(block_size_for(1 << 24) % 1024, 0)
+
+    def test_unchanged(self):
+        old = self.random.randbytes(100000)
+        delta = self.delta(old, old)
+        self.assertEqual(self.copied(delta), len(old))
+        self.assertEqual(self.apply(old, old, delta), old)
+
+    def test_insertion(self):
+        old = self.random.randbytes(100000)
+        new = old[:30000] + b"inserted" + old[30000:]
+        delta = self.delta(old, new)
+        self.assertEqual(self.apply(old, new, delta), new)
+        # Only the block around the insertion is sent as literal.
+        self.assertGreaterEqual(self.copied(delta), len(old) - 2 * block_size_for(len(old)))
+
+    def test_deletion(self):
+        old = self.random.randbytes(100000)
+        new = old[:50000] + old[50100:]
+        delta = self.delta(old, new)
+        self.assertEqual(self.apply(old, new, delta), new)
+        self.assertGreaterEqual(self.copied(delta), len(old) - 2 * block_size_for(len(old)))
+
+    def test_changed(self):
+        old = self.random.randbytes(100000)
+        new = self.random.randbytes(120000)
+        delta = self.delta(old, new)
+        self.assertEqual(delta, [("literal", 0, len(new))])
+
+    def test_tail(self):
+        old = self.random.randbytes(10000)
+        new = b"head" + old
+        delta = self.delta(old, new)
+        self.assertEqual(self.apply(old, new, delta), new)
+        self.assertEqual(delta[-1], ("copy", 8192, 8196, 1808))
+
+    def test_empty(self):
+        self.assertEqual(self.delta(b"", b"new"), [("literal", 0, 3)])
+        self.assertEqual(self.delta(b"old", b""), [])
+
+    def test_merge_copies(self):
+        copies = []
+        merge_copies(copies, 0, 100, 10)
+        merge_copies(copies, 10, 110, 10)
+        merge_copies(copies, 50, 120, 10)
+        self.assertEqual(copies, [[0, 100, 20], [50, 120, 10]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+from old.manifest import TransferManifest, resume_ranges
+
+
+class TransferManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(TransferManifest, "directory", self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+        self.target = os.path.join(self.directory.name, "target")
+        self.data = os.urandom(300000)
+        with open(self.target, "wb") as fd:
+            fd.write(self.data)
+
+    def test_add(self):
+        manifest = TransferManifest(uuid4(), self.target, 1000)
+        manifest.add(0, 100)
+        manifest.add(100, 200)
+        manifest.add(500, 600)
+        manifest.add(300, 400)
+        manifest.add(350, 550)
+        manifest.add(700, 700)
+        self.assertEqual(manifest.ranges, [[0, 200], [300, 600]])
+        self.assertEqual(manifest.completed(), 500)
+        self.assertEqual(manifest.missing(), [(200, 300), (600, 1000)])
+
+        manifest.add(150, 350)
+        self.assertEqual(manifest.ranges, [[0, 600]])
+
+    def test_discard(self):
+        manifest = TransferManifest(uuid4(), self.target, 1000)
+        manifest.add(0, 1000)
+        manifest.discard(200, 300)
+        self.assertEqual(manifest.ranges, [[0, 200], [300, 1000]])
+        self.assertEqual(manifest.missing(), [(200, 300)])
+
+    def test_save_load(self):
+        uuid = uuid4()
+        manifest = TransferManifest(uuid, self.target, len(self.data))
+        manifest.add(0, 100000)
+        manifest.add(200000, 250000)
+        manifest.save(force=True)
+
+        loaded = TransferManifest.load(uuid, self.target, len(self.data))
+        self.assertEqual(loaded.ranges, manifest.ranges)
+
+        # Another target or size is a new download.
+        self.assertIsNone(TransferManifest.load(uuid, self.target, len(self.data) + 1))
+        self.assertIsNone(TransferManifest.load(uuid, self.target + "2", len(self.data)))
+        self.assertIsNone(TransferManifest.load(uuid4(), self.target, len(self.data)))
+
+        manifest.remove()
+        self.assertIsNone(TransferManifest.load(uuid, self.target, len(self.data)))
+
+    def test_load_truncated(self):
+        uuid = uuid4()
+        manifest = TransferManifest(uuid, self.target, len(self.data) * 2)
+        manifest.add(0, len(self.data) * 2)
+        manifest.save(force=True)
+        self.assertIsNone(TransferManifest.load(uuid, self.target, len(self.data) * 2))
+
+    def test_save_interval(self):
+        uuid = uuid4()
+        manifest = TransferManifest(uuid, self.target, len(self.data))
+        manifest.add(0, 100)
+        manifest.save()
+        self.assertFalse(os.path.exists(manifest.file))
+
+    def test_resume(self):
+        uuid = uuid4()
+        manifest = TransferManifest(uuid, self.target, len(self.data))
+        manifest.add(0, 100000)
+        manifest.add(200000, 250000)
+        with open(self.target, "rb") as fd:
+            reply = {"uuid": str(uuid), "ranges": manifest.ranges, "tails": manifest.tails(fd)}
+        with open(self.target, "rb") as fd:
+            self.assertEqual(resume_ranges(fd, len(self.data), reply), [(100000, 200000), (250000, 300000)])
+
+        # The receiver's tail of the first range doesn't match the sender's file anymore.
+        with open(self.target, "r+b") as fd:
+            fd.seek(99999)
+            fd.write(bytes([self.data[99999] ^ 1]))
+        with open(self.target, "rb") as fd:
+            self.assertEqual(resume_ranges(fd, len(self.data), reply),
+                             [(100000 - TransferManifest.tailSize, 200000), (250000, 300000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import socket
+import unittest
+from threading import Thread
+from uuid import uuid4
+
+from advUtils.network import DataBlock, Multiplexer, PacketSystem
+
+
+class MultiplexerTest(unittest.TestCase):
+    window = 64 * 1024
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.server = Multiplexer(PacketSystem(self.a), True, window=self.window, fragment_size=4096,
+                                  bulk_fragment_size=16384)
+        self.client = Multiplexer(PacketSystem(self.b), False, window=self.window, fragment_size=4096,
+                                  bulk_fragment_size=16384)
+        self.server.start()
+        self.client.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+        self.a.close()
+        self.b.close()
+
+    def send(self, func, *args):
+        thread = Thread(target=func, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def test_control(self):
+        self.client.control.send({"type": "ping"})
+        self.assertEqual(self.server.control.recv(), {"type": "ping"})
+        self.server.control.send({"type": "pong"})
+        self.assertEqual(self.client.control.recv(), {"type": "pong"})
+
+    def test_streams(self):
+        stream = self.client.open()
+        stream.send("first")
+        accepted = self.server.accept()
+        self.assertEqual(accepted.id, stream.id)
+        self.assertEqual(stream.id % 2, 1)
+        self.assertEqual(self.server.open().id % 2, 0)
+        self.assertEqual(accepted.recv(), "first")
+
+    def test_order(self):
+        stream = self.client.open()
+        sender = self.send(lambda: [stream.send(index) for index in range(200)])
+        accepted = self.server.accept()
+        self.assertEqual([accepted.recv() for _ in range(200)], list(range(200)))
+        sender.join(10)
+
+    def test_fragmented_block(self):
+        # Blocks bigger than the window are sent in fragments, and granted again while they're received.
+        stream = self.client.open()
+        transfer_id = uuid4()
+        data = os.urandom(self.window * 5 + 123)
+        sender = self.send(stream.send_block, transfer_id, 42, data, DataBlock.LAST_BLOCK)
+        block = self.server.accept().recv()
+        self.assertEqual((block.transferId, block.offset, block.last_block), (transfer_id, 42, True))
+        self.assertEqual(bytes(block.data), data)
+        sender.join(10)
+        self.assertFalse(sender.is_alive())
+
+    def test_window(self):
+        # A stream that isn't read stops its own sender, not the control stream.
+        stream = self.client.open()
+        sent = []
+        sender = self.send(lambda: [(stream.send(bytes(4096)), sent.append(index)) for index in range(100)])
+        accepted = self.server.accept()
+        sender.join(0.5)
+        self.assertTrue(sender.is_alive())
+        self.assertLess(len(sent), 100)
+
+        self.client.control.send("control")
+        self.assertEqual(self.server.control.recv(), "control")
+
+        for _ in range(100):
+            self.assertEqual(accepted.recv(), bytes(4096))
+        sender.join(10)
+        self.assertEqual(len(sent), 100)
+
+    def test_interleaved(self):
+        first, second = self.client.open(), self.client.open()
+        data = os.urandom(200000)
+        senders = [self.send(lambda: [first.send_block(uuid4(), 0, data) for _ in range(5)]),
+                   self.send(lambda: [second.send(index) for index in range(50)])]
+        accepted = {stream.id: stream for stream in (self.server.accept(), self.server.accept())}
+
+        # The second stream is read to its end while the first one waits for its window.
+        self.assertEqual([accepted[second.id].recv() for _ in range(50)], list(range(50)))
+        for _ in range(5):
+            self.assertEqual(bytes(accepted[first.id].recv().data), data)
+        for sender in senders:
+            sender.join(10)
+
+    def test_close(self):
+        stream = self.client.open()
+        stream.send("last")
+        stream.close()
+        accepted = self.server.accept()
+        self.assertEqual(accepted.recv(), "last")
+        with self.assertRaises(ConnectionError):
+            accepted.recv()
+        with self.assertRaises(ConnectionError):
+            stream.send("closed")
+
+    def test_max_message_size(self):
+        self.client.maxMessageSize = 1000
+        stream = self.client.open()
+        with self.assertRaises(ValueError):
+            stream.send(bytes(2000))
+        stream.send(bytes(500))
+        self.assertEqual(self.server.accept().recv(), bytes(500))
+
+    def test_connection_lost(self):
+        stream = self.client.open()
+        self.a.shutdown(socket.SHUT_RDWR)
+        with self.assertRaises(ConnectionError):
+            self.client.control.recv()
+        with self.assertRaises(ConnectionError):
+            stream.recv()
+        with self.assertRaises(ConnectionError):
+            self.client.open()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from old.scheduler import Transfer, TransferScheduler
+
+
+class TransferSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatched = []
+        self.scheduler = TransferScheduler(lambda conn, item: self.dispatched.append((conn, item)),
+                                           small_file_size=100)
+
+    def submit(self, name, size=None, priority=0, conn="peer"):
+        transfer = Transfer(conn, [name], size, priority)
+        self.scheduler.submit(transfer)
+        return transfer
+
+    def started(self):
+        return [item for _, item in self.dispatched]
+
+    def test_one_transfer_per_peer(self):
+        first = self.submit("first", 1000)
+        self.submit("second", 1000)
+        self.assertEqual(self.started(), ["first"])
+
+        self.scheduler.finished(first)
+        self.assertEqual(self.started(), ["first", "second"])
+
+    def test_peers_run_independently(self):
+        self.submit("a", 1000, conn="peer a")
+        self.submit("b", 1000, conn="peer b")
+        self.assertEqual(self.started(), ["a", "b"])
+
+    def test_order(self):
+        running = self.submit("running", 1000)
+        self.submit("large", 1000)
+        self.submit("folder")
+        self.submit("small", 50)
+        self.submit("smaller", 10)
+        self.submit("urgent", 1000, priority=1)
+
+        self.assertEqual([transfer.items[0] for transfer in self.scheduler.queued("peer")],
+                         ["urgent", "smaller", "small", "large", "folder"])
+
+        self.scheduler.finished(running)
+        self.assertEqual(self.started(), ["running", "urgent"])
+
+    def test_pause_resume(self):
+        running = self.submit("running", 1000)
+        paused = self.submit("paused", 1000)
+        self.submit("next", 1000)
+
+        self.assertTrue(self.scheduler.pause(paused))
+        self.assertFalse(self.scheduler.pause(running))
+        self.scheduler.finished(running)
+        self.assertEqual(self.started(), ["running", "next"])
+
+        self.scheduler.resume(paused)
+        self.assertEqual(paused.state, Transfer.QUEUED)
+        self.assertEqual(self.scheduler.queued("peer"), [paused])
+
+    def test_resume_starts_when_idle(self):
+        running = self.submit("running", 1000)
+        paused = self.submit("paused", 1000)
+        self.scheduler.pause(paused)
+        self.scheduler.finished(running)
+        self.assertEqual(self.started(), ["running"])
+
+        self.scheduler.resume(paused)
+        self.assertEqual(self.started(), ["running", "paused"])
+        self.assertEqual(paused.state, Transfer.RUNNING)
+
+    def test_move(self):
+        self.submit("running", 1000)
+        first = self.submit("first", 1000)
+        second = self.submit("second", 1000)
+        third = self.submit("third", 1000)
+
+        self.scheduler.move_to_front(third)
+        self.scheduler.move_to_back(first)
+        self.assertEqual(self.scheduler.queued("peer"), [third, second, first])
+
+    def test_concurrency(self):
+        for name in ("a", "b", "c", "d"):
+            self.submit(name, 1000)
+        self.assertEqual(self.started(), ["a"])
+
+        self.scheduler.set_concurrency("peer", 3)
+        self.assertEqual(self.started(), ["a", "b", "c"])
+        self.assertEqual(len(self.scheduler.running("peer")), 3)
+
+    def test_finished_once(self):
+        running = self.submit("running", 1000)
+        self.submit("next", 1000)
+        self.submit("last", 1000)
+
+        callback = self.scheduler.on_finished(running, lambda: None)
+        callback()
+        callback()
+        self.assertEqual(self.started(), ["running", "next"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from threading import Thread
+from time import monotonic
+
+from old.throttle import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    def consume(self, share, amount: int, blocks: int) -> float:
+        start = monotonic()
+        for _ in range(blocks):
+            share.consume(amount)
+        return monotonic() - start
+
+    def test_unlimited(self):
+        share = RateLimiter().share()
+        self.assertLess(self.consume(share, 1 << 30, 100), 0.1)
+
+    def test_rate(self):
+        share = RateLimiter(1000000, burst=0.05).share()
+        # 300 KB at 1 MB/s, the first block is free.
+        self.assertAlmostEqual(self.consume(share, 100000, 4), 0.3, delta=0.1)
+
+    def test_shares(self):
+        limiter = RateLimiter(1000000, burst=0.05)
+        shares = [limiter.share(), limiter.share(3.0)]
+        sent = [0, 0]
+
+        def run(index):
+            start = monotonic()
+            while monotonic() - start < 0.6:
+                shares[index].consume(10000)
+                sent[index] += 10000
+
+        threads = [Thread(target=run, args=(index,)) for index in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The rate is divided by weight, 1 to 3.
+        self.assertAlmostEqual(sent[1] / sent[0], 3.0, delta=0.8)
+        self.assertAlmostEqual(sum(sent), 600000, delta=150000)
+
+    def test_rate_change(self):
+        limiter = RateLimiter(1000, burst=0.05)
+        share = limiter.share()
+        share.consume(100000)
+        thread = Thread(target=share.consume, args=(1,))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+
+        # Waiting transfers pick up the new rate immediately.
+        limiter.rate = None
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()